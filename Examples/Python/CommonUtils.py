@@ -88,13 +88,15 @@ def download_and_unzip_dataset(datasetName, outputDirectory):
 	if generate_download_flag(outputDirectory,datasetName):
 		# check if the zipped data is present
 		zipfile = 'Data/' + datasetName + ".zip"
-		if not os.path.exists(zipfile):
+		if os.path.exists(zipfile):
+			print("Unzipping " + zipfile + " into " + outputDirectory)
+			with ZipFile(zipfile, 'r') as zipObj:
+				zipObj.extractall(path=outputDirectory)
+		else:
 			print("Can't find " + zipfile)
+			# the dataset is unzipped into outputDirectory as it downloads, without storing the zip
 			import DatasetUtils
-			DatasetUtils.downloadDataset(datasetName, destinationPath='./Data/')
-		print("Unzipping " + zipfile + " into " + outputDirectory)
-		with ZipFile(zipfile, 'r') as zipObj:
-			zipObj.extractall(path=outputDirectory)
+			DatasetUtils.downloadAndUnzipDataset(datasetName, destinationPath=outputDirectory)
 
 def get_file_list(directory, ending='', indices=[]):
 	file_list = []
@@ -374,15 +374,9 @@ def MeshesToVolumes(outDir, meshList, spacing):
     print("########### Turning Mesh To Volume ##############")
     if not os.path.exists(outDir):
         os.mkdir(outDir)
-    segList = []
-
-    for mesh_ in meshList:
-        segFile = rename(mesh_, outDir, "", ".nrrd")
-        segList.append(segFile)
-
-        mesh = Mesh(mesh_)
-        image = mesh.toImage(spacing)
-        image.write(segFile)
+    segList = [rename(mesh_, outDir, "", ".nrrd") for mesh_ in meshList]
+    # each mesh is read once and rasterized in parallel, images are written as they are ready
+    MeshUtils.meshesToImages(meshList, segList, spacing)
     return segList
 
 def ClipBinaryVolumes(outDir, segList, cutting_plane_points):
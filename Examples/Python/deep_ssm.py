@@ -74,7 +74,7 @@ def Run_Pipeline(args):
 		percent_variability = 0.99
 	embedded_dim = DataAugmentationUtils.runDataAugmentation(outputDirectory + "Augmentation/", train_img_list, train_local_particle_list, num_samples, num_dim, percent_variability, sampler_type, mixture_num=0, processes=3, world_point_list=train_world_particle_list)
 	aug_data_csv = outputDirectory + "Augmentation/TotalData.csv"
-	DataAugmentationUtils.visualizeAugmentation(aug_data_csv)
+	DataAugmentationUtils.visualizeAugmentation(aug_data_csv, mode="density")
 
 	print("\n\n\nStep 3. Reformat Data for Pytorch\n") #######################################################################
 	'''
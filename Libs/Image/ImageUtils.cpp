@@ -100,4 +100,42 @@ TransformPtr ImageUtils::createWarpTransform(const std::string &source_landmarks
   return tps;
 }
 
+TransformPtr ImageUtils::createWarpTransform(const Eigen::MatrixXd &source_landmarks, const Eigen::MatrixXd &target_landmarks, const int stride)
+{
+  if (source_landmarks.cols() != 3 || target_landmarks.cols() != 3 || source_landmarks.rows() != target_landmarks.rows())
+    throw std::invalid_argument("source and target landmarks must be N x 3 matrices of the same size");
+  if (stride < 1)
+    throw std::invalid_argument("stride must be at least 1");
+
+  typedef itk::ThinPlateSplineKernelTransform<double, 3> TPSTransform;
+  typedef TPSTransform::PointSetType PointSet;
+
+  PointSet::Pointer sourceLandMarks = PointSet::New();
+  PointSet::Pointer targetLandMarks = PointSet::New();
+  PointSet::PointsContainer::Pointer sourceLandMarkContainer = sourceLandMarks->GetPoints();
+  PointSet::PointsContainer::Pointer targetLandMarkContainer = targetLandMarks->GetPoints();
+
+  PointSet::PointIdentifier id{itk::NumericTraits<PointSet::PointIdentifier>::Zero};
+  for (Eigen::Index i = 0; i < source_landmarks.rows(); i += stride)
+  {
+    Point3 src({source_landmarks(i, 0), source_landmarks(i, 1), source_landmarks(i, 2)});
+    Point3 tgt({target_landmarks(i, 0), target_landmarks(i, 1), target_landmarks(i, 2)});
+
+    // swap src and tgt b/c ITK transforms must be inverted on creation since some do not provide an invert function
+    sourceLandMarkContainer->InsertElement( id, tgt );
+    targetLandMarkContainer->InsertElement( id, src );
+    id++;
+  }
+
+  if (id == 0) return AffineTransform::New();
+
+  // Create and return warp transform
+  TPSTransform::Pointer tps(TPSTransform::New());
+  tps->SetSourceLandmarks(sourceLandMarks);
+  tps->SetTargetLandmarks(targetLandMarks);
+  tps->ComputeWMatrix();
+
+  return tps;
+}
+
 } //shapeworks
@@ -3,6 +3,8 @@
 #include "Image.h"
 #include "ShapeworksUtils.h"
 
+#include <Eigen/Core>
+
 namespace shapeworks {
 
 /// Helper functions for image 
@@ -18,6 +20,9 @@ public:
   /// computes a warp transform from the source to the target landmarks
   static TransformPtr createWarpTransform(const std::string &source_landmarks, const std::string &target_landmarks, const int stride = 1);
 
+  /// computes a warp transform from the source to the target landmarks given as N x 3 matrices
+  static TransformPtr createWarpTransform(const Eigen::MatrixXd &source_landmarks, const Eigen::MatrixXd &target_landmarks, const int stride = 1);
+
 };
 
 } // shapeworks
@@ -14,6 +14,7 @@
 
 // tbb
 #include <tbb/mutex.h>
+#include <tbb/parallel_for.h>
 
 
 namespace shapeworks {
@@ -194,12 +195,11 @@ Region MeshUtils::boundingBox(std::vector<std::string> &filenames, bool center)
   if (filenames.empty())
     throw std::invalid_argument("No filenames provided to compute a bounding box");
   
-  Mesh mesh(filenames[0]);
-  Region bbox(mesh.boundingBox());
+  Region bbox(Mesh(filenames[0]).boundingBox());
 
-  for (auto filename : filenames)
+  for (size_t i = 1; i < filenames.size(); i++)
   {
-    Mesh mesh(filename);
+    Mesh mesh(filenames[i]);
     bbox.grow(mesh.boundingBox());
   }
 
@@ -213,11 +213,63 @@ Region MeshUtils::boundingBox(std::vector<Mesh> &meshes, bool center)
 
   Region bbox(meshes[0].boundingBox());
 
-  for (auto mesh : meshes)
+  for (const auto &mesh : meshes)
     bbox.grow(mesh.boundingBox());
 
   return bbox;
 }
 
+std::vector<Mesh> MeshUtils::readMeshes(const std::vector<std::string> &filenames, Region &bbox)
+{
+  std::vector<Mesh::MeshType> polyData(filenames.size());
+  tbb::mutex bbox_mutex;
+
+  tbb::parallel_for(tbb::blocked_range<size_t>{0, filenames.size()},
+                    [&](const tbb::blocked_range<size_t> &r) {
+    for (size_t i = r.begin(); i < r.end(); ++i)
+    {
+      Mesh mesh(threadSafeReadMesh(filenames[i]));
+      Region meshBox(mesh.boundingBox());
+      {
+        tbb::mutex::scoped_lock lock(bbox_mutex);
+        bbox.grow(meshBox);
+      }
+      polyData[i] = mesh.getVTKMesh();
+    }
+  });
+
+  std::vector<Mesh> meshes;
+  meshes.reserve(filenames.size());
+  for (auto &poly : polyData)
+    meshes.emplace_back(poly);
+  return meshes;
+}
+
+Region MeshUtils::meshesToImages(const std::vector<std::string> &meshFilenames, const std::vector<std::string> &imageFilenames,
+                                 Vector3 spacing, bool compressed)
+{
+  if (meshFilenames.size() != imageFilenames.size())
+    throw std::invalid_argument("Number of mesh and image filenames must match");
+
+  Region bbox;
+  tbb::mutex bbox_mutex;
+
+  tbb::parallel_for(tbb::blocked_range<size_t>{0, meshFilenames.size()},
+                    [&](const tbb::blocked_range<size_t> &r) {
+    for (size_t i = r.begin(); i < r.end(); ++i)
+    {
+      Mesh mesh(threadSafeReadMesh(meshFilenames[i]));
+      Region meshBox(mesh.boundingBox());
+      {
+        tbb::mutex::scoped_lock lock(bbox_mutex);
+        bbox.grow(meshBox);
+      }
+      mesh.toImage(spacing).write(imageFilenames[i], compressed);
+    }
+  });
+
+  return bbox;
+}
+
 
 } // shapeworks
@@ -43,6 +43,14 @@ public:
 
   /// calculate bounding box incrementally for shapework meshes
   static Region boundingBox(std::vector<Mesh> &meshes, bool center = false);
+
+  /// reads the meshes in parallel, each file once, and grows bbox to their union bounding box
+  static std::vector<Mesh> readMeshes(const std::vector<std::string> &filenames, Region &bbox);
+
+  /// rasterizes each mesh to a binary image in parallel, writing each image as soon as it is ready
+  /// every mesh is read once and the union bounding box of the meshes is returned
+  static Region meshesToImages(const std::vector<std::string> &meshFilenames, const std::vector<std::string> &imageFilenames,
+                               Vector3 spacing = makeVector({1.0, 1.0, 1.0}), bool compressed = true);
 };
 
 } // shapeworks
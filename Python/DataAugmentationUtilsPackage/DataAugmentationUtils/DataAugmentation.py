@@ -2,6 +2,9 @@
 import os
 import numpy as np
 import multiprocessing as mtps
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import time
 import json
 from DataAugmentationUtils import Utils
 from DataAugmentationUtils import Embedder
@@ -9,15 +12,12 @@ from DataAugmentationUtils import Sampler
 
 ################################# Augmentaiton Pipelines ###############################################
 
-def point_based_aug(out_dir, orig_img_list, orig_point_list, num_samples, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, processes=1, orig_world_point_list=None):
+def point_based_aug(out_dir, orig_img_list, orig_point_list, num_samples, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, processes=1, orig_world_point_list=None, pca_method='eigh', pca_dtype=np.float64, resume=False, pca_batch_size=None):
 	# Get Embedder
-	point_matrix = Utils.create_data_matrix(orig_point_list)
+	# with a PCA batch size the particles are streamed to memory-mapped matrices instead of being held in memory
+	matrix_dir = out_dir + "PCA_Particle_Info/" if pca_batch_size else None
+	PointEmbedder, point_matrix, world_point_matrix, world_get_local = get_embedder(orig_point_list, num_dim, percent_variability, orig_world_point_list, pca_method, pca_dtype, pca_batch_size, matrix_dir)
 	if orig_world_point_list is not None:
-		world_point_matrix = Utils.create_data_matrix(orig_world_point_list)
-		world_get_local = [Utils.estimate_homogeneous_similar_transform(
-			x=p.reshape((-1,3)).T,
-			y=point_matrix[i].reshape((-1,3)).T,
-		) for i,p in enumerate(world_point_matrix)]
 		world_get_local_info = {
 			'world_get_local_list':[
 				{
@@ -28,25 +28,11 @@ def point_based_aug(out_dir, orig_img_list, orig_point_list, num_samples, num_di
 			],
 			'generated_particle__world_get_local_index':[],
 		}
-		PointEmbedder = Embedder.PCA_Embbeder(world_point_matrix, num_dim, percent_variability)
-	else:
-		PointEmbedder = Embedder.PCA_Embbeder(point_matrix, num_dim, percent_variability)
 	num_dim = PointEmbedder.num_dim
 	PointEmbedder.write_PCA(out_dir + "PCA_Particle_Info/", "particles") # write PCA info for DeepSSM testing
 	embedded_matrix = PointEmbedder.getEmbeddedMatrix()
 	# Get sampler
-	if sampler_type == "gaussian":
-		PointSampler = Sampler.Gaussian_Sampler()
-		PointSampler.fit(embedded_matrix) 
-	elif sampler_type == "mixture":
-		PointSampler = Sampler.Mixture_Sampler()
-		PointSampler.fit(embedded_matrix, mixture_num) 
-	elif sampler_type == "kde":
-		PointSampler = Sampler.KDE_Sampler()
-		PointSampler.fit(embedded_matrix) 
-	else:
-		print("Error sampler_type unrecognized.")
-		print("Gaussian, mixture, and KDE currently supported.")
+	PointSampler = get_sampler(sampler_type, embedded_matrix, mixture_num)
 	
 	# Initialize output folders and lists
 	gen_point_dir = out_dir + "Generated-Particles/"
@@ -55,54 +41,152 @@ def point_based_aug(out_dir, orig_img_list, orig_point_list, num_samples, num_di
 	gen_image_dir = out_dir + "Generated-Images/"
 	if not os.path.exists(gen_image_dir):
 		os.makedirs(gen_image_dir)
-	gen_embeddings = []
-	gen_points_paths = []
-	gen_image_paths = []
-	if processes != 1:
-		generate_image_params_list = []
-	# Sample to generate new examples
-	for index in range(1, num_samples+1):
-		print("Generating " +str(index)+'/'+str(num_samples))
-		name = 'Generated_sample_' + Utils.pad_index(index)
-		# Generate embedding
-		sampled_embedding, base_index = PointSampler.sample()
-		gen_embeddings.append(sampled_embedding)
-		# Generate particles
+	# Rows are streamed to TotalData.csv and its sidecar as batches complete
+	num_orig = len(orig_img_list)
+	csv_writer = Utils.CSV_Writer(out_dir + "TotalData.csv", num_dim, num_orig + num_samples, resume)
+	if csv_writer.count == 0:
+		csv_writer.write(orig_img_list, orig_point_list, embedded_matrix)
+	resumed = csv_writer.count - num_orig
+	if resumed > 0:
+		print("Resuming after " + str(resumed) + '/' + str(num_samples) + " generated samples")
 		if orig_world_point_list is not None:
-			p = PointEmbedder.project(sampled_embedding)
-			i = int(np.nanargmin(np.linalg.norm(p-world_point_matrix, axis=(1,2))))
-			# TODO add Randomness in the transformation from world to local particles
-			gen_points = (world_get_local[i] @ Utils.get_homogeneous_coordinates(p.reshape((-1,3)).T))[:3,:].T
-			world_get_local_info['generated_particle__world_get_local_index'].append(i)
-		else:
-			gen_points = PointEmbedder.project(sampled_embedding)
-		gen_points_path = gen_point_dir + name + ".particles"
-		np.savetxt(gen_points_path, gen_points)
-		gen_points_paths.append(gen_points_path)
-		# Generate image
-		base_image_path = orig_img_list[base_index]
-		base_particles_path = orig_point_list[base_index]
-		if processes==1:
-			gen_image_path = Utils.generate_image(out_dir, gen_points_path, base_image_path, base_particles_path)
-			gen_image_paths.append(gen_image_path)
-		else:
-			generate_image_params_list.append({
-				'out_dir':out_dir,
-				'gen_points_path':gen_points_path,
-				'base_image_path':base_image_path,
-				'base_particles_path':base_particles_path,
-			})
+			# the transform used for each written sample is recovered from its scores
+			_, world_indices = generate_particles_batch(PointEmbedder, csv_writer.scores[num_orig:csv_writer.count], world_point_matrix, world_get_local)
+			world_get_local_info['generated_particle__world_get_local_index'].extend(int(i) for i in world_indices)
+	# Pipeline: batches are sampled and projected here while a thread pool writes particle files
+	# and a process pool (if processes != 1) warps images, with a bounded number of batches in flight
+	batch_size = min(num_samples, max(32, 8*processes)) if num_samples else 1
+	max_pending = 2*max(1, processes)
+	# the worker processes are started before the writer threads so no threads are running when they fork
+	warper = mtps.Pool(processes=processes) if processes != 1 else None
+	writer = ThreadPool(4)
+	pending = deque()
+	completed = resumed
+	t0 = time.time()
+	try:
+		for start in range(resumed, num_samples, batch_size):
+			count = min(batch_size, num_samples - start)
+			# Generate embeddings
+			sampled_embeddings, base_indices = PointSampler.sample_batch(count)
+			# Generate particles
+			gen_points, world_indices = generate_particles_batch(PointEmbedder, sampled_embeddings, world_point_matrix, world_get_local)
+			if orig_world_point_list is not None:
+				world_get_local_info['generated_particle__world_get_local_index'].extend(int(i) for i in world_indices)
+			names = ['Generated_sample_' + Utils.pad_index(start + i + 1) for i in range(count)]
+			batch_points_paths = [gen_point_dir + name + ".particles" for name in names]
+			batch_image_paths = [gen_image_dir + name + ".nrrd" for name in names]
+			writes = writer.starmap_async(np.savetxt, zip(batch_points_paths, gen_points))
+			# Generate images, samples sharing a base image go to the same worker so it reads the base once
+			groups = {}
+			for i in range(count):
+				groups.setdefault(int(base_indices[i]), []).append((batch_image_paths[i], gen_points[i]))
+			tasks = [(orig_img_list[base_index], orig_point_list[base_index], group) for base_index, group in groups.items()]
+			if warper is None:
+				warps = [generate_images(task) for task in tasks]
+			else:
+				warps = warper.map_async(generate_images, tasks)
+			pending.append((batch_image_paths, batch_points_paths, sampled_embeddings, writes, warps))
+			while len(pending) > max_pending or (pending and start + count == num_samples):
+				batch_image_paths, batch_points_paths, sampled_embeddings, writes, warps = pending.popleft()
+				writes.get()
+				if warper is not None:
+					warps.get()
+				# a batch is committed to the csv once its files are written
+				csv_writer.write(batch_image_paths, batch_points_paths, sampled_embeddings)
+				completed += len(batch_image_paths)
+				elapsed = time.time() - t0
+				print("Generated " + str(completed) + '/' + str(num_samples) + " (" + '%.2f' % ((completed - resumed)/max(elapsed, 1e-9)) + " samples/sec)")
+	finally:
+		writer.close()
+		if warper is not None:
+			warper.close()
+		writer.join()
+		if warper is not None:
+			warper.join()
+		csv_writer.close()
 	if orig_world_point_list is not None:
 		# write world to local transformation information for generated particles
 		with open(out_dir + '/world_get_local_info.json', 'w') as f:
 			json.dump(world_get_local_info, f)
-	if processes!=1:
-		with mtps.Pool(processes=processes) as p:
-			gen_image_paths = p.map(generate_image, generate_image_params_list)
-	csv_file = out_dir + "TotalData.csv"
-	Utils.make_CSV(out_dir + "TotalData.csv", orig_img_list, orig_point_list, embedded_matrix, gen_image_paths, gen_points_paths, gen_embeddings)
 	return num_dim
 
-def generate_image(param):
-	gen_image_path = Utils.generate_image(param['out_dir'], param['gen_points_path'], param['base_image_path'], param['base_particles_path'])
-	return gen_image_path
+'''
+Fits the PCA embedder to the local particles, or to the world particles when they are given
+pca_method and pca_dtype select the PCA computation (see Embedder.PCA_Embbeder)
+returns the embedder, the local and world particle matrices, and the world to local transforms (None without world particles)
+'''
+def get_embedder(orig_point_list, num_dim=0, percent_variability=0.95, orig_world_point_list=None, pca_method='eigh', pca_dtype=np.float64, pca_batch_size=None, matrix_dir=None):
+	if matrix_dir is not None and not os.path.exists(matrix_dir):
+		os.makedirs(matrix_dir)
+	point_matrix = Utils.create_data_matrix(orig_point_list, matrix_dir + 'particle_matrix.npy' if matrix_dir else None)
+	if orig_world_point_list is None:
+		return Embedder.PCA_Embbeder(point_matrix, num_dim, percent_variability, pca_method, pca_dtype, pca_batch_size), point_matrix, None, None
+	world_point_matrix = Utils.create_data_matrix(orig_world_point_list, matrix_dir + 'world_particle_matrix.npy' if matrix_dir else None)
+	world_get_local = Utils.estimate_homogeneous_similar_transform_batch(
+		x=np.transpose(world_point_matrix.reshape((world_point_matrix.shape[0], -1, 3)), (0, 2, 1)),
+		y=np.transpose(point_matrix.reshape((point_matrix.shape[0], -1, 3)), (0, 2, 1)),
+	)
+	PointEmbedder = Embedder.PCA_Embbeder(world_point_matrix, num_dim, percent_variability, pca_method, pca_dtype, pca_batch_size)
+	return PointEmbedder, point_matrix, world_point_matrix, world_get_local
+
+'''
+Fits the sampler of sampler_type (gaussian, mixture, or KDE) to the embedded matrix
+'''
+def get_sampler(sampler_type, embedded_matrix, mixture_num=0):
+	sampler_type = sampler_type.lower()
+	if sampler_type == "gaussian":
+		PointSampler = Sampler.Gaussian_Sampler()
+		PointSampler.fit(embedded_matrix) 
+	elif sampler_type == "mixture":
+		PointSampler = Sampler.Mixture_Sampler()
+		PointSampler.fit(embedded_matrix, mixture_num) 
+	elif sampler_type == "kde":
+		PointSampler = Sampler.KDE_Sampler()
+		PointSampler.fit(embedded_matrix) 
+	else:
+		print("Error sampler_type unrecognized.")
+		print("Gaussian, mixture, and KDE currently supported.")
+		exit()
+	return PointSampler
+
+'''
+Projects a sampled embedding to local particles
+with world particles the transform of the closest original world particles maps the projection to local particles
+returns the particles and the index of the world to local transform used (None without world particles)
+'''
+def generate_particles(PointEmbedder, sampled_embedding, world_point_matrix=None, world_get_local=None):
+	gen_points, world_indices = generate_particles_batch(PointEmbedder, np.asarray(sampled_embedding)[np.newaxis], world_point_matrix, world_get_local)
+	if world_indices is None:
+		return gen_points[0], None
+	return gen_points[0], int(world_indices[0])
+
+'''
+Projects an (n, d) array of sampled embeddings to an (n, M, 3) array of local particles
+the closest original world particles for every sample are found with one matrix product
+returns the particles and the indices of the world to local transforms used (None without world particles)
+'''
+def generate_particles_batch(PointEmbedder, sampled_embeddings, world_point_matrix=None, world_get_local=None):
+	p = PointEmbedder.project_batch(sampled_embeddings)
+	if world_point_matrix is None:
+		return p, None
+	flat_p = p.reshape(p.shape[0], -1)
+	flat_world = world_point_matrix.reshape(world_point_matrix.shape[0], -1)
+	# squared distances |p|^2 - 2 p.w + |w|^2
+	dists = np.sum(flat_p**2, axis=1)[:, np.newaxis] - 2*np.matmul(flat_p, flat_world.T) + np.sum(flat_world**2, axis=1)[np.newaxis]
+	indices = np.nanargmin(dists, axis=1)
+	# TODO add Randomness in the transformation from world to local particles
+	transforms = np.array(world_get_local)[indices]
+	p = p.reshape(p.shape[0], -1, 3)
+	gen_points = np.matmul(p, np.transpose(transforms[:, :3, :3], (0, 2, 1))) + transforms[:, np.newaxis, :3, 3]
+	return gen_points, indices
+
+'''
+Warps the base image to each of the generated particles and writes the images
+task is (base image path, base particles path, list of (generated image path, generated particles))
+'''
+def generate_images(task):
+	base_image_path, base_particles_path, samples = task
+	image, base_particles = Utils.get_base(base_image_path, base_particles_path)
+	for gen_image_path, gen_points in samples:
+		Utils.warp_image(image, base_particles, gen_points).write(gen_image_path)
+	return [gen_image_path for gen_image_path, gen_points in samples]
@@ -17,51 +17,135 @@ class Embedder(ABC):
 		pass
  
 # instance of embedder that uses PCA for dimension reduction
+# method selects how the modes are computed:
+#	'eigh' - eigendecomposition of the N x N gram matrix (all modes)
+#	'randomized' - randomized SVD that only computes the retained modes
+#	'incremental' - incremental PCA fed batch_size samples (or the number of modes if larger) at a time, so data_matrix can be a memory-mapped array
+# dtype is the floating point type used for the computation, float32 halves the memory of float64
 class PCA_Embbeder(Embedder):
 	# overriding abstract methods
-	def __init__(self, data_matrix, num_dim=0, percent_variability=0.95):
+	def __init__(self, data_matrix, num_dim=0, percent_variability=0.95, method='eigh', dtype=np.float64, batch_size=None):
 		self.data_matrix = data_matrix
-		num_dim = self.run_PCA(num_dim, percent_variability)
+		self.dtype = dtype
+		self.batch_size = batch_size
+		self.mean = self.get_mean()
+		num_dim = self.run_PCA(num_dim, percent_variability, method)
 		self.num_dim = num_dim
+	# flattened mean of the data instances, computed in batches
+	def get_mean(self):
+		total = np.zeros(int(np.prod(self.data_matrix.shape[1:])), dtype=np.float64)
+		for start, batch in self.get_batches():
+			total += np.sum(batch, axis=0)
+		return (total / self.data_matrix.shape[0]).astype(self.dtype)
+	# yields (start index, centered or raw flattened batch) pairs over the data instances
+	# batches have batch_size instances (self.batch_size by default), a last batch smaller than min_size is merged into the one before it
+	def get_batches(self, centered=False, min_size=0, batch_size=None):
+		N = self.data_matrix.shape[0]
+		if batch_size is None:
+			batch_size = self.batch_size if self.batch_size else N
+		bounds = list(range(0, N, batch_size)) + [N]
+		if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_size:
+			del bounds[-2]
+		for start, end in zip(bounds[:-1], bounds[1:]):
+			batch = np.asarray(self.data_matrix[start:end], dtype=self.dtype)
+			batch = batch.reshape(batch.shape[0], -1)
+			if centered:
+				batch = batch - self.mean
+			yield start, batch
 	# run PCA on data_matrix for PCA_Embedder
-	def run_PCA(self, num_dim, percent_variability):
-		# get covariance matrix (uses compact trick)
+	def run_PCA(self, num_dim, percent_variability, method='eigh'):
 		N = self.data_matrix.shape[0]
-		data_matrix_2d = self.data_matrix.reshape(self.data_matrix.shape[0], -1).T # flatten data instances and transpose
-		mean = np.mean(data_matrix_2d, axis=1)
-		centered_data_matrix_2d = (data_matrix_2d.T - mean).T
-		trick_cov_matrix  = np.dot(centered_data_matrix_2d.T,centered_data_matrix_2d) * 1.0/np.sqrt(N-1)
-		# get eignevectors and eigenvalues
-		eigen_values, eigen_vectors = np.linalg.eigh(trick_cov_matrix)
-		eigen_vectors = np.dot(centered_data_matrix_2d, eigen_vectors)
-		for i in range(N):
-			eigen_vectors[:,i] = eigen_vectors[:,i]/np.linalg.norm(eigen_vectors[:,i])
-		eigen_values = np.flip(eigen_values)
-		eigen_vectors = np.flip(eigen_vectors, 1)
+		# eigenvalues are scaled like the compact covariance trick, squared singular values / sqrt(N-1)
+		scale = 1.0/np.sqrt(N-1)
+		if method == 'eigh':
+			eigen_values, eigen_vectors = self.run_eigh(scale)
+			total_variance = np.sum(eigen_values)
+		elif method in ['randomized', 'incremental']:
+			# the total variance is the trace of the gram matrix, so the retained variability is known without every mode
+			total_variance = 0.
+			for start, batch in self.get_batches(centered=True):
+				total_variance += np.sum(np.float64(batch)**2)
+			total_variance *= scale
+			if method == 'randomized':
+				eigen_values, eigen_vectors = self.run_randomized(num_dim, percent_variability, total_variance, scale)
+			else:
+				eigen_values, eigen_vectors = self.run_incremental(num_dim, percent_variability, total_variance, scale)
+		else:
+			print("Error: PCA method " + str(method) + " unrecognized.")
+			print("eigh, randomized, and incremental currently supported.")
+			exit()
 		# get num PCA components
-		cumDst = np.cumsum(eigen_values) / np.sum(eigen_values)
+		cumDst = np.cumsum(eigen_values) / total_variance
 		if num_dim == 0:
-			cumDst = np.cumsum(eigen_values) / np.sum(eigen_values)
-			num_dim = np.where(cumDst > float(percent_variability))[0][0] + 1
+			num_dim = min(np.searchsorted(cumDst, float(percent_variability), side='right') + 1, len(eigen_values))
+			if cumDst[num_dim-1] < float(percent_variability):
+				print("Warning: the " + str(num_dim) + " PCA modes computed preserve less than the requested variability.")
 		W = eigen_vectors[:, :num_dim]
-		PCA_scores = np.matmul(centered_data_matrix_2d.T, W)
+		PCA_scores = np.zeros((N, num_dim), dtype=self.dtype)
+		for start, batch in self.get_batches(centered=True):
+			PCA_scores[start:start+batch.shape[0]] = np.matmul(batch, W)
 		print("The PCA modes of particles being retained : ", num_dim)
 		print("Variablity preserved: " + str(float(cumDst[num_dim-1])))
 		self.num_dim = num_dim
 		self.PCA_scores = PCA_scores
-		self.eigen_vectors = eigen_vectors
+		self.eigen_vectors = np.ascontiguousarray(W)
 		self.eigen_values = eigen_values
 		return num_dim
+	# eigendecomposition of the gram matrix (compact trick)
+	def run_eigh(self, scale):
+		centered_data_matrix_2d = np.concatenate([batch for start, batch in self.get_batches(centered=True)]).T
+		trick_cov_matrix  = np.dot(centered_data_matrix_2d.T,centered_data_matrix_2d) * scale
+		# get eignevectors and eigenvalues
+		eigen_values, eigen_vectors = np.linalg.eigh(trick_cov_matrix)
+		eigen_vectors = np.dot(centered_data_matrix_2d, eigen_vectors)
+		eigen_vectors /= np.linalg.norm(eigen_vectors, axis=0)
+		eigen_values = np.flip(eigen_values)
+		eigen_vectors = np.flip(eigen_vectors, 1)
+		return eigen_values, eigen_vectors
+	# randomized SVD of the top modes, doubling the number of modes until percent_variability is reached
+	def run_randomized(self, num_dim, percent_variability, total_variance, scale):
+		from sklearn.utils.extmath import randomized_svd
+		centered_data_matrix_2d = np.concatenate([batch for start, batch in self.get_batches(centered=True)])
+		max_dim = min(centered_data_matrix_2d.shape)
+		num_modes = num_dim if num_dim else min(32, max_dim)
+		while True:
+			U, S, VT = randomized_svd(centered_data_matrix_2d, num_modes, random_state=0)
+			eigen_values = S**2 * scale
+			if num_dim or num_modes == max_dim or np.sum(eigen_values) / total_variance > float(percent_variability):
+				return eigen_values, VT.T
+			num_modes = min(2*num_modes, max_dim)
+	# incremental PCA, only batch_size samples are in memory at a time
+	# like run_randomized the number of modes is doubled until percent_variability is reached,
+	# batches grow to the number of modes since partial_fit needs at least that many samples per batch
+	def run_incremental(self, num_dim, percent_variability, total_variance, scale):
+		from sklearn.decomposition import IncrementalPCA
+		N = self.data_matrix.shape[0]
+		batch_size = self.batch_size if self.batch_size else N
+		max_dim = min(N, self.mean.size)
+		num_modes = num_dim if num_dim else min(batch_size, max_dim)
+		while True:
+			ipca = IncrementalPCA(n_components=num_modes)
+			for start, batch in self.get_batches(min_size=num_modes, batch_size=max(batch_size, num_modes)):
+				ipca.partial_fit(batch)
+			# explained_variance_ is squared singular values / (N-1)
+			eigen_values = ipca.explained_variance_ * (N-1) * scale
+			if num_dim or num_modes == max_dim or np.sum(eigen_values) / total_variance > float(percent_variability):
+				return eigen_values, ipca.components_.T.astype(self.dtype)
+			num_modes = min(2*num_modes, max_dim)
 	# write PCA info to files 
-	# @TODO do we need all of this?
-	def write_PCA(self, out_dir, suffix):
+	# pca_model.npz holds the mean, eigenvalues and retained modes in one binary file (see load_PCA)
+	# the text mean, eigenvalues and pcamode files are also written unless write_text is False
+	def write_PCA(self, out_dir, suffix, write_text=True):
 		if not os.path.exists(out_dir):
 			os.makedirs(out_dir)
 		np.save(out_dir +  'original_PCA_scores.npy', self.PCA_scores)
-		mean = np.mean(self.data_matrix, axis=0)
+		mean = self.mean.reshape(self.data_matrix.shape[1:])
+		np.savez(out_dir + 'pca_model.npz', mean=mean, eigen_values=self.eigen_values, modes=self.eigen_vectors.T)
+		if not write_text:
+			return
 		np.savetxt(out_dir + 'mean.' + suffix, mean)
 		np.savetxt(out_dir + 'eigenvalues.txt', self.eigen_values)
-		for i in range(self.data_matrix.shape[0]):
+		for i in range(self.eigen_vectors.shape[1]):
 			nm = out_dir + 'pcamode' + str(i) + '.' + suffix
 			data = self.eigen_vectors[:, i]
 			data = data.reshape(self.data_matrix.shape[1:])
@@ -72,7 +156,26 @@ class PCA_Embbeder(Embedder):
 	# projects embbed array into data
 	def project(self, PCA_instance):
 		W = self.eigen_vectors[:, :self.num_dim].T
-		mean = np.mean(self.data_matrix, axis=0)
-		data_instance =  np.matmul(PCA_instance, W) + mean.reshape(-1)
+		data_instance =  np.matmul(PCA_instance, W) + self.mean
 		data_instance = data_instance.reshape((self.data_matrix.shape[1:]))
-		return data_instance
\ No newline at end of file
+		return data_instance
+	# projects an (n, num_dim) array of embedded instances into an (n,) + instance shape array of data
+	def project_batch(self, PCA_instances):
+		W = self.eigen_vectors[:, :self.num_dim].T
+		data_instances = np.matmul(PCA_instances, W) + self.mean
+		return data_instances.reshape((-1,) + self.data_matrix.shape[1:])
+
+# loads PCA info written by PCA_Embbeder.write_PCA
+# returns the mean, the eigenvalues, and the modes as a (num_modes, flattened size) matrix
+# reads pca_model.npz if there is one and otherwise the text files
+def load_PCA(out_dir, suffix='particles'):
+	model_path = os.path.join(out_dir, 'pca_model.npz')
+	if os.path.exists(model_path):
+		with np.load(model_path) as model:
+			return model['mean'], model['eigen_values'], model['modes']
+	mean = np.loadtxt(os.path.join(out_dir, 'mean.' + suffix))
+	eigen_values = np.loadtxt(os.path.join(out_dir, 'eigenvalues.txt'))
+	modes = []
+	while os.path.exists(os.path.join(out_dir, 'pcamode' + str(len(modes)) + '.' + suffix)):
+		modes.append(np.loadtxt(os.path.join(out_dir, 'pcamode' + str(len(modes)) + '.' + suffix)).flatten())
+	return mean, eigen_values, np.array(modes).reshape(len(modes), mean.size)
@@ -0,0 +1,120 @@
+# Online Augmentation Module
+# Generates augmented image/particle pairs on demand instead of writing them to disk.
+# The fitted embedder and sampler are held in memory and each sample is warped when it is requested,
+# so DataLoader workers generate the augmented data in parallel while the network trains.
+import copy
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from shapeworks import Image
+from DataAugmentationUtils import DataAugmentation
+from DataAugmentationUtils import Utils
+
+'''
+Dataset of the original examples followed by num_samples augmented examples
+items are (image, PCA scores, particles) tensors like the DeepSSM loaders
+	resample: draw a new augmented example every time an index is requested, otherwise index i is always the same example
+	seed: seeds the sampler so the generated examples are reproducible
+	down_sample: True to downsample images to 3/4 of their size, or a scale factor
+	cache_size: number of base images each worker keeps in memory
+'''
+class OnlineAugmentationDataset(Dataset):
+	def __init__(self, img_list, local_point_list, num_samples, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, world_point_list=None, include_originals=True, resample=True, seed=0, down_sample=False, cache_size=4):
+		self.img_list = img_list
+		self.local_point_list = local_point_list
+		self.num_samples = num_samples
+		self.include_originals = include_originals
+		self.resample = resample
+		self.seed = seed
+		self.down_sample = down_sample
+		self.cache_size = cache_size
+		self.embedder, self.point_matrix, self.world_point_matrix, self.world_get_local = DataAugmentation.get_embedder(local_point_list, num_dim, percent_variability, world_point_list)
+		self.num_dim = self.embedder.num_dim
+		self.embedded_matrix = self.embedder.getEmbeddedMatrix()
+		self.sampler = DataAugmentation.get_sampler(sampler_type, self.embedded_matrix, mixture_num)
+		self.normalization = None
+		self.images = OrderedDict()
+	# shapeworks images are not picklable, each worker reads its own
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['images'] = OrderedDict()
+		return state
+	def __len__(self):
+		return self.getNumOriginals() + self.num_samples
+	def __getitem__(self, index):
+		image, scores, particles = self.generate(index)
+		if self.normalization is not None:
+			image = (image - self.normalization['mean_img']) / self.normalization['std_img']
+			scores = (scores - self.normalization['mean_PCA']) / self.normalization['std_PCA']
+		image = torch.from_numpy(np.array(image, dtype=np.float32)[np.newaxis])
+		scores = torch.from_numpy(np.array(scores, dtype=np.float32))
+		particles = torch.from_numpy(np.array(particles, dtype=np.float32))
+		return image, scores, particles
+	def getNumOriginals(self):
+		return len(self.img_list) if self.include_originals else 0
+	# returns the image array, PCA scores and local particles of the example at index without normalization
+	def generate(self, index):
+		if index < self.getNumOriginals():
+			return self.toArray(self.getImage(index)), self.embedded_matrix[index], self.point_matrix[index]
+		rng = self.getGenerator(index)
+		sampled_embedding, base_index = self.sampler.sample(rng)
+		gen_points, _ = DataAugmentation.generate_particles(self.embedder, sampled_embedding, self.world_point_matrix, self.world_get_local)
+		image = self.warpImage(base_index, gen_points)
+		return self.toArray(image), sampled_embedding, gen_points
+	def getGenerator(self, index):
+		entropy = [self.seed, index]
+		if self.resample:
+			# drawn from torch so each epoch (and each worker) differs, reproducibly under torch.manual_seed
+			entropy.append(int(torch.randint(2**62, (1,))))
+		return np.random.default_rng(entropy)
+	# returns the base image, keeping the most recently used ones in memory
+	def getImage(self, base_index):
+		image = self.images.pop(base_index, None)
+		if image is None:
+			image = Image(self.img_list[base_index])
+			if len(self.images) >= self.cache_size:
+				self.images.popitem(last=False)
+		self.images[base_index] = image
+		return image
+	# warps a copy of the base image from its particles to the generated particles
+	def warpImage(self, base_index, gen_points):
+		return Utils.warp_image(self.getImage(base_index), self.point_matrix[base_index], gen_points)
+	def toArray(self, image):
+		if self.down_sample:
+			scale = 0.75 if isinstance(self.down_sample, (bool, np.bool_)) else float(self.down_sample)
+			dims = image.dims()
+			image = image.copy()
+			image.resize([max(1, int(scale*dims[0])), max(1, int(scale*dims[1])), max(1, int(scale*dims[2]))])
+		return image.toArray()
+	# estimates the PCA score and image normalization from the originals and num_draws sampled scores
+	def estimateNormalization(self, num_draws=1000):
+		rng = np.random.default_rng(self.seed)
+		scores = [self.sampler.sample(rng)[0] for draw in range(num_draws)]
+		scores = np.concatenate((self.embedded_matrix, np.array(scores).reshape(-1, self.embedded_matrix.shape[1])))
+		# image stats are accumulated like the DeepSSM loaders do (see Utils.combine_stats)
+		stats = None
+		for index in range(len(self.img_list)):
+			stats = Utils.combine_stats(stats, Utils.get_image_stats(self.toArray(self.getImage(index))))
+		count, mean_img, M2 = stats
+		self.normalization = {
+			'mean_PCA': np.mean(scores, axis=0),
+			'std_PCA': np.std(scores, axis=0),
+			'mean_img': mean_img,
+			'std_img': np.sqrt(M2/count),
+		}
+		return self.normalization
+	def setNormalization(self, normalization):
+		self.normalization = normalization
+	# returns a dataset of num_samples fixed augmented examples that shares the fitted embedder and sampler
+	def getValidationDataset(self, num_samples, seed=None):
+		val_data = copy.copy(self)
+		val_data.num_samples = num_samples
+		val_data.include_originals = False
+		val_data.resample = False
+		val_data.seed = self.seed + 1 if seed is None else seed
+		val_data.images = OrderedDict()
+		return val_data
+	# write PCA info for DeepSSM testing
+	def write_PCA(self, out_dir, write_text=True):
+		self.embedder.write_PCA(out_dir, "particles", write_text)
@@ -6,7 +6,8 @@ import os
 import numpy as np
 from abc import ABC, abstractmethod
 from sklearn.mixture import GaussianMixture
-import random
+from scipy.linalg import solve_triangular
+from scipy.spatial import cKDTree
 
 
 ###################### Sampler Class ###################################
@@ -19,20 +20,41 @@ class Sampler(ABC):
 		self.embedded_matrix = embedded_matrix
 		pass
 	# sample should return the sample and the index of the nearest real example
-	def sample(self):
+	# rng is an optional numpy Generator to draw from instead of the global numpy random state
+	def sample(self, rng=None):
 		pass
+	# sample_batch returns an (n, d) array of samples and the indices of their nearest real examples
+	# samplers override it to draw all n samples at once
+	def sample_batch(self, n, rng=None):
+		samples = np.array([self.sample(rng)[0] for i in range(n)]).reshape(n, -1)
+		return samples, self.getClosestIndices(samples)
+	# gets the index of the closest real example (by mahalanobis distance) to each sample
+	# the whitened embedded matrix and its KD-tree are computed once and cached
+	def getClosestIndices(self, samples):
+		if getattr(self, 'closest_tree', None) is None:
+			self.covariance_matrix = np.cov(np.asarray(self.embedded_matrix).reshape(len(self.embedded_matrix), -1).T)
+			self.closest_tree = cKDTree(whiten(self.embedded_matrix, self.covariance_matrix))
+		return self.closest_tree.query(whiten(samples, self.covariance_matrix))[1]
 
 # instance of Sampler class that uses a single Gaussian
 class Gaussian_Sampler(Sampler):
 	def fit(self, embedded_matrix):
 		print("Fitting Gaussian distribution...")
 		self.embedded_matrix = embedded_matrix
+		self.closest_tree = None
 		self.mean = np.mean(embedded_matrix, axis=0)
 		self.cov = np.cov(embedded_matrix, rowvar=0)
-	def sample(self):
-		sample = np.random.multivariate_normal(self.mean, self.cov)
-		closest_index = getClosest(sample, self.embedded_matrix)
+	def sample(self, rng=None):
+		if rng is None:
+			rng = np.random
+		sample = rng.multivariate_normal(self.mean, self.cov)
+		closest_index = self.getClosestIndices(sample[np.newaxis])[0]
 		return sample, closest_index
+	def sample_batch(self, n, rng=None):
+		if rng is None:
+			rng = np.random
+		samples = rng.multivariate_normal(self.mean, self.cov, size=n)
+		return samples, self.getClosestIndices(samples)
 
 # instance of Sampler class that uses a mixture of Gaussians
 # mixture_num is the number of clusters to use (if 0 it autoselects the best number using the elbow method)
@@ -40,6 +62,7 @@ class Mixture_Sampler(Sampler):
 	def fit(self, embedded_matrix, mixture_num):
 		print("Fitting Gaussian mixture model...")
 		self.embedded_matrix = embedded_matrix
+		self.closest_tree = None
 		if mixture_num == 0:
 			mixture_num = self.selectClusterNum()
 		self.GMM = GaussianMixture(mixture_num, covariance_type='full', random_state=0)
@@ -55,54 +78,73 @@ class Mixture_Sampler(Sampler):
 		mixture_num = n_components[avg_index]
 		print("Using " + str(mixture_num) + " components.")
 		return mixture_num
-	def sample(self):
-		rand_int = random.randint(1, 1000)
-		sample = self.GMM.sample(rand_int)[0][-1]
-		closest_index = getClosest(sample, self.embedded_matrix)
-		return sample, closest_index
+	def sample(self, rng=None):
+		samples, closest_indices = self.sample_batch(1, rng)
+		return samples[0], closest_indices[0]
+	def sample_batch(self, n, rng=None):
+		if rng is None:
+			rng = np.random
+		# GMM.sample draws from its fixed random_state, so seed it from rng for each batch
+		random_state = self.GMM.random_state
+		self.GMM.random_state = int(rng.randint(2**31) if rng is np.random else rng.integers(2**31))
+		samples = self.GMM.sample(n)[0]
+		self.GMM.random_state = random_state
+		# samples come back grouped by mixture component
+		samples = samples[rng.permutation(n)]
+		return samples, self.getClosestIndices(samples)
 
 # instance of Sampler class that uses kernel density estimate
 class KDE_Sampler(Sampler):
 	def fit(self, embedded_matrix):
 		print("Fitting KDE...")
 		self.embedded_matrix = embedded_matrix
+		self.closest_tree = None
 		# get sigma squared
-		nearest_neighbor_dists = []
-		cov = np.cov(embedded_matrix.T)
-		for i in embedded_matrix:
-			smallest = np.Inf
-			for j in embedded_matrix:
-				dist = Mdist(i,j,cov)
-				if dist < smallest and dist != 0:
-					smallest = dist
-			nearest_neighbor_dists.append(smallest)
-		self.sigma_squared = np.mean(np.array(nearest_neighbor_dists))/embedded_matrix.shape[1]
-	def sample(self):
-		base_index = np.random.randint(self.embedded_matrix.shape[0])
-		base_PCA_score = self.embedded_matrix[base_index]
-		noise = []
-		for i in range(self.embedded_matrix.shape[1]):
-			noise.append(np.random.normal(0,self.sigma_squared))
-		noise = np.array(noise)
-		sampled_PCA_score = base_PCA_score + noise
-		return sampled_PCA_score, base_index
+		# in whitened coordinates the squared euclidean distance is the squared mahalanobis distance
+		whitened_matrix = whiten(embedded_matrix)
+		nearest_neighbor_dists = getNearestNeighborDistances(whitened_matrix)
+		self.sigma_squared = np.mean(nearest_neighbor_dists)/embedded_matrix.shape[1]
+	def sample(self, rng=None):
+		samples, base_indices = self.sample_batch(1, rng)
+		return samples[0], base_indices[0]
+	# the base examples are chosen at random, so they are returned instead of the closest examples
+	def sample_batch(self, n, rng=None):
+		if rng is None:
+			base_indices = np.random.randint(self.embedded_matrix.shape[0], size=n)
+			normal = np.random.normal
+		else:
+			base_indices = rng.integers(self.embedded_matrix.shape[0], size=n)
+			normal = rng.normal
+		noise = normal(0, self.sigma_squared, size=(n, self.embedded_matrix.shape[1]))
+		samples = self.embedded_matrix[base_indices] + noise
+		return samples, base_indices
 
 ###################### Helper methods ###################################
 
-# sampler helper - gets mahalanobis distance
-def Mdist(instance_i, instance_j, covariance_matrix):
-	temp = instance_i - instance_j
-	dist = np.dot(np.dot(temp, np.linalg.inv(covariance_matrix)), temp.T)
-	return dist
+# sampler helper - whitens the rows of embedded_matrix with the Cholesky factor of the covariance
+def whiten(embedded_matrix, covariance_matrix=None):
+	embedded_matrix = np.asarray(embedded_matrix)
+	embedded_matrix = embedded_matrix.reshape(embedded_matrix.shape[0], -1)
+	if covariance_matrix is None:
+		covariance_matrix = np.cov(embedded_matrix.T)
+	cholesky_factor = np.linalg.cholesky(np.atleast_2d(covariance_matrix))
+	return solve_triangular(cholesky_factor, embedded_matrix.T, lower=True).T
 
-# sampler helper - gets closest real example to sample
-def getClosest(sample, embedded_matrix):
-	covariance_matrix = np.cov(embedded_matrix.T)
-	smallest = np.inf
-	for index in range(embedded_matrix.shape[0]):
-		example = embedded_matrix[index]
-		dist = Mdist(sample, example, covariance_matrix)
-		if dist <= smallest:
-			smallest = dist
-			closest = index
-	return closest
+# sampler helper - gets the squared distance from each point to its nearest point at a nonzero distance
+def getNearestNeighborDistances(points):
+	num_points = points.shape[0]
+	tree = cKDTree(points)
+	nearest = np.full(num_points, np.inf)
+	remaining = np.arange(num_points)
+	k = 2
+	# duplicates are at distance zero, so query more neighbors for the points that only found duplicates
+	while remaining.size > 0:
+		k = min(k, num_points)
+		dists = tree.query(points[remaining], k=k)[0].reshape(remaining.size, -1)
+		dists[dists == 0] = np.inf
+		nearest[remaining] = np.min(dists, axis=1)
+		if k == num_points:
+			break
+		remaining = remaining[np.isinf(nearest[remaining])]
+		k *= 2
+	return nearest**2
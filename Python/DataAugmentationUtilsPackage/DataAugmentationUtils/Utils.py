@@ -1,16 +1,30 @@
-import subprocess
+import os
+import csv
+import json
 import numpy as np
+from collections import OrderedDict
+from shapeworks import Image, ImageUtils
 
 # from image2ssm.ssmaug.utils import estimate_homogeneous_similar_transform,get_homogeneous_coordinates
 
 '''
 Reads data from files in given list and turns into one np matrix
+if out_path is given the matrix is a memory-mapped .npy file at that path, filled one file at a time
 '''
-def create_data_matrix(file_list):
-	data_matrix = []
-	for file in file_list:
-		data_matrix.append(np.loadtxt(file))
-	return np.array(data_matrix)
+def create_data_matrix(file_list, out_path=None):
+	if out_path is None:
+		data_matrix = []
+		for file in file_list:
+			data_matrix.append(np.loadtxt(file))
+		return np.array(data_matrix)
+	data_matrix = None
+	for index, file in enumerate(file_list):
+		data = np.loadtxt(file)
+		if data_matrix is None:
+			data_matrix = np.lib.format.open_memmap(out_path, mode='w+', dtype=data.dtype, shape=(len(file_list),) + data.shape)
+		data_matrix[index] = data
+	data_matrix.flush()
+	return data_matrix
 
 '''
 Pad index 
@@ -24,22 +38,172 @@ def pad_index(index):
 '''
 Makes csv of real and augmented data with format:
 	image path, particles path, PCA scores
+the scores and paths are also written to the columnar sidecar read by read_CSV
 '''
 def make_CSV(filename, orig_imgs, orig_points, orig_embeddings, gen_imgs, gen_points, gen_embeddings):
-	csv_out = open(filename, "w+")
-	# write originals
-	for orig_index in range(len(orig_imgs)):
-		string = orig_imgs[orig_index] + "," + orig_points[orig_index]
-		for score in orig_embeddings[orig_index]:
-			string += "," + str(score)
-		csv_out.write(string + "\n")
-	# write generated
-	for gen_index in range(len(gen_imgs)):
-		string = gen_imgs[gen_index] + "," + gen_points[gen_index]
-		for score in gen_embeddings[gen_index]:
-			string += "," + str(score)
-		csv_out.write(string + "\n")
-	csv_out.close()
+	num_dim = np.asarray(orig_embeddings).shape[1]
+	writer = CSV_Writer(filename, num_dim, len(orig_imgs) + len(gen_imgs))
+	writer.write(orig_imgs, orig_points, orig_embeddings)
+	if len(gen_imgs) > 0:
+		writer.write(gen_imgs, gen_points, gen_embeddings)
+	writer.close()
+
+'''
+Returns the paths of the sidecar files written next to a data csv:
+	<name>_scores.npy holds the PCA scores as one (capacity, num_dim) array
+	<name>_index.jsonl holds one line with the image and particle paths of each batch of rows written
+'''
+def get_sidecar_paths(filename):
+	base = os.path.splitext(filename)[0]
+	return base + '_scores.npy', base + '_index.jsonl'
+
+'''
+Reads the index of a data csv sidecar
+returns the image paths, particle paths and the length in bytes of the complete lines
+a last line without a newline was interrupted while it was written and is ignored
+'''
+def read_index(index_path):
+	image_paths = []
+	particle_paths = []
+	length = 0
+	with open(index_path, 'rb') as index_file:
+		for line in index_file:
+			if not line.endswith(b'\n'):
+				break
+			batch = json.loads(line)
+			image_paths.extend(batch['image_paths'])
+			particle_paths.extend(batch['particle_paths'])
+			length += len(line)
+	return image_paths, particle_paths, length
+
+'''
+Returns the number of lines in a file without parsing them
+'''
+def count_lines(filename):
+	count = 0
+	with open(filename, 'rb') as lines_file:
+		for chunk in iter(lambda: lines_file.read(1048576), b''):
+			count += chunk.count(b'\n')
+	return count
+
+'''
+Streams rows of real and augmented data to the csv and its sidecar as they are generated
+each batch of rows is committed by appending its line to the index, so with resume=True an interrupted run continues after the last committed row
+'''
+class CSV_Writer:
+	def __init__(self, filename, num_dim, capacity, resume=False):
+		self.filename = filename
+		self.scores_path, self.index_path = get_sidecar_paths(filename)
+		shape = (int(capacity), int(num_dim))
+		self.count = 0
+		if resume and os.path.exists(self.index_path) and os.path.exists(self.scores_path) and os.path.exists(filename):
+			image_paths, particle_paths, length = read_index(self.index_path)
+			self.scores = np.load(self.scores_path, mmap_mode='r+')
+			if self.scores.shape != shape:
+				print("Error: " + self.scores_path + " does not match this run, it cannot be resumed.")
+				exit()
+			self.count = len(image_paths)
+			# drop an index line and csv rows written after the last committed batch
+			with open(self.index_path, 'r+b') as index_file:
+				index_file.truncate(length)
+			with open(filename, 'r+') as csv_file:
+				for row in range(self.count):
+					csv_file.readline()
+				csv_file.truncate(csv_file.tell())
+		else:
+			self.scores = np.lib.format.open_memmap(self.scores_path, mode='w+', dtype=np.float64, shape=shape)
+			open(filename, 'w').close()
+			open(self.index_path, 'w').close()
+	# appends rows for the images, particles, and (n, num_dim) scores
+	def write(self, image_paths, particle_paths, scores):
+		scores = np.asarray(scores).reshape(len(image_paths), -1)
+		lines = [','.join([image_paths[i], particle_paths[i]] + [str(score) for score in scores[i]]) + '\n' for i in range(len(image_paths))]
+		with open(self.filename, 'a') as csv_file:
+			csv_file.writelines(lines)
+		self.scores[self.count:self.count + len(image_paths)] = scores
+		self.scores.flush()
+		self.count += len(image_paths)
+		batch = {'image_paths': list(image_paths), 'particle_paths': list(particle_paths)}
+		with open(self.index_path, 'a') as index_file:
+			index_file.write(json.dumps(batch) + '\n')
+	def close(self):
+		self.scores.flush()
+
+'''
+Reads a data csv made by make_CSV or CSV_Writer
+returns the image paths, particle paths, and scores as one (N, num_dim) array
+the sidecar is read when it is present and has as many rows as the csv, and the csv is parsed otherwise
+'''
+def read_CSV(filename):
+	scores_path, index_path = get_sidecar_paths(filename)
+	# a csv edited after the sidecar was written is parsed instead
+	if os.path.exists(scores_path) and os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(filename):
+		image_paths, particle_paths, length = read_index(index_path)
+		if len(image_paths) == count_lines(filename):
+			scores = np.load(scores_path, mmap_mode='r')[:len(image_paths)]
+			return image_paths, particle_paths, np.array(scores)
+	image_paths = []
+	particle_paths = []
+	scores = []
+	with open(filename, newline='') as csv_file:
+		for row in csv.reader(csv_file):
+			image_paths.append(row[0])
+			particle_paths.append(row[1])
+			scores.append(row[2:])
+	return image_paths, particle_paths, np.array(scores, dtype=np.float64).reshape(len(image_paths), -1)
+
+'''
+Returns the count, mean and M2 (sum of squared differences from the mean) of the voxels of an image
+these stats of several images are merged with combine_stats and give the std as sqrt(M2/count) without the precision loss of E[x^2]-E[x]^2
+'''
+def get_image_stats(img):
+	mean = np.mean(img, dtype=np.float64)
+	M2 = np.sum((np.asarray(img, dtype=np.float64) - mean)**2)
+	return img.size, mean, M2
+
+'''
+Merges two (count, mean, M2) stats using Chan et al.'s parallel update, either can be None
+'''
+def combine_stats(stats_a, stats_b):
+	if stats_a is None:
+		return stats_b
+	if stats_b is None:
+		return stats_a
+	count_a, mean_a, M2_a = stats_a
+	count_b, mean_b, M2_b = stats_b
+	count = count_a + count_b
+	delta = mean_b - mean_a
+	mean = mean_a + delta*count_b/count
+	M2 = M2_a + M2_b + delta**2*count_a*count_b/count
+	return count, mean, M2
+
+# the most recently used base images and particles in this process, generated samples often share a base
+base_cache = OrderedDict()
+BASE_CACHE_SIZE = 2
+
+'''
+Reads a base image and its particles, keeping the most recently used ones in memory
+'''
+def get_base(base_image, base_particles):
+	key = (base_image, base_particles)
+	base = base_cache.pop(key, None)
+	if base is None:
+		base = (Image(base_image), np.loadtxt(base_particles))
+		if len(base_cache) >= BASE_CACHE_SIZE:
+			base_cache.popitem(last=False)
+	base_cache[key] = base
+	return base
+
+'''
+Warps a copy of image with the thin plate spline from the source particles to the target particles
+'''
+def warp_image(image, source_particles, target_particles, stride=2):
+	source_particles = np.asarray(source_particles, dtype=np.float64).reshape(-1, 3)
+	target_particles = np.asarray(target_particles, dtype=np.float64).reshape(-1, 3)
+	transform = ImageUtils.createWarpTransform(source_particles, target_particles, stride)
+	warped_image = image.copy()
+	warped_image.applyTransform(transform)
+	return warped_image
 
 '''
 Use warp between particles to warp original image into a new image
@@ -47,11 +211,8 @@ Use warp between particles to warp original image into a new image
 def generate_image(out_dir, gen_particles, base_image, base_particles):
 	image_name = gen_particles.split('/')[-1].replace(".particles",".nrrd")
 	gen_image = out_dir + "Generated-Images/" + image_name
-	cmd = ["shapeworks", 
-		"read-image", "--name", base_image,
-		"warp-image", "--source", base_particles, "--target", gen_particles, "--stride", "2",
-		"write-image", "--name", gen_image]
-	subprocess.check_call(cmd)
+	image, source_particles = get_base(base_image, base_particles)
+	warp_image(image, source_particles, np.loadtxt(gen_particles)).write(gen_image)
 	return gen_image
 
 def get_homogeneous_coordinates(x):
@@ -115,11 +276,11 @@ def estimate_similar_transform(x, y):
 
 	S = np.identity(m)
 	if rank_cov_xy == m-1:
-		if np.linalg.det(U) * np.linalg.det(VT) == -1:
-			S[m, m] = -1		
+		if np.linalg.det(U) * np.linalg.det(VT) < 0:
+			S[m-1, m-1] = -1
 	else:
 		if np.linalg.det(cov_xy) < 0:
-			S[m, m] = -1		
+			S[m-1, m-1] = -1
 
 
 	R = U @ S @ VT
@@ -166,4 +327,52 @@ def estimate_homogeneous_similar_transform(x, y):
 	'''
 	R, t, c = estimate_similar_transform(x=x, y=y)
 	T = get_homogeneous_similar_transform(R=R, t=t, c=c)
-	return T
\ No newline at end of file
+	return T
+
+def estimate_homogeneous_similar_transform_batch(x, y):
+	'''
+	estimate the optimal homogeneous similarity transformations from each points x[i] to points y[i]
+	same as estimate_homogeneous_similar_transform with the SVDs and determinants of all pairs computed at once
+	---
+	x:
+		(n_shapes, n_coordinates, n_samples), first input points
+	y:
+		(n_shapes, n_coordinates, n_samples), second input points
+	---
+	T:
+		(n_shapes, n_coordinates+1, n_coordinates+1) optimal homogeneous similarity transformations from points x to points y
+	'''
+	N, m, n = x.shape
+	assert (y.shape == x.shape), 'shapes of x and y should be the same, but now they are:' + str(x.shape) + ',' + str(y.shape)
+
+	mu_x = np.mean(x, axis=2, keepdims=True)
+	mu_y = np.mean(y, axis=2, keepdims=True)
+
+	# center the points
+	x_tilt = x - mu_x
+	y_tilt = y - mu_y
+
+	sigma_sq_x = np.sum(x_tilt ** 2, axis=(1, 2)) / n
+
+	cov_xy = np.matmul(y_tilt, np.transpose(x_tilt, (0, 2, 1))) / n
+
+	rank_cov_xy = np.linalg.matrix_rank(cov_xy)
+
+	assert np.all(rank_cov_xy >= m-1), 'rank (cov_xy) < m - 1, refer to Equations (40-43) in http://web.stanford.edu/class/cs273/refs/umeyama.pdf'
+
+	U, D, VT = np.linalg.svd(cov_xy)
+
+	# diagonal of S, the last entry is -1 where the reflection has to be removed
+	reflect = np.where(rank_cov_xy == m-1, np.linalg.det(U) * np.linalg.det(VT) < 0, np.linalg.det(cov_xy) < 0)
+	S = np.ones((N, m))
+	S[reflect, m-1] = -1
+
+	R = np.matmul(U, S[:, :, np.newaxis] * VT)
+	c = np.sum(D * S, axis=1) / sigma_sq_x
+	t = mu_y - c[:, np.newaxis, np.newaxis] * np.matmul(R, mu_x)
+
+	T = np.zeros((N, m+1, m+1))
+	T[:, 0:m, 0:m] = c[:, np.newaxis, np.newaxis] * R
+	T[:, 0:m, m] = t[:, :, 0]
+	T[:, m, m] = 1
+	return T
@@ -1,6 +1,9 @@
+import os
 import csv
 import re
+import hashlib
 import numpy as np
+from DataAugmentationUtils import Utils
 import seaborn as sns
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -9,36 +12,62 @@ from bokeh.document import Document
 from bokeh.embed import file_html
 from bokeh.layouts import gridplot
 from bokeh.models import (BasicTicker, Circle, ColumnDataSource, DataRange1d,
-                          Grid, LinearAxis, PanTool, Plot, WheelZoomTool,)
-from bokeh.resources import INLINE
+                          Grid, LinearAxis, LinearColorMapper, PanTool, Plot, WheelZoomTool,)
+from bokeh.models import Image as ImageGlyph
+from bokeh.palettes import Reds9
+from bokeh.resources import CDN, INLINE
 from bokeh.util.browser import view
 
-def splom(data_csv):
+'''
+Writes a scatterplot matrix of the PCA scores to filename
+- mode = 'scatter' to draw every point, or 'density' to draw the generated samples as a 2D histogram per pair
+  (the originals are still drawn as points), so the file size does not grow with the number of samples
+- max_points = if not 0, a random subset of at most max_points generated samples is drawn
+- bins = number of histogram bins per axis in density mode
+- resources = 'inline' to embed BokehJS in the file, or 'cdn' to load it from the web (much smaller file)
+- show = open the file in the default browser
+The file is only rendered again when the CSV, its sidecar or the options change, a .key file next to it records them.
+'''
+def splom(data_csv, mode='scatter', max_points=0, bins=50, resources='inline', show=True, seed=0, filename="augmentation_splom.html"):
+    if mode not in ['scatter', 'density']:
+        print("Error splom mode unrecognized.")
+        print("scatter and density currently supported.")
+        exit()
+    key_filename = os.path.splitext(filename)[0] + ".key"
+    key = get_cache_key(data_csv, [mode, max_points, bins, resources, seed])
+    if os.path.exists(filename) and os.path.exists(key_filename):
+        with open(key_filename) as f:
+            cached = f.read() == key
+        if cached:
+            print("Using cached %s" % filename)
+            if show:
+                view(filename)
+            return filename
+
     # read csv
-    colors = []
-    scores = []
-    with open(data_csv, newline='') as csvfile:
-        datareader = csv.reader(csvfile)
-        index = 0
-        for row in datareader:
-            if "Generated" in row[0]:
-                colors.append('red')
-            else:
-                colors.append('blue')
-            scores.append(row[2:])
-    scores = np.array(scores)
+    image_paths, particle_paths, scores = Utils.read_CSV(data_csv)
+    generated = np.array(["Generated" in image_path for image_path in image_paths], dtype=bool)
+    if max_points and np.sum(generated) > max_points:
+        rng = np.random.default_rng(seed)
+        keep = np.sort(rng.choice(np.flatnonzero(generated), max_points, replace=False))
+        rows = np.concatenate((np.flatnonzero(~generated), keep))
+        scores = scores[rows]
+        generated = generated[rows]
+    colors = np.where(generated, 'red', 'blue').tolist()
 
     # make splom
     plots = []
-    for y in range(len(scores[0])):
+    num_dim = scores.shape[1]
+    for y in range(num_dim):
         row = []
-        for x in range(len(scores[0])):
-            xax = (y == len(scores[0])-1)
+        for x in range(num_dim):
+            xax = (y == num_dim-1)
             yax = (x == 0)
-            xscores = [float(item) for item in list(scores[:,x])]
-            yscores = [float(item) for item in list(scores[:,y])]
-            source = ColumnDataSource(dict(x=xscores, y=yscores, colors=colors))
-            plot = make_plot(source, x, y, xax, yax)
+            if mode == 'density':
+                plot = make_density_plot(scores[generated,x], scores[generated,y], scores[~generated,x], scores[~generated,y], x, y, xax, yax, bins)
+            else:
+                source = ColumnDataSource(dict(x=scores[:,x].tolist(), y=scores[:,y].tolist(), colors=colors))
+                plot = make_plot(source, x, y, xax, yax)
             row.append(plot)
         plots.append(row)
 
@@ -48,12 +77,29 @@ def splom(data_csv):
     doc.add_root(grid)
 
     doc.validate()
-    filename = "augmentation_splom.html"
     with open(filename, "w") as f:
-        f.write(file_html(doc, INLINE, "Data SPLOM"))
+        f.write(file_html(doc, CDN if resources == 'cdn' else INLINE, "Data SPLOM"))
+    with open(key_filename, "w") as f:
+        f.write(key)
     print("Wrote %s" % filename)
-    view(filename)
+    if show:
+        view(filename)
+    return filename
 
+'''
+Returns a hash of the contents of the csv and its sidecar files, which Utils.read_CSV may read instead, and the rendering options
+'''
+def get_cache_key(data_csv, options):
+    sha = hashlib.sha256()
+    for path in [data_csv] + list(Utils.get_sidecar_paths(data_csv)):
+        if not os.path.exists(path):
+            sha.update(b'missing')
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    sha.update(repr(options).encode())
+    return sha.hexdigest()
 
 def make_plot(source, xindex, yindex, xax=False, yax=False):
     xdr = DataRange1d(bounds=None)
@@ -91,23 +137,33 @@ def make_plot(source, xindex, yindex, xax=False, yax=False):
     plot.add_tools(PanTool(), WheelZoomTool())
     return plot
 
+'''
+Draws the generated samples of a pair of PCA modes as a 2D histogram with the originals as points
+'''
+def make_density_plot(gen_x, gen_y, orig_x, orig_y, xindex, yindex, xax=False, yax=False, bins=50):
+    all_x = np.concatenate((gen_x, orig_x))
+    all_y = np.concatenate((gen_y, orig_y))
+    x_range = (float(np.min(all_x)), float(np.max(all_x)) + 1e-12)
+    y_range = (float(np.min(all_y)), float(np.max(all_y)) + 1e-12)
+    counts, _, _ = np.histogram2d(gen_x, gen_y, bins=bins, range=[x_range, y_range])
+    # image rows are y, empty bins are transparent
+    counts = np.where(counts > 0, np.log1p(counts), np.nan).T
+    source = ColumnDataSource(dict(x=orig_x.tolist(), y=orig_y.tolist(), colors=['blue']*len(orig_x)))
+    plot = make_plot(source, xindex, yindex, xax, yax)
+    mapper = LinearColorMapper(palette=Reds9[::-1], nan_color=(0, 0, 0, 0))
+    image = ImageGlyph(image='image', x=x_range[0], y=y_range[0], dw=x_range[1] - x_range[0], dh=y_range[1] - y_range[0], color_mapper=mapper)
+    r = plot.add_glyph(ColumnDataSource(dict(image=[counts])), image, level='underlay')
+    plot.x_range.renderers.append(r)
+    plot.y_range.renderers.append(r)
+    return plot
+
 def violin(data_csv):
     # Get data frame
-    types = []
-    dims = []
-    scores = []
-    with open(data_csv, newline='') as csvfile:
-        datareader = csv.reader(csvfile)
-        index = 0
-        for row in datareader:
-            current_type = "Original"
-            if "Generated" in row[0]:
-                current_type = "Generated"
-            for index in range(2, len(row)):
-                types.append(current_type)
-                dims.append(str(index-1))
-                scores.append(float(row[index]))
-    data = {'Data_Type':types, 'PCA_Mode':dims, "PCA_Score":scores}
+    image_paths, particle_paths, scores = Utils.read_CSV(data_csv)
+    num_samples, num_dim = scores.shape
+    types = np.repeat(["Generated" if "Generated" in image_path else "Original" for image_path in image_paths], num_dim)
+    dims = np.tile([str(index+1) for index in range(num_dim)], num_samples)
+    data = {'Data_Type':types, 'PCA_Mode':dims, "PCA_Score":scores.reshape(-1)}
     df = pd.DataFrame(data) 
     # Plot
     sns.set_style("whitegrid")
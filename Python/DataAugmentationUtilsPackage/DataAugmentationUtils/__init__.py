@@ -1,5 +1,6 @@
 from DataAugmentationUtils import DataAugmentation
 from DataAugmentationUtils import Visualize
+import numpy as np
 
 '''
 Runs data augmentation and takes the following arguements:
@@ -12,16 +13,37 @@ Runs data augmentation and takes the following arguements:
 - sampler_type = type of distribution to represent embedded data with for sampling
 - processes = number of processes to break image generation between for parallelization
 - world_point_list = list of paths to local.particle files (required if different from local)
+- pca_method = how PCA modes are computed: 'eigh' (all modes), 'randomized' (randomized SVD of the retained modes), or 'incremental'
+- pca_dtype = floating point type of the PCA computation, float32 uses half the memory of float64
+- resume = True to continue an interrupted run in out_dir after the last sample written to TotalData.csv
+- pca_batch_size = number of samples PCA processes at a time, the particles are then read into memory-mapped matrices in out_dir instead of memory (with pca_method 'incremental' PCA runs out-of-core)
 '''
-def runDataAugmentation(out_dir, img_list, local_point_list, num_samples=3, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, processes=1, world_point_list=None):
+def runDataAugmentation(out_dir, img_list, local_point_list, num_samples=3, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, processes=1, world_point_list=None, pca_method='eigh', pca_dtype=np.float64, resume=False, pca_batch_size=None):
     print("Running point based data augmentation.")
-    num_dim = DataAugmentation.point_based_aug(out_dir, img_list, local_point_list, num_samples, num_dim, percent_variability, sampler_type, mixture_num, processes, world_point_list)
+    num_dim = DataAugmentation.point_based_aug(out_dir, img_list, local_point_list, num_samples, num_dim, percent_variability, sampler_type, mixture_num, processes, world_point_list, pca_method, pca_dtype, resume, pca_batch_size)
     print("Done.")
     return num_dim
 
-def visualizeAugmentation(data_csv, viz_type='splom'):
+'''
+Returns a torch Dataset that generates augmented examples on demand instead of writing them to disk, takes the following arguments:
+- img_list, local_point_list, num_samples, num_dim, percent_variability, sampler_type, mixture_num, world_point_list = as in runDataAugmentation
+- seed = seeds the sampler so generated examples are reproducible
+- down_sample = True to downsample images to 3/4 of their size, or a scale factor
+Requires PyTorch.
+'''
+def getOnlineAugmentationDataset(img_list, local_point_list, num_samples=3, num_dim=0, percent_variability=0.95, sampler_type="KDE", mixture_num=0, world_point_list=None, seed=0, down_sample=False):
+    # imported here so the rest of the package does not require PyTorch
+    from DataAugmentationUtils import OnlineAugmentation
+    return OnlineAugmentation.OnlineAugmentationDataset(img_list, local_point_list, num_samples, num_dim, percent_variability, sampler_type, mixture_num, world_point_list, seed=seed, down_sample=down_sample)
+
+'''
+Visualizes the PCA scores of the original and generated data in data_csv, takes the following arguments:
+- viz_type = 'splom' for a scatterplot matrix or 'violin' for violin plots
+- mode, max_points, resources, show = splom options, see Visualize.splom
+'''
+def visualizeAugmentation(data_csv, viz_type='splom', mode='scatter', max_points=0, resources='inline', show=True):
     if viz_type == 'splom':
-        Visualize.splom(data_csv)
+        Visualize.splom(data_csv, mode, max_points, resources=resources, show=show)
     elif viz_type == 'violin':
         Visualize.violin(data_csv)
     else:
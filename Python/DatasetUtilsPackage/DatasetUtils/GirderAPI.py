@@ -1,17 +1,27 @@
 import requests 
 import json
+import hashlib
 
 from sys import stdout
-from math import ceil
 from datetime import datetime
 
 import os
 
+from DatasetUtils import ZipStream
+
 
 _ERROR_LOG_FILE = 'portal_error_log.txt'
 _MB_PER_CHUNK = 64
 _B_PER_MB = 1048576
 _CHUNK_SIZE = _MB_PER_CHUNK * _B_PER_MB # Download 128 MB at a time
+_DOWNLOAD_CHUNK_SIZE = _B_PER_MB # bytes written at a time while streaming a download
+_MAX_CONNECTIONS = 32
+
+## One session is shared by every request so connections to the server are kept alive and reused,
+#  including by the download and upload threads
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=_MAX_CONNECTIONS, pool_maxsize=_MAX_CONNECTIONS))
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=_MAX_CONNECTIONS, pool_maxsize=_MAX_CONNECTIONS))
 
 ## Utility function to write to the error log file
 def _writeToErrorLog(infoDict):
@@ -28,14 +38,15 @@ def _makeRequest(requestFunction, url, params, headers, actionMessage, data, pri
     else:
         response = requestFunction(url = url, params = params, headers = headers, stream = True) 
 
-    if response.status_code == 200:
+    # 206 is the response to a byte range request
+    if response.status_code in (200, 206):
         return response
 
     if printError:
         # Write debug info to file since return code was error
         print(response.status_code, 'ERROR while', actionMessage)
         _writeToErrorLog({
-                'function': 'POST' if requestFunction is requests.post else 'GET' if requestFunction is requests.get else 'OTHER',
+                'function': requestFunction.__name__.upper(),
                 'url': url, 
                 'params': params, 
                 'headers': headers, 
@@ -48,12 +59,12 @@ def _makeRequest(requestFunction, url, params, headers, actionMessage, data, pri
 
 ## Returns response or writes details to log file and raises ValueError
 def _makeGetRequest(url, params, headers, actionMessage, printError=True):
-    return _makeRequest(requestFunction = requests.get, url = url, params = params, headers = headers, actionMessage = actionMessage, data = None, printError = printError)
+    return _makeRequest(requestFunction = _session.get, url = url, params = params, headers = headers, actionMessage = actionMessage, data = None, printError = printError)
 
 
 ## Returns response or writes details to log file and raises ValueError
 def _makePostRequest(url, params, headers, actionMessage, data = None, printError=True):
-    return _makeRequest(requestFunction = requests.post, url = url, params = params, headers = headers, actionMessage = actionMessage, data = data, printError = printError)
+    return _makeRequest(requestFunction = _session.post, url = url, params = params, headers = headers, actionMessage = actionMessage, data = data, printError = printError)
 
 
 def getAccessToken(serverAddress, apiKey):
@@ -161,26 +172,114 @@ def listItemsInFolder(serverAddress, accessToken, folderId):
     return response.json()
     
 
+## Returns the list of files of an item, with their size and sha512 checksum when the server computed it
+def listFilesInItem(serverAddress, accessToken, itemId):
+    response = _makeGetRequest(
+        url = serverAddress + 'api/v1/item/' + itemId + '/files', 
+        params = {'limit': 0}, 
+        headers = {'Girder-Token': accessToken}, 
+        actionMessage = 'listing files in item %s' % itemId)
+    return response.json()
+
+
+## Returns the sha512 hex digest of a local file
+def fileChecksum(path):
+    sha = hashlib.sha512()
+    with open(path, 'rb') as filehandle:
+        for chunk in iter(lambda: filehandle.read(_DOWNLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+## Returns True if the local file matches the files of an item listed by listFilesInItem:
+#  same size and, if the server has it, the same sha512 checksum
+#  Items of several files are downloaded as a zip, which cannot be compared and is taken to match
+def _matchesItemFiles(filename, files):
+    if len(files) != 1:
+        return True
+    if os.path.getsize(filename) != files[0].get('size'):
+        return False
+    if 'sha512' not in files[0]:
+        return True
+    return files[0]['sha512'] == fileChecksum(filename)
+
+
+## Returns True if path already holds the item: same size and, if the server has it, the same sha512 checksum
+def isItemDownloaded(serverAddress, accessToken, path, item, files = None):
+    filename = path + '/' + item['name']
+    if not os.path.isfile(filename) or os.path.getsize(filename) != item.get('size'):
+        return False
+    if files is None:
+        files = listFilesInItem(serverAddress, accessToken, item['_id'])
+    if len(files) != 1:
+        return False
+    return _matchesItemFiles(filename, files)
+
+
 ## Downloads a file to path/
-def downloadItem(serverAddress, accessToken, path, item):
+#  The file is streamed to path/name.part which is renamed when complete and verified against the size and
+#  checksum on the server. With resume, an existing .part file is continued with a byte range request, and if
+#  the result does not match, e.g. because the file changed on the server, it is downloaded again from the start.
+#  With skipExisting, files that already match are not downloaded.
+#  Returns True if the item was downloaded, False if it was skipped
+def downloadItem(serverAddress, accessToken, path, item, resume=True, skipExisting=True, printProgress=True):
+    filename = path + '/' + item['name']
+    files = listFilesInItem(serverAddress, accessToken, item['_id'])
+    if skipExisting and isItemDownloaded(serverAddress, accessToken, path, item, files):
+        if printProgress:
+            print('Skip downloading %s' % filename)
+        return False
+    partFilename = filename + '.part'
+    offset = os.path.getsize(partFilename) if resume and os.path.exists(partFilename) else 0
+    size = files[0].get('size') if len(files) == 1 else None
+    if size is not None and offset > size:
+        # the .part file is not a prefix of this file
+        offset = 0
+    # a .part file of the full size only misses the rename, requesting the range past its end would fail
+    if offset == 0 or offset != size:
+        offset = _downloadItemPart(serverAddress, accessToken, item, filename, offset, printProgress)
+    if not _matchesItemFiles(partFilename, files):
+        if offset == 0:
+            os.remove(partFilename)
+            raise ValueError('Downloaded %s does not match the file on the server' % filename)
+        # the resumed .part file was from a different version of the file
+        _downloadItemPart(serverAddress, accessToken, item, filename, 0, printProgress)
+        if not _matchesItemFiles(partFilename, files):
+            os.remove(partFilename)
+            raise ValueError('Downloaded %s does not match the file on the server' % filename)
+    os.replace(partFilename, filename)
+    return True
+
+
+## Streams an item to filename.part, continuing from offset with a byte range request if it is not 0
+#  Returns the offset the download actually started at, 0 if the server sent the whole file
+def _downloadItemPart(serverAddress, accessToken, item, filename, offset, printProgress):
+    partFilename = filename + '.part'
+    headers = {'Girder-Token': accessToken}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
     response = _makeGetRequest(
         url = serverAddress + 'api/v1/item/' + item['_id'] + '/download', 
         params = None,
-        headers = {'Girder-Token': accessToken},
+        headers = headers,
         actionMessage = 'downloading item %s' % item['name']
     )
-    filename = path + '/' + item['name']
-    fileSize = int(response.headers['Content-Length'])
-    bytesDownloaded = 0
+    if response.status_code != 206:
+        # the server sent the whole file
+        offset = 0
+    bytesDownloaded = offset
 
-    with open(filename, "wb") as filehandle:
-        for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+    with open(partFilename, "ab" if offset > 0 else "wb") as filehandle:
+        for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
             if not chunk:  # filter out keep-alive new chunks
                 continue
             filehandle.write(chunk)
             bytesDownloaded += len(chunk)
-            _printProgress(filename, bytesDownloaded)
-        stdout.write('\n')
+            if printProgress:
+                _printProgress(filename, bytesDownloaded)
+        if printProgress:
+            stdout.write('\n')
+    return offset
 
 
 ## Downloads a folder to path/ as a .zip
@@ -195,7 +294,7 @@ def downloadFolder(serverAddress, accessToken, path, folderInfo):
     bytesDownloaded = 0
 
     with open(filename, "wb") as filehandle:
-        for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+        for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
             if not chunk:  # filter out keep-alive new chunks
                 continue
             filehandle.write(chunk)
@@ -204,6 +303,33 @@ def downloadFolder(serverAddress, accessToken, path, folderInfo):
         stdout.write('\n')
 
 
+## Downloads a folder as a .zip and extracts it to path/ while it downloads, without storing the zip
+#  members selects the files to extract (see ZipStream.extractZipStream)
+#  Returns the paths of the extracted files
+def downloadFolderUnzipped(serverAddress, accessToken, path, folderInfo, members = None):
+    response = _makeGetRequest(
+        url = serverAddress + 'api/v1/folder/' + folderInfo['_id'] + '/download', 
+        params = None,
+        headers = {'Girder-Token': accessToken},
+        actionMessage = 'downloading folder %s' % folderInfo['name']
+    )
+    filename = path + '/' + folderInfo['name'] + '.zip'
+    bytesDownloaded = [0]
+
+    def chunks():
+        for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+            bytesDownloaded[0] += len(chunk)
+            _printProgress(filename, bytesDownloaded[0])
+            yield chunk
+
+    try:
+        return ZipStream.extractZipStream(chunks(), path, members)
+    finally:
+        # with a list of members the download stops once they are extracted
+        response.close()
+        stdout.write('\n')
+
+
 def _printProgress(fileName, progressBytes, totalBytes = None):
     divider = 1024 if progressBytes < _B_PER_MB else _B_PER_MB
     unit = 'KB' if progressBytes < _B_PER_MB else 'MB'
@@ -214,6 +340,7 @@ def _printProgress(fileName, progressBytes, totalBytes = None):
         stdout.write('\r%s [%d/%d %s]' % (fileName, progressBytes/divider, totalBytes/divider, unit))
 
 
+## Returns the json of the created folder
 def createFolder(serverAddress, accessToken, parentId, name, parentType='folder'):
     actionMessage = 'creating folder %s' % name
     response = _makePostRequest(
@@ -222,38 +349,72 @@ def createFolder(serverAddress, accessToken, parentId, name, parentType='folder'
         headers = {'Girder-Token': accessToken},
         actionMessage = actionMessage
     )
+    return response.json()
 
 
-def uploadFile(serverAddress, accessToken, parentId, name, path, parentType='folder'):
-    filesize = os.stat(path).st_size
-
-    # Create an upload-in-progress
-    response = _makePostRequest(
-        url = serverAddress + 'api/v1/file', 
-        params = {'parentId': parentId, 'name': name, 'parentType': parentType, 'size': filesize, 'mimeType': 'application/octet-stream'},
+## Returns the number of bytes the server has received for an upload-in-progress
+def getUploadOffset(serverAddress, accessToken, uploadId):
+    response = _makeGetRequest(
+        url = serverAddress + 'api/v1/file/offset', 
+        params = {'uploadId': uploadId},
         headers = {'Girder-Token': accessToken},
-        actionMessage = 'Creating upload-in-progress for %s' % name
+        actionMessage = 'getting offset of upload %s' % uploadId,
+        printError = False
     )
-    uploadid = response.json()['_id']
-    offset = 0
-    chunkIndex = 0
+    return response.json()['offset']
+
+
+## Uploads the file at path as name in the parent, one chunk of _CHUNK_SIZE at a time
+#  Chunks of an upload must reach the server in order, so they are sent one after the other.
+#  If uploadId is an upload-in-progress of this file, it is continued from the offset the server has,
+#  otherwise a new upload is created and onUploadCreated(uploadId) is called so it can be resumed later.
+#  Returns the json of the uploaded file
+def uploadFile(serverAddress, accessToken, parentId, name, path, parentType='folder', uploadId=None, onUploadCreated=None, printProgress=True):
+    filesize = os.stat(path).st_size
+    offset = None
+    if uploadId is not None:
+        try:
+            offset = getUploadOffset(serverAddress, accessToken, uploadId)
+        except ValueError:
+            # the upload expired or was finished
+            offset = None
+
+    if offset is None:
+        # Create an upload-in-progress
+        response = _makePostRequest(
+            url = serverAddress + 'api/v1/file', 
+            params = {'parentId': parentId, 'name': name, 'parentType': parentType, 'size': filesize, 'mimeType': 'application/octet-stream'},
+            headers = {'Girder-Token': accessToken},
+            actionMessage = 'Creating upload-in-progress for %s' % name
+        )
+        if filesize == 0:
+            # empty files are created without chunks
+            return response.json()
+        uploadId = response.json()['_id']
+        if onUploadCreated is not None:
+            onUploadCreated(uploadId)
+        offset = 0
+    chunkIndex = offset // _CHUNK_SIZE
+    fileInfo = None
 
     with open(path, 'rb') as filehandle:
-        stdout.write('\r%s [%d/%d MB]' % (path, chunkIndex*_MB_PER_CHUNK, ceil(filesize / _CHUNK_SIZE * _MB_PER_CHUNK)))
-        # TODO clean up this while loop
-        while(True):
+        filehandle.seek(offset)
+        if printProgress:
+            _printProgress(path, offset, filesize)
+        while offset < filesize:
             chunk = filehandle.read(_CHUNK_SIZE)
-            if chunk:
-                response = _makePostRequest(
-                        url = serverAddress + 'api/v1/file/chunk', 
-                        params = {'uploadId': uploadid, 'offset': offset},
-                        headers = {'Girder-Token': accessToken},
-                        actionMessage = 'Uploading chunk %d for %s' % (chunkIndex, name),
-                        data = chunk
-                    )
-                offset += len(chunk)
-                chunkIndex += 1
+            response = _makePostRequest(
+                    url = serverAddress + 'api/v1/file/chunk', 
+                    params = {'uploadId': uploadId, 'offset': offset},
+                    headers = {'Girder-Token': accessToken},
+                    actionMessage = 'Uploading chunk %d for %s' % (chunkIndex, name),
+                    data = chunk
+                )
+            fileInfo = response.json()
+            offset += len(chunk)
+            chunkIndex += 1
+            if printProgress:
                 _printProgress(path, offset, filesize)
-            else:
-                break
-        stdout.write('\n')
+        if printProgress:
+            stdout.write('\n')
+    return fileInfo
@@ -3,6 +3,9 @@ import json
 import os
 import getpass
 import base64
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from DatasetUtils import GirderAPI
 
@@ -11,6 +14,14 @@ _LOGIN_FILE_NAME = 'shapeworksPortalLogin.txt'
 _CONTACT_SUPPORT_STRING = 'Please contact support: shapeworks-dev-support@sci.utah.edu'
 _VERSION = 'v2'
 _USE_CASE_DATA_COLLECTION = 'use-case-data-%s' % _VERSION
+_DOWNLOAD_CONCURRENCY = 8
+_UPLOAD_CONCURRENCY = 4
+_UPLOAD_MANIFEST_FILE = 'shapeworksPortalUploads.json'
+_UPLOAD_MANIFEST_SAVE_INTERVAL = 5 # seconds between saves of the upload manifest while uploading
+_LISTING_CACHE_FILE = 'shapeworksPortalCache.json'
+_LISTING_CACHE_TTL = 3600 # seconds a cached listing is used without asking the server
+_LISTING_CACHE_MAX_AGE = 86400 # seconds after which a cached dataset listing is always listed again
+_listingCacheLock = threading.Lock()
 
 serverAddress = 'http://cibc1.sci.utah.edu:8080/'
 
@@ -106,21 +117,170 @@ def _verifyLoginState(loginState):
     return 'key' in loginState and 'username' in loginState
 
 
-def _downloadFolder(accessToken, path, folder, parsedFileList = None):
+## Loads the listing cache, a dictionary of {key: {'time': seconds since epoch, 'value': ...}}
+def _loadListingCache():
+    if not os.path.exists(_LISTING_CACHE_FILE):
+        return {}
+    try:
+        with open(_LISTING_CACHE_FILE) as json_file:
+            return json.load(json_file)
+    except ValueError:
+        return {}
+
+
+## Returns the cached value of key and whether it is younger than the TTL, or (None, False)
+def _getCachedListing(key):
+    with _listingCacheLock:
+        entry = _loadListingCache().get(serverAddress + _USE_CASE_DATA_COLLECTION + '/' + key)
+    if entry is None:
+        return None, False
+    return entry['value'], time.time() - entry['time'] < _LISTING_CACHE_TTL
+
+
+def _setCachedListing(key, value):
+    with _listingCacheLock:
+        cache = _loadListingCache()
+        fullKey = serverAddress + _USE_CASE_DATA_COLLECTION + '/' + key
+        if value is None:
+            cache.pop(fullKey, None)
+        else:
+            cache[fullKey] = {'time': time.time(), 'value': value}
+        tmpFile = _LISTING_CACHE_FILE + '.tmp'
+        with open(tmpFile, 'w') as outfile:
+            json.dump(cache, outfile)
+        os.replace(tmpFile, _LISTING_CACHE_FILE)
+
+
+## Removes every cached listing
+def clearListingCache():
+    with _listingCacheLock:
+        if os.path.exists(_LISTING_CACHE_FILE):
+            os.remove(_LISTING_CACHE_FILE)
+
+
+def _getUseCaseCollection(accessToken):
+    collection, fresh = _getCachedListing('collection')
+    if not fresh:
+        collection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
+        _setCachedListing('collection', collection)
+    return collection
+
+
+## Returns the dataset folders of the use case collection
+def _getDatasetFolders(accessToken, refresh = False):
+    folders, fresh = _getCachedListing('datasets')
+    if refresh or not fresh:
+        useCaseCollection = _getUseCaseCollection(accessToken)
+        folders = GirderAPI.getFolderList(serverAddress, accessToken, 'collection', useCaseCollection['_id'])
+        _setCachedListing('datasets', folders)
+    return folders
+
+
+def _getDatasetFolder(accessToken, datasetName, refresh = False):
+    folders = [folder for folder in _getDatasetFolders(accessToken, refresh) if folder['name'] == datasetName]
+    if len(folders) == 0 and not refresh:
+        # the cached list may predate the dataset
+        return _getDatasetFolder(accessToken, datasetName, True)
+    actionMessage = 'finding folder: %s' % datasetName
+    if len(folders) == 0:
+        raise ValueError('ERROR %s. Found 0 folders' % actionMessage)
+    if len(folders) > 1:
+        print('WARNING', actionMessage)
+        print('Found %d folders.' % len(folders))
+        print('Using folder with id = %s' % folders[0]['_id'])
+    return folders[0]
+
+
+## Lists folder and all of its subfolders, one level at a time with the requests of a level made concurrently
+#  Returns {'folders': [[path parts, folder], ...], 'items': [[path parts of the folder, item], ...]}
+def _walkFolder(accessToken, folder):
+    tree = {'folders': [], 'items': []}
+    level = [([], folder)]
+    pool = ThreadPool(_DOWNLOAD_CONCURRENCY)
+    try:
+        while len(level) > 0:
+            def listFolder(entry):
+                parts, levelFolder = entry
+                items = GirderAPI.listItemsInFolder(serverAddress, accessToken, levelFolder['_id'])
+                subfolders = GirderAPI.getFolderList(serverAddress, accessToken, parentType='folder', parentId=levelFolder['_id'])
+                return items, subfolders
+            nextLevel = []
+            for (parts, levelFolder), (items, subfolders) in zip(level, pool.map(listFolder, level, chunksize=1)):
+                tree['items'] += [[parts, item] for item in items]
+                for subfolder in subfolders:
+                    tree['folders'].append([parts + [subfolder['name']], subfolder])
+                    nextLevel.append((parts + [subfolder['name']], subfolder))
+            level = nextLevel
+    finally:
+        pool.close()
+        pool.join()
+    return tree
+
+
+## Returns the dataset folder and the listing of every folder and item in it (see _walkFolder)
+#  A cached listing younger than the TTL is used as is. An older one is used if the dataset folder has the
+#  same updated time and size as when it was listed, which costs one or two requests, otherwise the dataset
+#  is listed again. Girder only changes the updated time of a folder when the folder itself is edited, but
+#  it adds the size of new files to every parent folder. Listings older than the maximum age are always
+#  listed again, since replacing a file with one of the same size changes neither.
+def _getDatasetTree(accessToken, datasetName, refresh = False):
+    cached, fresh = _getCachedListing('tree/' + datasetName)
+    if cached is not None and fresh and not refresh:
+        return cached['folder'], cached['tree']
+    datasetFolder = _getDatasetFolder(accessToken, datasetName, refresh = cached is not None or refresh)
+    unchanged = (cached is not None and not refresh
+                 and time.time() - cached.get('listed', 0) < _LISTING_CACHE_MAX_AGE
+                 and cached['folder'].get('updated') == datasetFolder.get('updated')
+                 and cached['folder'].get('size') == datasetFolder.get('size'))
+    if unchanged:
+        tree = cached['tree']
+        listed = cached['listed']
+    else:
+        tree = _walkFolder(accessToken, datasetFolder)
+        listed = time.time()
+    _setCachedListing('tree/' + datasetName, {'folder': datasetFolder, 'tree': tree, 'listed': listed})
+    return datasetFolder, tree
+
+
+## Returns the files of parsedFileList (paths split into parts) that are not in the dataset tree
+def _missingFiles(tree, parsedFileList):
+    found = set(tuple(parts) + (item['name'],) for parts, item in tree['items'])
+    return ['/'.join(parts) for parts in parsedFileList if tuple(parts) not in found]
+
+
+## Downloads the items of the dataset tree (see _getDatasetTree) to path with concurrency parallel downloads
+#  parsedFileList is a list of file paths split into parts, only those files are downloaded if it is given
+def _downloadFolder(accessToken, path, tree, parsedFileList = None, concurrency = _DOWNLOAD_CONCURRENCY):
     if not os.path.exists(path):
         os.makedirs(path)
-    # 1 download items in this folder
-    items = GirderAPI.listItemsInFolder(serverAddress, accessToken, folder['_id'])
-    for item in items:
-        subset = None if not parsedFileList else [elem for elem in parsedFileList if len(elem) == 1 and elem[0] == item['name']]
-        if subset is None or len(subset) > 0:
-            GirderAPI.downloadItem(serverAddress, accessToken, path, item)
-        
-    # 2 for each subfolder, create directory in the file system and download every item in the subfolder
-    for subfolder in GirderAPI.getFolderList(serverAddress, accessToken, parentType='folder', parentId=folder['_id']):
-        subset = None if not parsedFileList else [elem[1:] for elem in parsedFileList if len(elem) > 1 and elem[0] == subfolder['name']]
-        if subset is None or len(subset) > 0:
-            _downloadFolder(accessToken, path + '/' + subfolder['name'], subfolder, subset)
+    if parsedFileList:
+        wanted = set(tuple(parts) for parts in parsedFileList)
+        downloads = [(path + ''.join('/' + part for part in parts), item) for parts, item in tree['items'] if tuple(parts + [item['name']]) in wanted]
+    else:
+        downloads = [(path + ''.join('/' + part for part in parts), item) for parts, item in tree['items']]
+        for parts, folder in tree['folders']:
+            folderPath = path + ''.join('/' + part for part in parts)
+            if not os.path.exists(folderPath):
+                os.makedirs(folderPath)
+    for itemPath in set(itemPath for itemPath, item in downloads):
+        if not os.path.exists(itemPath):
+            os.makedirs(itemPath)
+    lock = threading.Lock()
+    completed = [0]
+
+    def download(task):
+        itemPath, item = task
+        downloaded = GirderAPI.downloadItem(serverAddress, accessToken, itemPath, item, printProgress=False)
+        with lock:
+            completed[0] += 1
+            print('[%d/%d] %s %s' % (completed[0], len(downloads), 'Downloaded' if downloaded else 'Skipped', itemPath + '/' + item['name']))
+
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        pool.map(download, downloads, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _splitPathIntoParts(path):
@@ -139,83 +299,211 @@ def _splitPathIntoParts(path):
     return allparts
 
 
-def downloadDataset(accessToken, datasetName, destinationPath, fileList = None):
-    # 1 get info of the use case collection
-    useCaseCollection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
-    # 2 get info of the dataset folder in that collection
-    datasetFolder = GirderAPI.getFolderInfo(serverAddress, accessToken, parentType='collection', parentId=useCaseCollection['_id'], folderName=datasetName)
-    # 3 download every item in the base dataset folder
-    if fileList:
-        _downloadFolder(accessToken, destinationPath, datasetFolder, [_splitPathIntoParts(path) for path in fileList])
-    else:
-        _downloadFolder(accessToken, destinationPath, datasetFolder)
+def downloadDataset(accessToken, datasetName, destinationPath, fileList = None, concurrency = _DOWNLOAD_CONCURRENCY):
+    # 1 get the listing of the dataset folder in the use case collection
+    datasetFolder, tree = _getDatasetTree(accessToken, datasetName)
+    # 2 download every item in the dataset folder
+    try:
+        if fileList:
+            parsedFileList = [_splitPathIntoParts(path) for path in fileList]
+            if len(_missingFiles(tree, parsedFileList)) > 0:
+                # the cached listing may predate the files
+                datasetFolder, tree = _getDatasetTree(accessToken, datasetName, refresh = True)
+                missing = _missingFiles(tree, parsedFileList)
+                if len(missing) > 0:
+                    print('WARNING %d files are not in the %s dataset: %s' % (len(missing), datasetName, ', '.join(missing)))
+            _downloadFolder(accessToken, destinationPath, tree, parsedFileList, concurrency)
+        else:
+            _downloadFolder(accessToken, destinationPath, tree, concurrency=concurrency)
+    except Exception:
+        # the cached listing may be out of date, list the dataset again next time
+        _setCachedListing('tree/' + datasetName, None)
+        raise
 
 
 def downloadDatasetZip(accessToken, datasetName, destinationPath):
-    # 1 get info of the use case collection
-    useCaseCollection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
-    # 2 get info of the dataset folder in that collection
-    datasetFolder = GirderAPI.getFolderInfo(serverAddress, accessToken, parentType='collection', parentId=useCaseCollection['_id'], folderName=datasetName)
-    # 3 download the dataset folder
+    # 1 get info of the dataset folder in the use case collection
+    datasetFolder = _getDatasetFolder(accessToken, datasetName)
+    # 2 download the dataset folder
     GirderAPI.downloadFolder(serverAddress, accessToken, path=destinationPath, folderInfo=datasetFolder)
 
 
-def _uploadFolder(accessToken, folderName, folderPath, parentId, parentType, existingFileList = []):
-    try:
-        folderInfo = GirderAPI.getFolderInfo(serverAddress, accessToken, parentType=parentType, parentId=parentId, folderName=folderName)
-        print('Skip creating folder ' + folderPath)
-    except:
-        GirderAPI.createFolder(serverAddress, accessToken, parentId, folderName, parentType=parentType)
-
-    folderInfo = GirderAPI.getFolderInfo(serverAddress, accessToken, parentType=parentType, parentId=parentId, folderName=folderName)
-    for item in os.listdir(folderPath):
-        # must use / here to match girder file paths
-        itempath = os.path.join(folderPath, item)
-        if os.path.isfile(itempath):
-            if itempath in existingFileList:
-                print('Skip uploading ' + itempath)
-            else:
-                GirderAPI.uploadFile(serverAddress, accessToken, folderInfo['_id'], item, itempath, parentType='folder')
-        else:
-            _uploadFolder(accessToken, item, itempath, folderInfo['_id'], 'folder', existingFileList)
+## Downloads the dataset as a zip and extracts it to destinationPath/datasetName while it downloads
+#  fileList is a list of file paths in the dataset, or a function that is given each path and returns
+#  whether to extract it. Every file is extracted if it is None.
+def downloadDatasetUnzipped(accessToken, datasetName, destinationPath, fileList = None):
+    # 1 get info of the dataset folder in the use case collection
+    datasetFolder = _getDatasetFolder(accessToken, datasetName)
+    # 2 stream the dataset folder, the names in the zip start with the folder name
+    prefix = datasetFolder['name'] + '/'
+    if fileList is None:
+        members = None
+    elif callable(fileList):
+        members = lambda name: name.startswith(prefix) and fileList(name[len(prefix):])
+    else:
+        members = [prefix + '/'.join(_splitPathIntoParts(path)) for path in fileList]
+    return GirderAPI.downloadFolderUnzipped(serverAddress, accessToken, path=destinationPath, folderInfo=datasetFolder, members=members)
 
 
-## Uploads dataset to the data portal without overwriting anything.
-## To replace files, delete them on the data portal before uploading.
-def uploadDataset(accessToken, datasetName, datasetPath):
-    useCaseCollection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
-    if useCaseCollection is None:
-        return False
-    
-    existingFileList = []
-    if datasetName in getDatasetList(accessToken):
-        # Get list of existing files to avoid overriding
-        existingFileList = [os.path.join(datasetPath, f) for f in getFileList(accessToken, datasetName)]
-    return _uploadFolder(accessToken, datasetName, datasetPath, useCaseCollection['_id'], parentType='collection', existingFileList=existingFileList)
+## Returns the key of the upload of datasetPath as datasetName in the upload manifest
+def _uploadManifestKey(datasetName, datasetPath):
+    return serverAddress + _USE_CASE_DATA_COLLECTION + '/' + datasetName + ':' + os.path.abspath(datasetPath)
 
 
-def getDatasetList(accessToken):
-    useCaseCollection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
-    jsonList = GirderAPI.getFolderList(serverAddress, accessToken, 'collection', useCaseCollection['_id'])
-    return [element['name'] for element in jsonList]
+def _loadUploadManifests():
+    if not os.path.exists(_UPLOAD_MANIFEST_FILE):
+        return {}
+    try:
+        with open(_UPLOAD_MANIFEST_FILE) as json_file:
+            return json.load(json_file)
+    except ValueError:
+        return {}
 
 
-def getFileList(accessToken, datasetName):
-    useCaseCollection = GirderAPI.getCollectionInfo(serverAddress, accessToken, _USE_CASE_DATA_COLLECTION)
-    datasetFolder = GirderAPI.getFolderInfo(serverAddress, accessToken, parentType='collection', parentId=useCaseCollection['_id'], folderName=datasetName)
+## Returns the manifest of an upload: {file path in the dataset: {'size', 'mtime', 'sha512', 'uploadId', 'uploaded'}}
+def _loadUploadManifest(key):
+    return _loadUploadManifests().get(key, {})
 
-    # Add items and folders of base directory
-    items = GirderAPI.listItemsInFolder(serverAddress, accessToken, datasetFolder['_id'])
-    subfolders = [(sf, '') for sf in GirderAPI.getFolderList(serverAddress, accessToken, parentType='folder', parentId=datasetFolder['_id'])]
-    itemPaths = [element['name'] for element in items]
 
-    # Iterate through subfolders to get all the items
-    while len(subfolders) > 0:
-        subfolder = subfolders.pop(0)
-        path = subfolder[1] + subfolder[0]['name'] + os.path.sep
-        items = GirderAPI.listItemsInFolder(serverAddress, accessToken, subfolder[0]['_id'])
-        itemPaths += [path + element['name'] for element in items]
-        subfolders = [(sf, path) for sf in GirderAPI.getFolderList(serverAddress, accessToken, parentType='folder', parentId=subfolder[0]['_id'])] + subfolders
+## Saves the manifest of an upload, or removes it if manifest is None
+def _saveUploadManifest(key, manifest):
+    manifests = _loadUploadManifests()
+    if manifest is None:
+        manifests.pop(key, None)
+    else:
+        manifests[key] = manifest
+    tmpFile = _UPLOAD_MANIFEST_FILE + '.tmp'
+    with open(tmpFile, 'w') as outfile:
+        json.dump(manifests, outfile)
+    os.replace(tmpFile, _UPLOAD_MANIFEST_FILE)
 
-    return itemPaths
 
+## Uploads dataset to the data portal without overwriting anything.
+## To replace files, delete them on the data portal before uploading.
+#  Files that are already on the data portal with the same sha512 checksum are skipped, and files that
+#  differ or have no checksum on the data portal to compare with are reported and left as they are.
+#  concurrency files are uploaded at the same time. Progress is recorded in the upload manifest, saved every
+#  few seconds and when the upload stops, so an interrupted upload continues where it stopped when it is run again.
+def uploadDataset(accessToken, datasetName, datasetPath, concurrency = _UPLOAD_CONCURRENCY):
+    useCaseCollection = _getUseCaseCollection(accessToken)
+    if useCaseCollection is None:
+        return False
+
+    # 1 get the folders and items already on the data portal
+    folderIds = {}
+    existingItems = {}
+    if datasetName in getDatasetList(accessToken, refresh = True):
+        datasetFolder, tree = _getDatasetTree(accessToken, datasetName, refresh = True)
+        print('Skip creating folder ' + datasetPath)
+        folderIds[()] = datasetFolder['_id']
+        for parts, folder in tree['folders']:
+            folderIds[tuple(parts)] = folder['_id']
+        for parts, item in tree['items']:
+            existingItems[tuple(parts) + (item['name'],)] = item
+    else:
+        folderIds[()] = GirderAPI.createFolder(serverAddress, accessToken, useCaseCollection['_id'], datasetName, parentType='collection')['_id']
+
+    # 2 create the missing folders, parents before their subfolders
+    files = []
+    for dirPath, dirNames, fileNames in os.walk(datasetPath):
+        dirNames.sort()
+        relativePath = os.path.relpath(dirPath, datasetPath)
+        parts = () if relativePath == '.' else tuple(relativePath.split(os.path.sep))
+        if parts not in folderIds:
+            folderIds[parts] = GirderAPI.createFolder(serverAddress, accessToken, folderIds[parts[:-1]], parts[-1])['_id']
+        files += [(parts, fileName, os.path.join(dirPath, fileName)) for fileName in sorted(fileNames)]
+
+    # 3 upload the files
+    manifestKey = _uploadManifestKey(datasetName, datasetPath)
+    manifest = _loadUploadManifest(manifestKey)
+    lock = threading.Lock()
+    saveLock = threading.Lock()
+    completed = [0]
+    dirty = [False]
+    lastSave = [time.time()]
+
+    ## Saves the manifest if it changed, at most every _UPLOAD_MANIFEST_SAVE_INTERVAL seconds unless force is True
+    #  The file is written without holding lock, and a save that is already running is not waited for.
+    def saveManifest(force = False):
+        if not saveLock.acquire(blocking = force):
+            return
+        try:
+            with lock:
+                if not dirty[0] or (not force and time.time() - lastSave[0] < _UPLOAD_MANIFEST_SAVE_INTERVAL):
+                    return
+                snapshot = dict(manifest)
+                dirty[0] = False
+                lastSave[0] = time.time()
+            _saveUploadManifest(manifestKey, snapshot)
+        finally:
+            saveLock.release()
+
+    def saveEntry(filePath, entry):
+        with lock:
+            manifest[filePath] = dict(entry)
+            dirty[0] = True
+        saveManifest()
+
+    def upload(task):
+        parts, fileName, path = task
+        filePath = '/'.join(parts + (fileName,))
+        stat = os.stat(path)
+        with lock:
+            entry = dict(manifest.get(filePath, {}))
+        if entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime:
+            # the file changed since it was recorded
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        item = existingItems.get(parts + (fileName,))
+        if item is not None:
+            if entry.get('uploaded'):
+                result = 'Skipped'
+            else:
+                if 'sha512' not in entry:
+                    entry['sha512'] = GirderAPI.fileChecksum(path)
+                serverFiles = GirderAPI.listFilesInItem(serverAddress, accessToken, item['_id'])
+                if len(serverFiles) != 1 or serverFiles[0].get('size') != stat.st_size:
+                    result = 'Not replacing (differs from the data portal)'
+                elif 'sha512' not in serverFiles[0]:
+                    result = 'Not replacing (cannot verify, the data portal has no checksum)'
+                elif serverFiles[0]['sha512'] != entry['sha512']:
+                    result = 'Not replacing (differs from the data portal)'
+                else:
+                    entry['uploaded'] = True
+                    saveEntry(filePath, entry)
+                    result = 'Skipped'
+        else:
+            def onUploadCreated(uploadId):
+                entry['uploadId'] = uploadId
+                saveEntry(filePath, entry)
+            GirderAPI.uploadFile(serverAddress, accessToken, folderIds[parts], fileName, path, parentType='folder',
+                                 uploadId=entry.get('uploadId'), onUploadCreated=onUploadCreated, printProgress=False)
+            entry.pop('uploadId', None)
+            entry['uploaded'] = True
+            saveEntry(filePath, entry)
+            result = 'Uploaded'
+        with lock:
+            completed[0] += 1
+            print('[%d/%d] %s %s' % (completed[0], len(files), result, path))
+
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        pool.map(upload, files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        saveManifest(force = True)
+        # the cached listings no longer match the portal
+        _setCachedListing('datasets', None)
+        _setCachedListing('tree/' + datasetName, None)
+    # the upload is complete, nothing is left to resume
+    _saveUploadManifest(manifestKey, None)
+    return True
+
+
+def getDatasetList(accessToken, refresh = False):
+    return [element['name'] for element in _getDatasetFolders(accessToken, refresh)]
+
+
+def getFileList(accessToken, datasetName, refresh = False):
+    datasetFolder, tree = _getDatasetTree(accessToken, datasetName, refresh)
+    return [''.join(part + os.path.sep for part in parts) + item['name'] for parts, item in tree['items']]
@@ -0,0 +1,247 @@
+import os
+import struct
+import zlib
+
+_LOCAL_FILE_HEADER = b'PK\x03\x04'
+_DATA_DESCRIPTOR = b'PK\x07\x08'
+_CENTRAL_DIRECTORY = (b'PK\x01\x02', b'PK\x05\x05', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07')
+_NEXT_RECORDS = (_LOCAL_FILE_HEADER,) + _CENTRAL_DIRECTORY
+_STORED = 0
+_DEFLATED = 8
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_ZIP64_EXTRA_ID = 0x0001
+_READ_SIZE = 1048576 # bytes processed at a time
+_MAX_DESCRIPTOR_SIZE = 24 # signature, crc and zip64 sizes
+
+
+## Reads a stream of byte chunks, such as the content of an http response, as it arrives
+class _ChunkReader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def _fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += chunk
+                return True
+        return False
+
+    ## Returns exactly size bytes, raises ValueError if the stream ends first
+    def read(self, size):
+        while len(self.buffer) < size:
+            if not self._fill():
+                raise ValueError('Unexpected end of zip stream')
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    ## Returns between 1 and limit bytes, or b'' at the end of the stream
+    def readSome(self, limit = _READ_SIZE):
+        if not self.buffer and not self._fill():
+            return b''
+        data, self.buffer = self.buffer[:limit], self.buffer[limit:]
+        return data
+
+    ## Puts data back at the front of the stream
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+## Returns where the member name is extracted in destinationPath, refusing names that would escape it
+def _memberPath(destinationPath, name):
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if name.startswith('/') or '..' in parts or (len(parts) > 0 and ':' in parts[0]):
+        raise ValueError('Refusing to extract %s outside of %s' % (name, destinationPath))
+    return os.path.join(destinationPath, *parts)
+
+
+## Returns the sizes stored in the zip64 extra field of a local file header
+def _zip64Sizes(extra, compressedSize, size):
+    offset = 0
+    while offset + 4 <= len(extra):
+        headerId, dataSize = struct.unpack('<HH', extra[offset:offset + 4])
+        if headerId == _ZIP64_EXTRA_ID:
+            # a local header has both sizes in the extra field, uncompressed first
+            if dataSize >= 16:
+                size, compressedSize = struct.unpack('<QQ', extra[offset + 4:offset + 20])
+            break
+        offset += 4 + dataSize
+    return compressedSize, size
+
+
+## Writes data to out, if there is an out, and returns the crc-32 including it
+def _write(out, data, crc):
+    if out is None:
+        return crc
+    out.write(data)
+    return zlib.crc32(data, crc)
+
+
+## Copies a member of known compressed size to out
+#  Returns the number of bytes written and their crc-32
+def _copyKnownSize(reader, compressedSize, method, out):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == _DEFLATED and out is not None else None
+    crc = 0
+    written = 0
+    remaining = compressedSize
+    while remaining > 0:
+        data = reader.readSome(min(remaining, _READ_SIZE))
+        if not data:
+            raise ValueError('Unexpected end of zip stream')
+        remaining -= len(data)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        crc = _write(out, data, crc)
+        written += len(data)
+    if decompressor is not None:
+        data = decompressor.flush()
+        crc = _write(out, data, crc)
+        written += len(data)
+    return written, crc
+
+
+## Copies a deflated member of unknown size to out, the deflate stream marks its own end
+#  Returns the number of bytes written and their crc-32
+def _copyDeflated(reader, out):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    written = 0
+    while not decompressor.eof:
+        data = reader.readSome()
+        if not data:
+            raise ValueError('Unexpected end of zip stream')
+        data = decompressor.decompress(data)
+        crc = _write(out, data, crc)
+        written += len(data)
+    reader.unread(decompressor.unused_data)
+    return written, crc
+
+
+## Copies a stored member of unknown size to out
+#  The member ends at the data descriptor signature that is followed by the crc-32 and size of the bytes before it.
+#  The last bytes are held back until it is known they are not the start of the descriptor.
+#  Returns the number of bytes written and their crc-32
+def _copyStored(reader, out):
+    crc = 0
+    written = 0
+    pending = b''
+    while True:
+        data = reader.readSome()
+        if not data:
+            raise ValueError('No data descriptor matches the data of a stored zip member, the zip is corrupt')
+        pending += data
+        index = pending.find(_DATA_DESCRIPTOR)
+        while 0 <= index <= len(pending) - _MAX_DESCRIPTOR_SIZE:
+            candidateCrc = zlib.crc32(pending[:index], crc)
+            descriptorCrc, size32 = struct.unpack('<LL', pending[index + 4:index + 12])
+            size64, = struct.unpack('<Q', pending[index + 8:index + 16])
+            if descriptorCrc == candidateCrc and written + index in (size32, size64):
+                if out is not None:
+                    out.write(pending[:index])
+                reader.unread(pending[index:])
+                return written + index, candidateCrc
+            index = pending.find(_DATA_DESCRIPTOR, index + 1)
+        keep = min(len(pending), _MAX_DESCRIPTOR_SIZE - 1)
+        if index >= 0:
+            keep = max(keep, len(pending) - index)
+        data, pending = pending[:len(pending) - keep], pending[len(pending) - keep:]
+        crc = zlib.crc32(data, crc)
+        written += len(data)
+        if out is not None:
+            out.write(data)
+
+
+## Reads the data descriptor after a member, its signature is optional and its sizes are 4 or 8 bytes
+#  Returns the crc-32 and uncompressed size
+def _readDataDescriptor(reader):
+    data = reader.read(4)
+    if data == _DATA_DESCRIPTOR:
+        data = reader.read(4)
+    crc, = struct.unpack('<L', data)
+    data = reader.read(12)
+    # the next record follows 4 byte sizes right after them
+    if data[8:12] in _NEXT_RECORDS:
+        reader.unread(data[8:])
+        return crc, struct.unpack('<LL', data[:8])[1]
+    data += reader.read(4)
+    return crc, struct.unpack('<QQ', data)[1]
+
+
+## Extracts a zip file to destinationPath while it is read from chunks, an iterable of bytes
+#  The zip is read once from the start, so it can be extracted while it is downloaded without being stored.
+#  Each file is written to name.part and renamed once its crc-32 and size match the ones in the zip,
+#  otherwise ValueError is raised. members selects the files to extract: None for all of them, a list of
+#  names in the zip, or a function that is given each name and returns whether to extract it. With a list,
+#  reading stops as soon as all of them are extracted, and ValueError is raised if some are not in the zip.
+#  Returns the paths of the extracted files
+def extractZipStream(chunks, destinationPath, members = None):
+    reader = _ChunkReader(chunks)
+    remaining = set(members) if members is not None and not callable(members) else None
+    extracted = []
+    while remaining is None or len(remaining) > 0:
+        signature = reader.read(4)
+        if signature in _CENTRAL_DIRECTORY:
+            break
+        if signature != _LOCAL_FILE_HEADER:
+            raise ValueError('Unexpected record %r in zip stream' % signature)
+        version, flags, method, modTime, modDate, crc, compressedSize, size, nameLength, extraLength = struct.unpack('<HHHHHLLLHH', reader.read(26))
+        name = reader.read(nameLength).decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+        extra = reader.read(extraLength)
+        compressedSize, size = _zip64Sizes(extra, compressedSize, size)
+        if flags & _FLAG_ENCRYPTED:
+            raise ValueError('Encrypted zip member %s is not supported' % name)
+        if method not in (_STORED, _DEFLATED):
+            raise ValueError('Compression method %d of zip member %s is not supported' % (method, name))
+
+        wanted = members is None or (name in remaining if remaining is not None else members(name))
+        isDirectory = name.endswith('/')
+        # only the names that are extracted need to be safe
+        path = _memberPath(destinationPath, name) if wanted else None
+        if wanted and isDirectory:
+            os.makedirs(path, exist_ok=True)
+        out = None
+        if wanted and not isDirectory:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            out = open(path + '.part', 'wb')
+        try:
+            if flags & _FLAG_DATA_DESCRIPTOR:
+                if method == _DEFLATED:
+                    written, actualCrc = _copyDeflated(reader, out)
+                else:
+                    written, actualCrc = _copyStored(reader, out)
+                crc, size = _readDataDescriptor(reader)
+            else:
+                written, actualCrc = _copyKnownSize(reader, compressedSize, method, out)
+            if out is not None:
+                out.close()
+                if actualCrc != crc or written != size:
+                    raise ValueError('Checksum mismatch for zip member %s' % name)
+                os.replace(path + '.part', path)
+                extracted.append(path)
+        except:
+            if out is not None:
+                out.close()
+                os.remove(path + '.part')
+            raise
+        if wanted and remaining is not None:
+            remaining.discard(name)
+    if remaining:
+        raise ValueError('Zip members not found: %s' % ', '.join(sorted(remaining)))
+    return extracted
+
+
+## Downloads the zip file at url and extracts it to destinationPath while it downloads (see extractZipStream)
+#  The download uses the pooled connections of the GirderAPI session.
+#  Returns the paths of the extracted files
+def extractZipFromUrl(url, destinationPath, members = None, headers = None):
+    # imported here because GirderAPI imports this module
+    from DatasetUtils import GirderAPI
+    response = GirderAPI._session.get(url, headers = headers, stream = True)
+    try:
+        if response.status_code != 200:
+            raise ValueError('Response code %d while downloading %s' % (response.status_code, url))
+        return extractZipStream(response.iter_content(chunk_size = _READ_SIZE), destinationPath, members)
+    finally:
+        response.close()
@@ -20,8 +20,15 @@ def getFileList(datasetName, loginState = None):
     return GirderConnector.getFileList(accessToken, datasetName)
 
 
+## Removes the cached dataset and file listings so the next call lists the data portal again
+def clearListingCache():
+    GirderConnector.clearListingCache()
+
+
 ## fileList is list of file path strings 
-def downloadDataset(datasetName, destinationPath='.', fileList = None, asZip = True, loginState = None):
+## concurrency is the number of files downloaded at the same time when not downloading a zip.
+## Interrupted downloads are resumed and files that were already downloaded are skipped.
+def downloadDataset(datasetName, destinationPath='.', fileList = None, asZip = True, loginState = None, concurrency = 8):
     GirderConnector.printDataPortalWelcome()
     print('Downloading the', datasetName, 'dataset from the ShapeWorks Portal')
     accessToken = GirderConnector.login(loginState)
@@ -32,18 +39,36 @@ def downloadDataset(datasetName, destinationPath='.', fileList = None, asZip = T
     else:
         if fileList is not None:
             print('Downloading', len(fileList), 'specified files')
-        GirderConnector.downloadDataset(accessToken, datasetName, destinationPath, fileList)
+        GirderConnector.downloadDataset(accessToken, datasetName, destinationPath, fileList, concurrency)
 
     print('Downloaded the', datasetName, 'dataset from the ShapeWorks Portal.')
 
 
+## Downloads the dataset as a zip and extracts it to destinationPath/datasetName while it downloads, the zip is not stored.
+## Each file is checked against the checksum in the zip.
+## fileList is a list of file path strings, or a function that is given each file path and returns whether to extract it.
+## Returns the paths of the extracted files
+def downloadAndUnzipDataset(datasetName, destinationPath='.', fileList = None, loginState = None):
+    GirderConnector.printDataPortalWelcome()
+    print('Downloading and unzipping the', datasetName, 'dataset from the ShapeWorks Portal')
+    accessToken = GirderConnector.login(loginState)
+
+    extracted = GirderConnector.downloadDatasetUnzipped(accessToken, datasetName, destinationPath, fileList)
+
+    print('Downloaded and unzipped the', datasetName, 'dataset from the ShapeWorks Portal.')
+    return extracted
+
+
 ## Uploads dataset to the data portal without overwriting anything.
 ## To replace files, delete them on the data portal before uploading.
-def uploadDataset(datasetName, datasetPath, loginState = None):
+## Files already on the data portal with the same checksum are skipped.
+## concurrency is the number of files uploaded at the same time.
+## An interrupted upload continues where it stopped when it is run again.
+def uploadDataset(datasetName, datasetPath, loginState = None, concurrency = 4):
     GirderConnector.printDataPortalWelcome()
     print('Uploading the %s dataset from %s to the ShapeWorks Portal' % (datasetName, datasetPath))
     accessToken = GirderConnector.login(loginState)
 
-    GirderConnector.uploadDataset(accessToken, datasetName, datasetPath)
+    GirderConnector.uploadDataset(accessToken, datasetName, datasetPath, concurrency)
 
     print('Uploaded the', datasetName, 'dataset to the ShapeWorks Portal.')
@@ -1,7 +1,6 @@
 # Jadie Adams
 import os
 import numpy as np
-from numpy import matlib
 import itk
 import csv
 from scipy import ndimage
@@ -10,10 +9,15 @@ import random
 import time
 import shutil
 import subprocess
+import contextlib
+import functools
+import inspect
 import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch import distributed as dist
 
 ########################## Model Class ####################################
 
@@ -67,7 +71,8 @@ class DeepSSMNet(nn.Module):
 
 class Flatten(nn.Module):
 	def forward(self, x):
-		return x.view(x.size(0), -1)
+		# reshape rather than view so channels-last inputs can be flattened
+		return x.reshape(x.size(0), -1)
 
 ##################################### Train Functions ###########################
 
@@ -86,11 +91,11 @@ def weight_init(module, initf):
 Train helper
 	prints and logs values during training
 '''
-def log_print(logger, values):
+def log_print(logger, values, echo=True):
 	# print values
-	if isinstance(values[0], str):
+	if echo and isinstance(values[0], str):
 		print('	  '.join(values))
-	else:
+	elif echo:
 		format_values = ['%.4f' % i for i in values]
 		print('	  '.join(format_values))
 	# csv format
@@ -98,26 +103,220 @@ def log_print(logger, values):
 	log_string = ','.join(string_values)
 	logger.write(log_string + '\n')
 
+'''
+Train helper
+	saves a training checkpoint, writing to a temporary file first so an interrupted save cannot corrupt the last checkpoint
+'''
+def saveCheckpoint(checkpoint_path, checkpoint):
+	tmp_path = checkpoint_path + '.tmp'
+	torch.save(checkpoint, tmp_path)
+	os.replace(tmp_path, checkpoint_path)
+
+'''
+Train helper
+	returns the state of every random number generator used in training so a resumed run continues the same streams
+'''
+def getRNGState():
+	# only tensors and plain python values are stored, so the checkpoint loads with torch.load(weights_only=True)
+	name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+	numpy_state = [name, torch.from_numpy(keys.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian)]
+	version, internal_state, gauss_next = random.getstate()
+	random_state = [version, list(internal_state), gauss_next]
+	state = {'torch': torch.get_rng_state(), 'numpy': numpy_state, 'random': random_state}
+	if torch.cuda.is_available():
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+'''
+Train helper
+	restores random number generator states saved by getRNGState
+'''
+def setRNGState(state):
+	torch.set_rng_state(state['torch'].cpu())
+	name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+	np.random.set_state((name, np.asarray(keys).astype(np.uint32), pos, has_gauss, cached_gaussian))
+	version, internal_state, gauss_next = state['random']
+	random.setstate((version, tuple(internal_state), gauss_next))
+	if 'cuda' in state and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+'''
+Train helper
+	returns the torch device to use, the GPU if one is available unless a device is specified
+'''
+def getDevice(device=None):
+	if device is None:
+		device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+	return torch.device(device)
+
+'''
+Train helper
+	returns the autocast data type for the precision parameter or None for full float32 precision
+	torch before 1.10 only has fp16 autocast on the GPU, other mixed precisions exit with an error
+'''
+def getAutocastType(precision, device):
+	if precision in [None, 'float32', 'fp32']:
+		return None
+	elif precision in ['bfloat16', 'bf16']:
+		autocast_type = torch.bfloat16
+	elif precision in ['float16', 'fp16']:
+		autocast_type = torch.float16
+	else:
+		print("Error: precision " + str(precision) + " unrecognized.")
+		print("float32, bf16, and fp16 currently supported.")
+		exit()
+	if not hasattr(torch, 'autocast') and not (autocast_type == torch.float16 and device.type == 'cuda'):
+		print("Error: precision " + str(precision) + " on " + device.type + " requires torch>=1.10, torch " + torch.__version__ + " is installed.")
+		print("Only fp16 on a GPU is supported by this version.")
+		exit()
+	return autocast_type
+
+'''
+Train helper
+	returns a mixed precision autocast context for the device, or a no-op context for float32
+'''
+def autocast(device, autocast_type):
+	if autocast_type is None:
+		return contextlib.nullcontext()
+	if not hasattr(torch, 'autocast'):
+		# torch before 1.10, getAutocastType only allows fp16 on the GPU
+		return torch.cuda.amp.autocast()
+	return torch.autocast(device_type=device.type, dtype=autocast_type)
+
+'''
+Train helper
+	returns the memory format of the model and images, exits if channels last 3D is requested but not supported by torch
+'''
+def getMemoryFormat(channels_last):
+	if not channels_last:
+		return torch.contiguous_format
+	if not hasattr(torch, 'channels_last_3d'):
+		print("Error: channels_last requires torch>=1.10, torch " + torch.__version__ + " is installed.")
+		exit()
+	return torch.channels_last_3d
+
+'''
+Train helper
+	moves a batch of images to the device in the memory format used by the model
+'''
+def toDevice(img, device, memory_format):
+	return img.to(device, non_blocking=True).contiguous(memory_format=memory_format)
+
+'''
+Train helper
+	initializes the process group for distributed data-parallel training when requested by the parameters or by a launcher such as torchrun
+	returns whether training is distributed, this process's rank, and the number of processes
+'''
+def initDistributed(parameters):
+	distributed = parameters.get('distributed', int(os.environ.get('WORLD_SIZE', '1')) > 1)
+	if not distributed:
+		return False, 0, 1
+	if not dist.is_available():
+		print("Error: torch.distributed is not available in this PyTorch build.")
+		exit()
+	if not dist.is_initialized():
+		# MASTER_ADDR, MASTER_PORT, RANK and WORLD_SIZE are read from the environment
+		dist.init_process_group(backend=parameters.get('backend', 'gloo'))
+	return True, dist.get_rank(), dist.get_world_size()
+
+'''
+Train helper
+	rebuilds a loader so each process iterates over its own shard of the dataset
+'''
+def getDistributedLoader(loader, shuffle):
+	sampler = DistributedSampler(loader.dataset, shuffle=shuffle)
+	return DataLoader(loader.dataset, batch_size=loader.batch_size, sampler=sampler, num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+'''
+Train helper
+	sums per-process loss totals so every process computes the same epoch errors
+'''
+def reduceLosses(values, distributed):
+	values = torch.tensor(values, dtype=torch.float64)
+	if distributed:
+		dist.all_reduce(values, op=dist.ReduceOp.SUM)
+	return values.numpy()
+
+'''
+Train helper
+	returns total / count, or nan when there were no batches
+'''
+def meanOf(total, count):
+	if count == 0:
+		return np.nan
+	return total / count
+
+'''
+Train helper
+	loads a data loader saved with torch.save
+	loaders are whole pickled objects, which newer torch versions only load with weights_only=False
+'''
+def loadLoader(loader_path):
+	if 'weights_only' in inspect.signature(torch.load).parameters:
+		return torch.load(loader_path, weights_only=False)
+	return torch.load(loader_path)
+
+'''
+Train helper
+	opens a training log, resuming it at offset when given or starting it with the header otherwise
+'''
+def openLog(log_path, offset=None, echo=True):
+	if offset is not None and os.path.exists(log_path):
+		# drop anything logged after the checkpoint, those epochs are repeated
+		logger = open(log_path, "r+")
+		logger.seek(offset)
+		logger.truncate()
+	else:
+		logger = open(log_path, "w+")
+		log_print(logger, ["Epoch", "Train_Err", "Train_Rel_Err", "Val_Err", "Val_Rel_Err", "Sec"], echo)
+	return logger
+
 '''
 Network training method
 	defines, initializes, and trains the models
 	logs training and validation errors
 	saves the model and returns the path it is saved to
+	optional parameters:
+		device: torch device to train on (default is the GPU if available)
+		precision: float32 (default), bf16, or fp16 mixed precision using autocast
+		channels_last: use the channels-last 3D memory format (default False)
+		compile: optimize the model with torch.compile when available (default False)
+		num_threads: number of intra-op threads used on the CPU (default is the torch default)
+		checkpoint_freq: epochs between training checkpoints, 0 disables them (default 1)
+		resume: resume from the checkpoint in parent_dir if there is one (default True)
+		early_stop_patience: validation checks without improvement before stopping, 0 never stops early (default 0)
+		lr_scheduler: 'plateau' reduces the learning rate when the validation error stops improving (default None)
+		lr_factor: factor the learning rate is reduced by (default 0.5)
+		lr_patience: validation checks without improvement before the learning rate is reduced (default 2)
+		distributed: data-parallel training over torch.distributed processes (default True when launched with WORLD_SIZE > 1)
+		backend: torch.distributed backend (default gloo, which also runs on the CPU)
 '''
 def train(loader_dir, parameters, parent_dir):
+	distributed, rank, world_size = initDistributed(parameters)
 	# load le loaders
 	train_loader_path = loader_dir + "train"
 	validation_loader_path = loader_dir + "validation"
 	print("Loading data loaders...")
-	train_loader = torch.load(train_loader_path)
-	val_loader = torch.load(validation_loader_path)
+	train_loader = loadLoader(train_loader_path)
+	val_loader = loadLoader(validation_loader_path)
+	if distributed:
+		train_loader = getDistributedLoader(train_loader, shuffle=True)
+		val_loader = getDistributedLoader(val_loader, shuffle=False)
 	print("Done.")
 	# initalizations
-	num_pca = train_loader.dataset.pca_target[0].shape[0]
+	num_pca = train_loader.dataset[0][1].shape[0]
 	print("Defining model...")
 	model = DeepSSMNet(num_pca)
-	device = model.device
-	model.cuda()
+	device = parameters.get('device')
+	if device is None and distributed and torch.cuda.is_available():
+		device = 'cuda:' + os.environ.get('LOCAL_RANK', '0')
+	device = getDevice(device)
+	model.device = str(device)
+	if parameters.get('num_threads'):
+		torch.set_num_threads(parameters['num_threads'])
+	autocast_type = getAutocastType(parameters.get('precision'), device)
+	memory_format = getMemoryFormat(parameters.get('channels_last'))
+	model.to(device, memory_format=memory_format)
 	num_epochs = parameters['epochs']
 	learning_rate = parameters['learning_rate']
 	eval_freq = parameters['val_freq']
@@ -128,61 +327,166 @@ def train(loader_dir, parameters, parent_dir):
 	train_params = model.parameters()
 	opt = torch.optim.Adam(train_params, learning_rate)
 	opt.zero_grad()
+	# loss scaling keeps float16 gradients from underflowing on the GPU
+	scaler = torch.cuda.amp.GradScaler(enabled=(autocast_type == torch.float16 and device.type == 'cuda'))
+	# learning rate schedule and early stopping are measured in validation checks
+	scheduler = None
+	if parameters.get('lr_scheduler') == 'plateau':
+		scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(opt, factor=parameters.get('lr_factor', 0.5), patience=parameters.get('lr_patience', 2))
+	elif parameters.get('lr_scheduler'):
+		print("Error: Unknown lr_scheduler " + str(parameters['lr_scheduler']) + ", supported is 'plateau'.")
+		exit()
+	early_stop_patience = parameters.get('early_stop_patience', 0)
+	checkpoint_freq = parameters.get('checkpoint_freq', 1)
+	checkpoint_path = os.path.join(parent_dir, 'checkpoint.torch')
+	start_epoch = 1
+	smallest_val_rel_loss = np.inf
+	best_epoch = 0
+	count = 0
+	log_path = parent_dir + "train_log.csv"
+	rank_log_path = parent_dir + "train_log_rank" + str(rank) + ".csv"
+	# rank 0 owns the checkpoint and shares it, the other processes may not see its file system
+	checkpoint = None
+	if rank == 0 and parameters.get('resume', True) and os.path.exists(checkpoint_path) and os.path.exists(log_path):
+		checkpoint = torch.load(checkpoint_path, map_location='cpu')
+	if distributed:
+		shared = [checkpoint]
+		dist.broadcast_object_list(shared, src=0)
+		checkpoint = shared[0]
+	if checkpoint is not None:
+		model.load_state_dict(checkpoint['model'])
+		opt.load_state_dict(checkpoint['opt'])
+		scaler.load_state_dict(checkpoint['scaler'])
+		if scheduler is not None and checkpoint['scheduler'] is not None:
+			scheduler.load_state_dict(checkpoint['scheduler'])
+		start_epoch = checkpoint['epoch'] + 1
+		smallest_val_rel_loss = checkpoint['smallest_val_rel_loss']
+		best_epoch = checkpoint['best_epoch']
+		count = checkpoint['count']
+		setRNGState(checkpoint['rng'])
+		print("Resuming training from epoch " + str(start_epoch) + ".")
+	# only rank 0 writes train_log.csv, with errors over all processes; every process logs its own shard's errors when distributed
+	logger = None
+	if rank == 0:
+		logger = openLog(log_path, checkpoint['log_offset'] if checkpoint is not None else None)
+	rank_logger = None
+	if distributed:
+		rank_log_offset = None
+		if checkpoint is not None and checkpoint.get('rank_log_offsets') is not None:
+			rank_log_offset = checkpoint['rank_log_offsets'][rank]
+		rank_logger = openLog(rank_log_path, rank_log_offset, echo=False)
+	# the wrapped and compiled models share parameters with model, which is what gets saved
+	train_model = model
+	if distributed:
+		train_model = nn.parallel.DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None)
+	if parameters.get('compile') and hasattr(torch, 'compile'):
+		train_model = torch.compile(train_model)
 	print("Done.")
 	# train
-	print("Beginning training on device = " + device + '\n')
-	logger = open(parent_dir + "train_log.csv", "w+")
-	log_print(logger, ["Epoch", "Train_Err", "Train_Rel_Err", "Val_Err", "Val_Rel_Err", "Sec"])
+	print("Beginning training on device = " + str(device) + '\n')
 	t0 = time.time()
-	smallest_val_rel_loss = np.Inf
-	for e in range(1, num_epochs + 1):
-		torch.cuda.empty_cache()
+	e = start_epoch - 1
+	for e in range(start_epoch, num_epochs + 1):
+		if distributed:
+			train_loader.sampler.set_epoch(e)
 		# train
-		model.train()
+		train_model.train()
 		train_losses = []
 		train_rel_losses = []
 		for img, pca, mdl in train_loader:
 			opt.zero_grad()
-			img = img.to(device)
-			pca = pca.to(device)
-			pred = model(img)
+			img = toDevice(img, device, memory_format)
+			pca = pca.to(device, non_blocking=True)
+			with autocast(device, autocast_type):
+				pred = train_model(img)
+			pred = pred.float()
 			loss = torch.mean((pred - pca)**2)
-			loss.backward()
-			opt.step()
+			scaler.scale(loss).backward()
+			scaler.step(opt)
+			scaler.update()
 			train_losses.append(loss.item())
 			train_rel_loss = F.mse_loss(pred, pca) / F.mse_loss(pred*0, pca)
 			train_rel_losses.append(train_rel_loss.item())
 		# test validation
+		stop = False
 		if ((e % eval_freq) == 0 or e == 1):
-			model.eval()
+			train_model.eval()
 			val_losses = []
 			val_rel_losses = []
-			for img, pca, mdl in val_loader:
-				opt.zero_grad()
-				img = img.to(device)
-				pca = pca.to(device)
-				pred = model(img)
-				v_loss = torch.mean((pred - pca)**2)
-				val_losses.append(v_loss.item())
-				val_rel_loss = F.mse_loss(pred, pca) / F.mse_loss(pred*0, pca)
-				val_rel_losses.append(val_rel_loss.item())
+			with torch.no_grad():
+				for img, pca, mdl in val_loader:
+					img = toDevice(img, device, memory_format)
+					pca = pca.to(device, non_blocking=True)
+					with autocast(device, autocast_type):
+						pred = train_model(img)
+					pred = pred.float()
+					v_loss = torch.mean((pred - pca)**2)
+					val_losses.append(v_loss.item())
+					val_rel_loss = F.mse_loss(pred, pca) / F.mse_loss(pred*0, pca)
+					val_rel_losses.append(val_rel_loss.item())
 			# log
-			train_mr_MSE = np.mean(np.sqrt(train_losses))
-			val_mr_MSE = np.mean(np.sqrt(val_losses))
-			train_rel_err = np.mean(train_rel_losses)
-			val_rel_err =  np.mean(val_rel_losses)
-			log_print(logger, [e, train_mr_MSE, train_rel_err, val_mr_MSE, val_rel_err, time.time()-t0])
-			if val_rel_loss < smallest_val_rel_loss:
-				smallest_val_rel_loss = val_rel_loss
+			sums = [np.sum(np.sqrt(train_losses)), np.sum(train_rel_losses), len(train_losses), np.sum(np.sqrt(val_losses)), np.sum(val_rel_losses), len(val_losses)]
+			if rank_logger is not None:
+				# a process whose shard has no batches logs nan
+				log_print(rank_logger, [e, meanOf(sums[0], sums[2]), meanOf(sums[1], sums[2]), meanOf(sums[3], sums[5]), meanOf(sums[4], sums[5]), time.time()-t0], echo=False)
+			sums = reduceLosses(sums, distributed)
+			train_mr_MSE = meanOf(sums[0], sums[2])
+			train_rel_err = meanOf(sums[1], sums[2])
+			val_mr_MSE = meanOf(sums[3], sums[5])
+			val_rel_err = meanOf(sums[4], sums[5])
+			if logger is not None:
+				log_print(logger, [e, train_mr_MSE, train_rel_err, val_mr_MSE, val_rel_err, time.time()-t0])
+			# every process sees the same errors, so they all make the same decisions
+			if val_rel_err < smallest_val_rel_loss:
+				smallest_val_rel_loss = val_rel_err
 				best_epoch = e
 				count = 0
-				torch.save(model.state_dict(), os.path.join(parent_dir, 'best_model.torch'))
-				torch.save(opt.state_dict(), os.path.join(parent_dir, 'best_opt.torch'))
+				if rank == 0:
+					torch.save(model.state_dict(), os.path.join(parent_dir, 'best_model.torch'))
+					torch.save(opt.state_dict(), os.path.join(parent_dir, 'best_opt.torch'))
+			else:
+				count += 1
+			if scheduler is not None:
+				scheduler.step(val_rel_err)
+			if early_stop_patience and count >= early_stop_patience:
+				print("Validation error has not improved in " + str(count) + " checks, stopping early.")
+				stop = True
 			t0 = time.time()
+		if stop:
+			break
+		if checkpoint_freq and e % checkpoint_freq == 0 and e < num_epochs:
+			rank_log_offsets = None
+			if distributed:
+				rank_logger.flush()
+				rank_log_offsets = [None] * world_size
+				dist.all_gather_object(rank_log_offsets, rank_logger.tell())
+			if rank == 0:
+				logger.flush()
+				saveCheckpoint(checkpoint_path, {
+					'model': model.state_dict(),
+					'opt': opt.state_dict(),
+					'scaler': scaler.state_dict(),
+					'scheduler': scheduler.state_dict() if scheduler is not None else None,
+					'epoch': e,
+					'smallest_val_rel_loss': float(smallest_val_rel_loss),
+					'best_epoch': best_epoch,
+					'count': count,
+					'rng': getRNGState(),
+					'log_offset': logger.tell(),
+					'rank_log_offsets': rank_log_offsets})
 	# save
-	logger.close()
-	torch.save(model.state_dict(), os.path.join(parent_dir, 'final_model.torch'))
-	torch.save(opt.state_dict(), os.path.join(parent_dir, 'final_opt.torch'))
+	if rank_logger is not None:
+		rank_logger.close()
+	if rank == 0:
+		logger.close()
+		torch.save(model.state_dict(), os.path.join(parent_dir, 'final_model.torch'))
+		torch.save(opt.state_dict(), os.path.join(parent_dir, 'final_opt.torch'))
+		# the run is complete, a new call should start over rather than resume
+		if os.path.exists(checkpoint_path):
+			os.remove(checkpoint_path)
+	# no process returns before the final model is written
+	if distributed:
+		dist.barrier()
 	print("Training complete.")
 	print("Best model saved after epoch " + str(best_epoch) + ".")
 	print("Final model saved after epoch " + str(e) + ".")
@@ -193,62 +497,127 @@ def train(loader_dir, parameters, parent_dir):
 undo data whitening
 ''' 
 def undoNorm(data_list, mean, std):
-	unnorm_data = []
-	for data in data_list:
-		unnorm_data.append((data*std)+mean)
-	return np.array(unnorm_data)
+	return (np.asarray(data_list)*std)+mean
+
+'''
+Test helper
+	loads the PCA mean shape and the first num_pca modes as one (num_pca, 3*M) matrix
+	reads the binary pca_model.npz written by data augmentation if there is one, and otherwise the particle files
+	the result is cached by modification time so repeated predictions do not reparse the particle files
+	and files written again (e.g. by rerunning data augmentation) are read again
+'''
+def loadPCABasis(pca_score_path, num_pca):
+	model_path = pca_score_path + '/pca_model.npz'
+	source_path = model_path if os.path.exists(model_path) else pca_score_path + '/mean.particles'
+	return readPCABasis(pca_score_path, num_pca, os.path.getmtime(source_path))
+
+'''
+Test helper
+	reads the PCA basis for loadPCABasis, modified_time is only part of the cache key
+'''
+@functools.lru_cache(maxsize=8)
+def readPCABasis(pca_score_path, num_pca, modified_time):
+	model_path = pca_score_path + '/pca_model.npz'
+	if os.path.exists(model_path):
+		with np.load(model_path) as model:
+			meanshape = model['mean']
+			W = model['modes'][:num_pca]
+		if W.shape[0] < num_pca:
+			print("Error: " + model_path + " has " + str(W.shape[0]) + " modes, " + str(num_pca) + " are needed.")
+			exit()
+		return meanshape, np.float64(W)
+	meanshape = np.loadtxt(pca_score_path + '/mean.particles')
+	M = meanshape.shape[0]
+	W = np.zeros([num_pca, 3*M])
+	for i in range(num_pca):
+		nm = pca_score_path + '/pcamode' + str(i) + '.particles'
+		prt = np.loadtxt(nm)
+		W[i, ...] = prt.flatten()
+	return meanshape, W
 
 '''
 Test helper
 	gets the predicted paricle coordinates from the pca scores
-	saves them in out_dir
+	saves them in predPath unless it is None and returns them as an (N, M, 3) array
 '''
 def getPoints(predPath, pred_scores, pca_score_path, test_names, loader_dir):
 	print("Getting particles from predicted PCA scores...")
 	mean_PCA = np.load(loader_dir + 'mean_PCA.npy')
 	std_PCA = np.load(loader_dir + 'std_PCA.npy')
 	pred_scores = undoNorm(pred_scores, mean_PCA, std_PCA)
-	if not os.path.exists(predPath):
-		os.makedirs(predPath)
 	N = pred_scores.shape[0]
 	K = pred_scores.shape[1]
 	# now create the PCA matrix
-	meanshape = np.loadtxt(pca_score_path + '/mean.particles')
+	meanshape, W = loadPCABasis(pca_score_path, K)
 	M = meanshape.shape[0]
-	W = np.zeros([K, 3*M])
-	for i in range(K):
-		nm = pca_score_path + '/pcamode' + str(i) + '.particles'
-		prt = np.loadtxt(nm)
-		W[i, ...] = prt.flatten()
-	pointsPred = np.matmul(pred_scores,W) + np.matlib.repmat(meanshape.reshape(1, 3*M), N, 1)
-
-	for i in range(N):
-		print("Data Point : ", i)
-		nmpred = predPath + 'predicted_' + test_names[i] + '.particles'
-		tmpPred = pointsPred[i, ...].reshape(M, 3)
-		np.savetxt(nmpred, tmpPred)
+	pointsPred = (np.matmul(pred_scores, W) + meanshape.reshape(1, 3*M)).reshape(N, M, 3)
+	if predPath is not None:
+		if not os.path.exists(predPath):
+			os.makedirs(predPath)
+		for i in range(N):
+			nmpred = predPath + 'predicted_' + test_names[i] + '.particles'
+			np.savetxt(nmpred, pointsPred[i])
+		print("Saved " + str(N) + " predictions to " + predPath)
 	print("Done.\n")
+	return pointsPred
+
+'''
+Test helper
+	loads a trained model onto the device for inference
+'''
+def loadModel(model_path, num_pca, device):
+	model = DeepSSMNet(num_pca)
+	model.load_state_dict(torch.load(model_path, map_location=device))
+	model.device = str(device)
+	model.to(device)
+	model.eval()
+	return model
+
+'''
+Test helper
+	predicts the (whitened) PCA scores for batches of images with the model
+	images can be a DataLoader of (img, pca, mdl) batches or an (N, 1, D, H, W) array
+'''
+def predictScores(model, images, device, batch_size=32):
+	inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
+	if isinstance(images, DataLoader):
+		batches = (img for img, pca, mdl in images)
+	else:
+		batches = (torch.from_numpy(images[i:i+batch_size]) for i in range(0, len(images), batch_size))
+	pred_scores = []
+	with inference_mode():
+		for img in batches:
+			img = img.to(device, non_blocking=True)
+			pred_scores.append(model(img).float().cpu().numpy())
+	if not pred_scores:
+		return np.zeros((0, model.num_pca))
+	return np.concatenate(pred_scores)
 
 '''
 Network Test Function
 	predicts the PCA scores using the trained networks
 	returns the error measures and saves the predicted and poriginal particles for comparison
 '''
-def test(out_dir, model_path, loader_dir, pca_scores_path, num_pca):
+def test(out_dir, model_path, loader_dir, pca_scores_path, num_pca, batch_size=32, device=None):
 	if not os.path.exists(out_dir):
 		os.makedirs(out_dir)
 	# load le loaders
 	test_loader_path = loader_dir + "test"
 	print("Loading test data loader...")
-	test_loader = torch.load(test_loader_path)
+	test_loader = loadLoader(test_loader_path)
+	device = getDevice(device)
+	# rebatch the saved loader (which has a batch size of 1)
+	test_loader = DataLoader(
+			test_loader.dataset,
+			batch_size=batch_size,
+			shuffle=False,
+			num_workers=test_loader.num_workers,
+			pin_memory=(device.type == 'cuda')
+		)
 	print("Done.\n")
 	# initalizations
 	print("Loading trained model...")
-	model = DeepSSMNet(num_pca)
-	model.load_state_dict(torch.load(model_path))
-	device = model.device
-	model.cuda()
-	model.eval()
+	model = loadModel(model_path, num_pca, device)
 	# Get test names 
 	test_names_file = loader_dir + 'test_names.txt'
 	f = open(test_names_file, 'r')
@@ -258,19 +627,34 @@ def test(out_dir, model_path, loader_dir, pca_scores_path, num_pca):
 	test_names = test_names_string.split(",")
 	print("Done.\n")
 	print("Predicting for test images...")
-	index = 0
-	pred_scores = []
-	for img, pca, mdl in test_loader:
-		img = img.to(device)
-		pred = model(img)
-		pred_scores.append(pred.cpu().data.numpy()[0])
-		index += 1
-		print("Predicted test " + str(index) + ".")
+	t0 = time.time()
+	pred_scores = predictScores(model, test_loader, device)
+	print("Predicted " + str(len(pred_scores)) + " test images in " + '%.2f' % (time.time()-t0) + " seconds.")
 	print("Done.\n")
-	pred_scores = np.array(pred_scores)
 	getPoints(out_dir, pred_scores, pca_scores_path, test_names, loader_dir)
 	return
 
+'''
+Network Prediction Function
+	predicts particles for a list or array of image volumes in memory
+	the images must have the same size (and downsampling) as the images the model was trained on
+	they are whitened using the image stats saved in loader_dir
+	returns an (N, M, 3) array of particles, they are also saved to out_dir with names if out_dir is not None
+'''
+def predict(model_path, images, loader_dir, pca_scores_path, num_pca, batch_size=32, device=None, out_dir=None, names=None):
+	device = getDevice(device)
+	model = loadModel(model_path, num_pca, device)
+	images = np.asarray(images, dtype=np.float32)
+	if images.ndim == 4:
+		images = images[:, np.newaxis]
+	mean_image = np.load(loader_dir + 'mean_img.npy')
+	std_image = np.load(loader_dir + 'std_img.npy')
+	images = (images - np.float32(mean_image))/np.float32(std_image)
+	pred_scores = predictScores(model, images, device, batch_size)
+	if names is None:
+		names = [str(i) for i in range(len(pred_scores))]
+	return getPoints(out_dir, pred_scores, pca_scores_path, names, loader_dir)
+
 '''
 Make folder
 '''
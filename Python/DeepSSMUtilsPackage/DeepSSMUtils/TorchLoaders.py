@@ -1,10 +1,12 @@
 import os
+import json
 import numpy as np
 import itk
-import csv
-import random
-import subprocess
+import time
+import multiprocessing as mtps
 import torch
+from shapeworks import Image
+from DataAugmentationUtils import Utils as AugmentationUtils
 from torch import nn
 from torch.utils.data import DataLoader
 
@@ -12,18 +14,22 @@ from torch.utils.data import DataLoader
 
 '''
 Reads csv and makes train and validation data loaders
+If shard_size is not 0 the data is written to memory-mapped shards on disk instead of being held in RAM
 '''
-def getTrainValLoaders(loader_dir, data_csv, batch_size=1, down_sample=False):
+def getTrainValLoaders(loader_dir, data_csv, batch_size=1, down_sample=False, shard_size=0):
 	if not os.path.exists(loader_dir):
 		os.makedirs(loader_dir)
-	images, scores, models, prefixes = getAllTrainData(loader_dir, data_csv, down_sample)
-	images, scores, models, prefixes = shuffleData(images, scores, models, prefixes)
-	# split into train (80%) validation(20%)
-	cut = int(len(images)*.80) 
-	print("\nTurning to tensors...")
-	train_data = DeepSSMdataset(images[:cut], scores[:cut], models[:cut])
+	if shard_size:
+		train_data, val_data = getShardedTrainValData(loader_dir, data_csv, down_sample, shard_size)
+	else:
+		images, scores, models, prefixes = getAllTrainData(loader_dir, data_csv, down_sample)
+		images, scores, models, prefixes = shuffleData(images, scores, models, prefixes)
+		# split into train (80%) validation(20%)
+		cut = int(len(images)*.80) 
+		print("\nTurning to tensors...")
+		train_data = DeepSSMdataset(images[:cut], scores[:cut], models[:cut])
+		val_data = DeepSSMdataset(images[cut:], scores[cut:], models[cut:])
 	print(str(len(train_data)) + ' in training set')
-	val_data = DeepSSMdataset(images[cut:], scores[cut:], models[cut:])
 	print(str(len(val_data)) + ' in validation set')
 
 	print("\nCreating and saving dataloaders...")
@@ -50,10 +56,85 @@ def getTrainValLoaders(loader_dir, data_csv, batch_size=1, down_sample=False):
 	print("Val loader done.")
 	return train_path, val_path
 
+'''
+Makes train and validation data loaders from datasets that generate augmented examples on demand
+(see DataAugmentationUtils.getOnlineAugmentationDataset), normalizing both with stats estimated from train_data
+'''
+def getOnlineTrainValLoaders(loader_dir, train_data, val_data, batch_size=1, num_workers=8):
+	if not os.path.exists(loader_dir):
+		os.makedirs(loader_dir)
+	print("Estimating normalization...")
+	normalization = train_data.estimateNormalization()
+	val_data.setNormalization(normalization)
+	np.save(loader_dir + 'mean_PCA.npy', normalization['mean_PCA'])
+	np.save(loader_dir + 'std_PCA.npy', normalization['std_PCA'])
+	np.save(loader_dir + 'mean_img.npy', normalization['mean_img'])
+	np.save(loader_dir + 'std_img.npy', normalization['std_img'])
+	writeMetadata(loader_dir, mean_PCA=normalization['mean_PCA'].tolist(), std_PCA=normalization['std_PCA'].tolist(),
+		mean_img=float(normalization['mean_img']), std_img=float(normalization['std_img']))
+	print(str(len(train_data)) + ' in training set')
+	print(str(len(val_data)) + ' in validation set')
+	print("\nCreating and saving dataloaders...")
+	trainloader = DataLoader(
+			train_data,
+			batch_size=batch_size,
+			shuffle=True,
+			num_workers=num_workers,
+			pin_memory=torch.cuda.is_available()
+		)
+	train_path = loader_dir + 'train'
+	torch.save(trainloader, train_path)
+	print("Train loader done.")
+	validationloader = DataLoader(
+			val_data,
+			batch_size=1,
+			shuffle=False,
+			num_workers=num_workers,
+			pin_memory=torch.cuda.is_available()
+		)
+	val_path = loader_dir + 'validation'
+	torch.save(validationloader, val_path)
+	print("Val loader done.")
+	return train_path, val_path
+
+'''
+Streams the data in the csv into memory-mapped train (80%) and validation (20%) shards
+returns the train and validation datasets
+'''
+def getShardedTrainValData(loader_dir, data_csv, down_sample, shard_size):
+	print("Reading all data...")
+	image_paths, scores, model_paths, prefixes = readTrainCSV(data_csv)
+	scores = whitenPCAscores(scores, loader_dir)
+	print("Shuffling.")
+	# np.random.shuffle permutes by length only, so this is the same split shuffleData makes in memory
+	order = list(range(len(image_paths)))
+	np.random.shuffle(order)
+	# split into train (80%) validation(20%)
+	cut = int(len(order)*.80)
+	shard_dirs = []
+	stats = None
+	# one pool reads the images of all shards
+	pool = getReadPool(len(image_paths))
+	try:
+		for split, indices in [('train', order[:cut]), ('validation', order[cut:])]:
+			print("\nWriting " + split + " shards...")
+			shard_dir = loader_dir + split + '_shards/'
+			split_stats = writeShards(shard_dir, [image_paths[i] for i in indices], [scores[i] for i in indices], [model_paths[i] for i in indices], down_sample, shard_size, pool)
+			stats = AugmentationUtils.combine_stats(stats, split_stats)
+			shard_dirs.append(shard_dir)
+	finally:
+		if pool is not None:
+			pool.terminate()
+	mean_image, std_image = getSavedImageStats(loader_dir, stats)
+	for shard_dir in shard_dirs:
+		normalizeShards(shard_dir, mean_image, std_image)
+	return DeepSSMShardedDataset(shard_dirs[0]), DeepSSMShardedDataset(shard_dirs[1])
+
 '''
 Makes test data loader
+If shard_size is not 0 the images are written to memory-mapped shards on disk instead of being held in RAM
 '''
-def getTestLoader(loader_dir, test_img_list, down_sample):
+def getTestLoader(loader_dir, test_img_list, down_sample, shard_size=0):
 	# get data
 	image_paths = []
 	scores = []
@@ -68,9 +149,15 @@ def getTestLoader(loader_dir, test_img_list, down_sample):
 		# add label placeholders
 		scores.append([])
 		models.append([])
-	images = getImages(loader_dir, image_paths, down_sample)
-
-	test_data = DeepSSMdataset(images, scores, models)
+	if shard_size:
+		shard_dir = loader_dir + 'test_shards/'
+		stats = writeShards(shard_dir, image_paths, scores, [None]*len(image_paths), down_sample, shard_size)
+		mean_image, std_image = getSavedImageStats(loader_dir, stats)
+		normalizeShards(shard_dir, mean_image, std_image)
+		test_data = DeepSSMShardedDataset(shard_dir)
+	else:
+		images = getImages(loader_dir, image_paths, down_sample)
+		test_data = DeepSSMdataset(images, scores, models)
 	# Write test names to file so they are saved somewhere
 	name_file = open(loader_dir + 'test_names.txt', 'w+')
 	name_file.write(str(test_names))
@@ -96,58 +183,53 @@ returns images, scores, models, prefixes from CSV
 def getAllTrainData(loader_dir, data_csv, down_sample):
 	# get all data and targets
 	print("Reading all data...")
-	image_paths = []
-	scores = []
-	models = []
-	prefixes = []
-	with open(data_csv, newline='') as csvfile:
-		datareader = csv.reader(csvfile)
-		index = 0
-		for row in datareader:
-			image_path = row[0]
-			model_path = row[1]
-			pca_scores = row[2:]
-			# add name
-			prefix = getPrefix(image_path)
-			# data error check
-			if prefix not in getPrefix(model_path):
-				print("Error: Images and models mismatched in csv.")
-				print(index)
-				print(prefix)
-				print(getPrefix(model_path))
-				exit()
-			prefixes.append(prefix)
-			# add image path
-			image_paths.append(image_path)
-			# add score (un-normalized)
-			pca_scores = [float(i) for i in pca_scores]
-			scores.append(pca_scores)
-			# add model
-			mdl = getParticles(model_path)
-			models.append(mdl)
-			index += 1
+	image_paths, scores, model_paths, prefixes = readTrainCSV(data_csv)
+	models = [getParticles(model_path) for model_path in model_paths]
 	images = getImages(loader_dir, image_paths, down_sample)
 	scores = whitenPCAscores(scores, loader_dir)
 	return images, scores, models, prefixes 
 
+'''
+returns image paths, scores (un-normalized), model paths and prefixes from CSV
+when data augmentation wrote a sidecar next to the CSV the scores are loaded from it as one array (see DataAugmentationUtils.Utils.read_CSV)
+'''
+def readTrainCSV(data_csv):
+	image_paths, model_paths, scores = AugmentationUtils.read_CSV(data_csv)
+	prefixes = []
+	for index in range(len(image_paths)):
+		# add name
+		prefix = getPrefix(image_paths[index])
+		# data error check
+		if prefix not in getPrefix(model_paths[index]):
+			print("Error: Images and models mismatched in csv.")
+			print(index)
+			print(prefix)
+			print(getPrefix(model_paths[index]))
+			exit()
+		prefixes.append(prefix)
+	return image_paths, list(scores), model_paths, prefixes
+
 '''
 Shuffle all data
+	shuffles in place with the same permutation so the image array is not copied
 '''
 def shuffleData(images, scores, models, prefixes):
 	print("Shuffling.")
-	c = list(zip(images, scores, models, prefixes))
-	random.shuffle(c)
-	images, scores, models, prefixes = zip(*c)
+	state = np.random.get_state()
+	for data in [images, scores, models, prefixes]:
+		np.random.set_state(state)
+		np.random.shuffle(data)
 	return images, scores, models, prefixes
 
 '''
 Class for DeepSSM datasets that works with Pytorch DataLoader
+	the tensors share memory with float32 arrays instead of copying them
 '''
 class DeepSSMdataset():
 	def __init__(self, img, pca_target, mdl_target):
-		self.img = torch.FloatTensor(img)
-		self.pca_target = torch.FloatTensor(pca_target)
-		self.mdl_target = torch.FloatTensor(mdl_target)
+		self.img = torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32))
+		self.pca_target = torch.from_numpy(np.ascontiguousarray(pca_target, dtype=np.float32))
+		self.mdl_target = torch.from_numpy(np.ascontiguousarray(mdl_target, dtype=np.float32))
 	def __getitem__(self, index):
 		x = self.img[index]
 		y1 = self.pca_target[index]
@@ -156,6 +238,108 @@ class DeepSSMdataset():
 	def __len__(self):
 		return len(self.img)
 
+'''
+Class for DeepSSM datasets stored in memory-mapped shards on disk that works with Pytorch DataLoader
+	only the shard index is pickled with the DataLoader, samples are read lazily from the shards
+'''
+class DeepSSMShardedDataset():
+	def __init__(self, shard_dir):
+		self.shard_dir = os.path.abspath(shard_dir) + '/'
+		with open(self.shard_dir + 'index.json') as json_file:
+			self.index = json.load(json_file)
+		self.offsets = np.cumsum([0] + [shard['count'] for shard in self.index['shards']])
+		self.shards = {}
+	def __getstate__(self):
+		# open memory maps are not pickled, they get reopened by each loader worker
+		state = self.__dict__.copy()
+		state['shards'] = {}
+		return state
+	def getShard(self, shard_index):
+		if shard_index not in self.shards:
+			name = self.shard_dir + self.index['shards'][shard_index]['name']
+			arrays = []
+			for suffix in ['_img.npy', '_pca.npy', '_mdl.npy']:
+				# memory-map unless the array is empty (e.g. test labels)
+				mmap_mode = None if self.index['sizes'][suffix] == 0 else 'r'
+				arrays.append(np.load(name + suffix, mmap_mode=mmap_mode))
+			self.shards[shard_index] = arrays
+		return self.shards[shard_index]
+	def __getitem__(self, index):
+		shard_index = int(np.searchsorted(self.offsets, index, side='right')) - 1
+		local_index = index - self.offsets[shard_index]
+		img, pca, mdl = self.getShard(shard_index)
+		x = torch.from_numpy(np.array(img[local_index]))
+		y1 = torch.from_numpy(np.array(pca[local_index]))
+		y2 = torch.from_numpy(np.array(mdl[local_index]))
+		return x, y1, y2
+	def __len__(self):
+		return int(self.offsets[-1])
+
+'''
+getTorchDataLoaderHelper
+writes images, scores and models to fixed-shape float32 shards of shard_size samples
+model_paths entries are None for unlabeled (test) data
+images are written as read, returns their stats so the shards can be normalized afterwards with normalizeShards
+the images of all shards are read with pool (see getReadPool), or with a pool opened for them if it is None
+'''
+def writeShards(shard_dir, image_paths, scores, model_paths, down_sample, shard_size, pool=None):
+	if not os.path.exists(shard_dir):
+		os.makedirs(shard_dir)
+	shards = []
+	image_shape = None
+	stats = None
+	own_pool = pool is None
+	if own_pool:
+		pool = getReadPool(len(image_paths))
+	try:
+		for start in range(0, len(image_paths), shard_size):
+			end = min(start + shard_size, len(image_paths))
+			name = 'shard_' + str(len(shards)).zfill(4)
+			img_shard, shard_stats = readImages(image_paths[start:end], down_sample, out_path=shard_dir + name + '_img.npy', pool=pool)
+			if image_shape is None:
+				image_shape = img_shard.shape[2:]
+			elif img_shard.shape[2:] != image_shape:
+				print("Error: All images must be the same size to be written to shards.")
+				print(image_paths[start])
+				exit()
+			img_shard.flush()
+			del img_shard
+			stats = AugmentationUtils.combine_stats(stats, shard_stats)
+			np.save(shard_dir + name + '_pca.npy', np.array(scores[start:end], dtype=np.float32))
+			models = [[] if model_path is None else getParticles(model_path) for model_path in model_paths[start:end]]
+			models = np.array(models, dtype=np.float32)
+			np.save(shard_dir + name + '_mdl.npy', models)
+			shards.append({'name': name, 'count': end-start})
+			print("Wrote " + name + " (" + str(end) + "/" + str(len(image_paths)) + ")")
+	finally:
+		if own_pool and pool is not None:
+			pool.terminate()
+	index = {
+		'shards': shards,
+		'image_shape': list(image_shape) if image_shape else [],
+		'sizes': {
+			'_img.npy': int(np.prod(image_shape)) if image_shape else 0,
+			'_pca.npy': len(scores[0]) if scores else 0,
+			'_mdl.npy': int(models[0].size) if shards else 0
+		}
+	}
+	with open(shard_dir + 'index.json', 'w') as json_file:
+		json.dump(index, json_file)
+	return stats
+
+'''
+getTorchDataLoaderHelper
+whitens the images in the shards of shard_dir in place
+'''
+def normalizeShards(shard_dir, mean_image, std_image):
+	with open(shard_dir + 'index.json') as json_file:
+		shards = json.load(json_file)['shards']
+	for shard in shards:
+		img_shard = np.load(shard_dir + shard['name'] + '_img.npy', mmap_mode='r+')
+		normalizeImages(img_shard, mean_image, std_image)
+		img_shard.flush()
+		del img_shard
+
 '''
 getTorchDataLoaderHelper
 returns sample prefix from path string
@@ -181,65 +365,142 @@ def getParticles(model_path):
 
 '''
 getTorchDataLoaderHelper
-reads .nrrd files and returns whitened data
-'''
-def getImages(loader_dir, image_list, down_sample):
-	# get all images
-	all_images = []
-	for image_path in image_list:
-		if down_sample:
-			img = downSample(image_path)
+reads .nrrd files and returns whitened data as one (N, 1, D, H, W) float32 array
+'''
+def getImages(loader_dir, image_list, down_sample, processes=None):
+	images, stats = readImages(image_list, down_sample, processes)
+	mean_image, std_image = getSavedImageStats(loader_dir, stats)
+	normalizeImages(images, mean_image, std_image)
+	return images
+
+'''
+getTorchDataLoaderHelper
+returns a pool of processes to read image_count images with, or None if they are read in this process
+'''
+def getReadPool(image_count, processes=None):
+	if processes is None:
+		processes = os.cpu_count()
+	processes = max(1, min(processes, image_count))
+	return mtps.Pool(processes=processes) if processes != 1 else None
+
+'''
+getTorchDataLoaderHelper
+reads .nrrd files with a pool of processes, streaming them into one preallocated (N, 1, D, H, W) float32 array
+	if out_path is given the array is a memory-mapped .npy file at that path
+	pool is used instead of opening a pool if given (see getReadPool)
+	returns the array and the (count, mean, M2) stats of all voxels for getSavedImageStats, the stats are None if there are no images
+'''
+def readImages(image_list, down_sample, processes=None, out_path=None, pool=None):
+	if len(image_list) == 0:
+		return np.empty((0, 1), dtype=np.float32), None
+	t0 = time.time()
+	images = None
+	stats = None
+	params = [(image_path, down_sample) for image_path in image_list]
+	own_pool = pool is None
+	if own_pool:
+		pool = getReadPool(len(image_list), processes)
+	try:
+		if pool is None:
+			results = map(readImageWithStats, params)
 		else:
-			image = itk.imread(image_path, itk.F)
-			img = itk.GetArrayFromImage(image)
-		all_images.append(img)
-	all_images = np.array(all_images)
-	# get mean and std
+			workers = processes or os.cpu_count()
+			results = pool.imap(readImageWithStats, params, chunksize=max(1, len(params)//(4*workers)))
+		for index, (img, img_stats) in enumerate(results):
+			if images is None:
+				shape = (len(image_list), 1) + img.shape
+				if out_path is None:
+					images = np.empty(shape, dtype=np.float32)
+				else:
+					images = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=shape)
+			elif img.shape != images.shape[2:]:
+				print("Error: All images must be the same size.")
+				print(image_list[index])
+				exit()
+			images[index, 0] = img
+			stats = AugmentationUtils.combine_stats(stats, img_stats)
+	finally:
+		if own_pool and pool is not None:
+			pool.terminate()
+	seconds = max(time.time() - t0, 1e-6)
+	print("Read " + str(len(image_list)) + " images in " + '%.1f' % seconds + " seconds (" 
+		+ '%.1f' % (len(image_list)/seconds) + " images/s, " + '%.1f' % (images.nbytes/seconds/1e6) + " MB/s)")
+	return images, stats
+
+'''
+getTorchDataLoaderHelper
+reads one image and computes its stats (see DataAugmentationUtils.Utils.get_image_stats)
+'''
+def readImageWithStats(params):
+	image_path, down_sample = params
+	img = np.asarray(loadImage(image_path, down_sample), dtype=np.float32)
+	return img, AugmentationUtils.get_image_stats(img)
+
+'''
+getTorchDataLoaderHelper
+returns the saved image mean and std, or saves the ones from the given (count, mean, M2) stats if there are none yet
+	without saved stats or images (stats is None) there is nothing to whiten, so 0 and 1 are returned and nothing is saved
+'''
+def getSavedImageStats(loader_dir, stats):
 	mean_path = loader_dir + 'mean_img.npy'
 	std_path = loader_dir + 'std_img.npy'
-	if not os.path.exists(mean_path) or not os.path.exists(std_path):
-		mean_image = np.mean(all_images)
-		std_image = np.std(all_images)
-		np.save(mean_path, mean_image)
-		np.save(std_path, std_image)
-	else:
-		mean_image = np.load(mean_path)
-		std_image = np.load(std_path)
-	# normlaize
-	norm_images = []
-	for image in all_images:
-		norm_images.append([(image-mean_image)/std_image])
-	return norm_images
+	if os.path.exists(mean_path) and os.path.exists(std_path):
+		return np.load(mean_path), np.load(std_path)
+	if stats is None:
+		return np.float64(0), np.float64(1)
+	count, mean_image, M2 = stats
+	std_image = np.sqrt(M2/count)
+	np.save(mean_path, mean_image)
+	np.save(std_path, std_image)
+	writeMetadata(loader_dir, mean_img=float(mean_image), std_img=float(std_image))
+	return mean_image, std_image
+
+'''
+getTorchDataLoaderHelper
+whitens images in place one image at a time
+'''
+def normalizeImages(images, mean_image, std_image):
+	mean_image = np.float32(mean_image)
+	std_image = np.float32(std_image)
+	for index in range(images.shape[0]):
+		images[index] -= mean_image
+		images[index] /= std_image
+
+'''
+getTorchDataLoaderHelper
+reads a single .nrrd file as an array
+down_sample can be True to downsample to 3/4 of the original size, or a scale factor
+'''
+def loadImage(image_path, down_sample):
+	if down_sample:
+		scale = 0.75 if isinstance(down_sample, (bool, np.bool_)) else float(down_sample)
+		return downSample(image_path, scale)
+	image = itk.imread(image_path, itk.F)
+	return itk.GetArrayFromImage(image)
+
+'''
+getTorchDataLoaderHelper
+adds values to the metadata file which holds the normalization stats of the loaders
+'''
+def writeMetadata(loader_dir, **values):
+	metadata_path = loader_dir + 'metadata.json'
+	metadata = {}
+	if os.path.exists(metadata_path):
+		with open(metadata_path) as json_file:
+			metadata = json.load(json_file)
+	metadata.update(values)
+	with open(metadata_path, 'w') as json_file:
+		json.dump(metadata, json_file, indent=4)
 
 '''
-Decreases the size of the image to 3/4 it's original size
-'''
-def downSample(image_path):
-	path = os.path.dirname(image_path)
-	temp_path = path + "/temp.nrrd"
-	cmd = ["shapeworks",
-		   "read-image", "--name", image_path,
-		   "image-info", "--size", str(True)]
-	output = subprocess.run(cmd, capture_output=True, text=True).stdout.splitlines()
-	size = makeVector(output[0].split(":")[1])
-	sizex = int(3*size[0]/4)
-	sizey = int(3*size[1]/4)
-	sizez = int(3*size[2]/4)
-	cmd = ["shapeworks", 
-		"read-image", "--name", image_path,
-		"resize", "--sizex", str(sizex),
-		"--sizey", str(sizey),
-		"--sizez", str(sizez),
-		"write-image", "--name", temp_path]
-	subprocess.check_call(cmd)
-	image = itk.imread(temp_path, itk.F)
-	img = itk.GetArrayFromImage(image)
-	os.remove(temp_path)
-	return img
- 
-def makeVector(str):
-   arr = np.array(str.replace("[", "").replace("]", "").split(","))
-   return np.asarray(arr, np.float64)
+Decreases the size of the image to scale (3/4 by default) of its original size
+	resizes in-process using the shapeworks Python bindings so it is safe to call from worker processes
+'''
+def downSample(image_path, scale=0.75):
+	image = Image(image_path)
+	dims = image.dims()
+	image.resize([max(1, int(scale*dims[0])), max(1, int(scale*dims[1])), max(1, int(scale*dims[2]))])
+	return image.toArray()
 
 '''
 getTorchDataLoaderHelper
@@ -251,7 +512,5 @@ def whitenPCAscores(scores, loader_dir):
 	std_score = np.std(scores, axis=0)
 	np.save(loader_dir + 'mean_PCA.npy', mean_score)
 	np.save(loader_dir + 'std_PCA.npy', std_score)
-	norm_scores = []
-	for score in scores:
-		norm_scores.append((score-mean_score)/std_score)
-	return norm_scores
\ No newline at end of file
+	writeMetadata(loader_dir, mean_PCA=mean_score.tolist(), std_PCA=std_score.tolist())
+	return list((scores-mean_score)/std_score)
\ No newline at end of file
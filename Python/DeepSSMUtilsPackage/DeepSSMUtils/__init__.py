@@ -3,28 +3,37 @@ from DeepSSMUtils import DeepSSM
 from DeepSSMUtils import Analyze
 import torch
 
-def getTrainValLoaders(loader_dir, aug_data_csv, batch_size=1, down_sample=False):
-	testPytorch()
-	TorchLoaders.getTrainValLoaders(loader_dir, aug_data_csv, batch_size, down_sample)
+def getTrainValLoaders(loader_dir, aug_data_csv, batch_size=1, down_sample=False, shard_size=0):
+	testPytorch(require_gpu=False)
+	TorchLoaders.getTrainValLoaders(loader_dir, aug_data_csv, batch_size, down_sample, shard_size)
 
-def getTestLoader(loader_dir, test_img_list, down_sample=False):
-	testPytorch()
-	TorchLoaders.getTestLoader(loader_dir, test_img_list, down_sample)
+def getOnlineTrainValLoaders(loader_dir, train_data, val_data, batch_size=1, num_workers=8):
+	testPytorch(require_gpu=False)
+	return TorchLoaders.getOnlineTrainValLoaders(loader_dir, train_data, val_data, batch_size, num_workers)
+
+def getTestLoader(loader_dir, test_img_list, down_sample=False, shard_size=0):
+	testPytorch(require_gpu=False)
+	TorchLoaders.getTestLoader(loader_dir, test_img_list, down_sample, shard_size)
 
 def trainDeepSSM(loader_dir, parameters, parent_dir):
-	testPytorch()
+	# explicitly setting the device allows training on the CPU
+	testPytorch(require_gpu=('device' not in parameters))
 	return DeepSSM.train(loader_dir, parameters, parent_dir)
 
-def testDeepSSM(out_dir, model_path, loader_dir, PCA_scores_path, num_PCA):
-	testPytorch()
-	DeepSSM.test(out_dir, model_path, loader_dir, PCA_scores_path, num_PCA)
+def testDeepSSM(out_dir, model_path, loader_dir, PCA_scores_path, num_PCA, batch_size=32, device=None):
+	testPytorch(require_gpu=(device is None))
+	DeepSSM.test(out_dir, model_path, loader_dir, PCA_scores_path, num_PCA, batch_size, device)
 	return
 
+def predictDeepSSM(model_path, images, loader_dir, PCA_scores_path, num_PCA, batch_size=32, device=None, out_dir=None, names=None):
+	testPytorch(require_gpu=(device is None))
+	return DeepSSM.predict(model_path, images, loader_dir, PCA_scores_path, num_PCA, batch_size, device, out_dir, names)
+
 def analyzeResults(out_dir, DT_dir, prediction_dir, mean_prefix):
 	avg_distance = Analyze.getDistance(out_dir, DT_dir, prediction_dir, mean_prefix)
 	return avg_distance
 
-def testPytorch():
+def testPytorch(require_gpu=True):
 	if torch.cuda.is_available():
 		print("Running on GPU.")
 	else:
@@ -33,5 +42,7 @@ def testPytorch():
 		print("This will be very slow. If your machine has a GPU,") 
 		print("please reinstall Pytorch to your shapeworks conda ")
 		print("environment with the correct CUDA version.")
+		print("To train on the CPU anyway, set parameters['device'] = 'cpu'.")
 		print("**********************************************************")
-		exit()
\ No newline at end of file
+		if require_gpu:
+			exit()
\ No newline at end of file
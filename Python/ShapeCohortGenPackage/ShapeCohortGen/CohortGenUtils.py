@@ -3,6 +3,8 @@ import itk
 import numpy as np
 import scipy
 import shutil
+import multiprocessing as mtps
+from multiprocessing.pool import ThreadPool
 from shapeworks import *
 
 '''
@@ -50,74 +52,128 @@ def rename(inname, outDir, extension_addition, extension_change=''):
 		outname = outname.replace(current_extension, extension_change)
 	return outname
 
+'''
+Returns the seed sequence of seed (an int, a SeedSequence or None)
+with None the seed is drawn from the global numpy random state, so np.random.seed still reproduces the results
+'''
+def get_seed_sequence(seed):
+	if isinstance(seed, np.random.SeedSequence):
+		return seed
+	if seed is None:
+		seed = int(np.random.randint(2**31))
+	return np.random.SeedSequence(seed)
+
+'''
+Returns num independent seed sequences derived from seed (see get_seed_sequence)
+each sample gets its own so the results do not depend on the number of processes
+'''
+def spawn_seeds(seed, num):
+	return get_seed_sequence(seed).spawn(num)
+
+'''
+Runs function on each task, in a pool of processes (or threads) if processes is not 1, and returns the results in order
+progress(completed, total) is called as each task finishes, by default the progress is printed
+'''
+def run_tasks(function, tasks, processes=1, progress=None, name="sample", threads=False):
+	results = []
+	if processes == 1:
+		pool = None
+	elif threads:
+		pool = ThreadPool(processes)
+	else:
+		pool = mtps.Pool(processes=processes)
+	try:
+		iterator = map(function, tasks) if pool is None else pool.imap(function, tasks)
+		for result in iterator:
+			results.append(result)
+			if progress is None:
+				print("Generated " + name + " " + str(len(results)) + " out of " + str(len(tasks)))
+			else:
+				progress(len(results), len(tasks))
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return results
+
 '''
 Generate segmentations form mesh liost
 '''
-def generate_segmentations(meshList, out_dir, randomize_size, spacing, allow_on_boundary):
+def generate_segmentations(meshList, out_dir, randomize_size, spacing, allow_on_boundary, processes=1, seed=None, progress=None):
 	segDir = out_dir + "segmentations/"
 	make_dir(segDir)
 	PLYmeshList = get_file_with_ext(meshList,'ply')
-	# get dims tht fit all meshes
-	bb = MeshUtils.boundingBox(PLYmeshList)
+	# read each mesh once, the bounding box that fits all meshes is found while reading
+	meshes, bb = MeshUtils.readMeshes(PLYmeshList)
 	fit_all_origin = [bb.min[0], bb.min[1], bb.min[2]]
 	bb_dims = bb.max-bb.min
 	fit_all_dims = [bb_dims[0], bb_dims[1], bb_dims[2]]
 	# randomly select 20% meshes for boundary touching samples
 	numMeshes = len(PLYmeshList)
+	seeds = spawn_seeds(seed, numMeshes + 1)
 	meshIndexArray = np.array(list(range(numMeshes)))
 	subSampleSize = int(0.2*numMeshes)
-	randomBoundarySamples = np.random.choice(meshIndexArray,subSampleSize,replace=False)
-	# loop through meshes and turn to images
-	segList = []
-	meshIndex = 0
-	for mesh_ in PLYmeshList:
-		print("Generating seg " + str(meshIndex + 1) + " out of " + str(len(PLYmeshList)))
+	randomBoundarySamples = np.random.default_rng(seeds[0]).choice(meshIndexArray,subSampleSize,replace=False)
+	# turn meshes to images, rasterizing and writing release the GIL so the meshes are shared by worker threads
+	tasks = []
+	for meshIndex, mesh_ in enumerate(PLYmeshList):
 		segFile = rename(mesh_, segDir, "", ".nrrd")
-		segList.append(segFile)
-		mesh = Mesh(mesh_)
-		# If the meshIndex is in the randomly selected samples, get the origin and size 
-		# of that mesh so that the segmentation image touch the boundary
-		if allow_on_boundary and (meshIndex in randomBoundarySamples):
-			bb = mesh.boundingBox()
-			origin = [bb.min[0], bb.min[1], bb.min[2]]
-			dims = [bb.max[0]*2, bb.max[1]*2, bb.max[2]*2]
-			pad = np.zeros(3)
+		on_boundary = allow_on_boundary and (meshIndex in randomBoundarySamples)
+		tasks.append((meshes[meshIndex], segFile, on_boundary, fit_all_origin, fit_all_dims, randomize_size, spacing, seeds[meshIndex + 1]))
+	return run_tasks(generate_segmentation, tasks, processes, progress, "seg", threads=True)
+
+'''
+generate_segmentations helper, turns one mesh to a segmentation
+'''
+def generate_segmentation(task):
+	mesh, segFile, on_boundary, origin, dims, randomize_size, spacing, seed = task
+	rng = np.random.default_rng(seed)
+	# If the mesh is in the randomly selected samples, get the origin and size
+	# of that mesh so that the segmentation image touch the boundary
+	if on_boundary:
+		bb = mesh.boundingBox()
+		origin = [bb.min[0], bb.min[1], bb.min[2]]
+		dims = [bb.max[0]*2, bb.max[1]*2, bb.max[2]*2]
+		pad = np.zeros(3)
+	else:
+		# If randomize size, add random padding to x, y, and z dims
+		if randomize_size:
+			pad = rng.integers(5, high=15, size=3)
 		else:
-			origin = fit_all_origin
-			dims = fit_all_dims
-			# If randomize size, add random padding to x, y, and z dims
-			if randomize_size:
-				pad = np.random.randint(5, high=15, size=3)
-			else:
-				pad = np.full(3, 5)
-		origin = list(np.array(origin) - pad)
-		dims = list((np.array(dims) + (2*pad)).astype(int))
-		image = mesh.toImage(spacing, dims, origin)
-		image.write(segFile, 0)
-		meshIndex += 1
-	return segList
+			pad = np.full(3, 5)
+	origin = list(np.array(origin) - pad)
+	dims = list((np.array(dims) + (2*pad)).astype(int))
+	image = mesh.toImage(spacing, dims, origin)
+	image.write(segFile, 0)
+	return segFile
 
 '''
 Generates image by blurring and adding noise to segmentation
+block_size is the number of slices the noise is added to at a time (0 for the whole volume)
 '''
-def generate_images(segs, outDir, blur_factor, foreground_mean, foreground_var, background_mean, background_var):
+def generate_images(segs, outDir, blur_factor, foreground_mean, foreground_var, background_mean, background_var, processes=1, seed=None, progress=None, block_size=0):
 	imgDir = outDir + 'images/'
 	make_dir(imgDir)
-	index = 1
-	for seg in segs:
-		print("Generating image " + str(index) + " out of " + str(len(segs)))
-		name = seg.replace('segmentations/','images/').replace('_seg.nrrd', '_blur' + str(blur_factor) + '.nrrd')
-		itk_bin = itk.imread(seg, itk.F)
-		img_array = itk.array_from_image(itk_bin)
-		img_array = blur(img_array, blur_factor)
-		img_array = apply_noise(img_array, foreground_mean, foreground_var, background_mean, background_var)
-		img_array = np.float32(img_array)
-		itk_img_view = itk.image_view_from_array(img_array)
-		itk_img_view.SetOrigin(itk_bin.GetOrigin())
-		itk.imwrite(itk_img_view, name)
-		index += 1
+	seeds = spawn_seeds(seed, len(segs))
+	tasks = [(seg, blur_factor, foreground_mean, foreground_var, background_mean, background_var, block_size, seeds[index]) for index, seg in enumerate(segs)]
+	run_tasks(generate_image, tasks, processes, progress, "image")
 	return get_files(imgDir)
 
+'''
+generate_images helper, blurs and adds noise to one segmentation
+'''
+def generate_image(task):
+	seg, blur_factor, foreground_mean, foreground_var, background_mean, background_var, block_size, seed = task
+	name = seg.replace('segmentations/','images/').replace('_seg.nrrd', '_blur' + str(blur_factor) + '.nrrd')
+	itk_bin = itk.imread(seg, itk.F)
+	img_array = itk.array_from_image(itk_bin)
+	img_array = blur(img_array, blur_factor)
+	img_array = apply_noise(img_array, foreground_mean, foreground_var, background_mean, background_var, np.random.default_rng(seed), block_size)
+	itk_img_view = itk.image_view_from_array(img_array)
+	itk_img_view.SetOrigin(itk_bin.GetOrigin())
+	itk.imwrite(itk_img_view, name)
+	return name
+
 '''
 get_image helper
 '''
@@ -128,14 +184,22 @@ def blur(img, size):
 '''
 get_image helper
 '''
-def apply_noise(img, foreground_mean, foreground_var, background_mean, background_var):
-	background_indices = np.where(img < 0.5)
-	foreground_indices = np.where(img > 0.5)
-	img = img*(foreground_mean-background_mean)
-	img = img + np.ones(img.shape)*background_mean
-	foreground_noise = np.random.normal(0, foreground_var**0.5, img.shape)
-	foreground_noise[background_indices] = 0
-	background_noise = np.random.normal(0, background_var**0.5, img.shape)
-	background_noise[foreground_indices] = 0
-	noisy_img = img + foreground_noise + background_noise
-	return noisy_img
\ No newline at end of file
+def apply_noise(img, foreground_mean, foreground_var, background_mean, background_var, rng=None, block_size=0):
+	# works in float32, in place when img already is float32
+	img = np.asarray(img, dtype=np.float32)
+	if rng is None:
+		rng = np.random.default_rng()
+	foreground_std = np.float32(foreground_var**0.5)
+	background_std = np.float32(background_var**0.5)
+	# block_size slices at a time, or the whole volume
+	step = block_size if block_size > 0 else max(img.shape[0], 1)
+	for start in range(0, img.shape[0], step):
+		block = img[start:start+step]
+		foreground = block > 0.5
+		background = block < 0.5
+		block *= np.float32(foreground_mean-background_mean)
+		block += np.float32(background_mean)
+		# noise is only drawn for the voxels it is added to
+		block[foreground] += foreground_std * rng.standard_normal(np.count_nonzero(foreground), dtype=np.float32)
+		block[background] += background_std * rng.standard_normal(np.count_nonzero(background), dtype=np.float32)
+	return img
@@ -1,8 +1,19 @@
+import numpy as np
 from ShapeCohortGen import Supershapes,Ellipsoids,CohortGenUtils
 
+'''
+Base cohort generator
+- processes = number of processes each generation step is split between
+- seed = seeds every generation step, so a cohort is reproduced by the same seed and calls whatever the number of processes
+  if seed is None it is drawn from the global numpy random state, so np.random.seed also reproduces the cohort
+- progress = called as progress(completed, total) as each sample of a step finishes, by default the progress is printed
+'''
 class CohortGenerator():
-	def __init__(self,out_dir):
+	def __init__(self,out_dir, processes=1, seed=None, progress=None):
 		self.out_dir = out_dir
+		self.processes = processes
+		self.seed_sequence = CohortGenUtils.get_seed_sequence(seed)
+		self.progress = progress
 		self.meshes = []
 		self.segs = []
 		self.images = []
@@ -10,25 +21,30 @@ class CohortGenerator():
 		if not self.meshes:
 			print("Error: No meshes have been generated to get segmentations from.\n Call 'generate' first.")
 			return
-		self.segs = CohortGenUtils.generate_segmentations(self.meshes, self.out_dir, randomize_size, spacing, allow_on_boundary)
+		self.segs = CohortGenUtils.generate_segmentations(self.meshes, self.out_dir, randomize_size, spacing, allow_on_boundary, self.processes, self.next_seed(), self.progress)
 		return self.segs
-	def generate_images(self, blur_factor=1, foreground_mean=180, foreground_var=30, background_mean=80, background_var=30):
+	# block_size is the number of slices noise is added to at a time, 0 for the whole volume
+	def generate_images(self, blur_factor=1, foreground_mean=180, foreground_var=30, background_mean=80, background_var=30, block_size=0):
 		if not self.segs:
 			print("Error: No segmentations have been generated to get images from.\n Call 'generate_segmentations' first.")
 			return
-		self.images = CohortGenUtils.generate_images(self.segs, self.out_dir, blur_factor, foreground_mean, foreground_var, background_mean, background_var)
+		self.images = CohortGenUtils.generate_images(self.segs, self.out_dir, blur_factor, foreground_mean, foreground_var, background_mean, background_var, self.processes, self.next_seed(), self.progress, block_size)
 		return self.images
+	# seed sequence of the next generation step
+	def next_seed(self):
+		return self.seed_sequence.spawn(1)[0]
 
 class EllipsoidCohortGenerator(CohortGenerator):
-	def __init__(self,out_dir):
-		super().__init__(out_dir)
+	def __init__(self,out_dir, processes=1, seed=None, progress=None):
+		super().__init__(out_dir, processes, seed, progress)
 	def generate(self, num_samples=3, randomize_center=True, randomize_rotation=True):
-		self.meshes = Ellipsoids.generate(num_samples, self.out_dir, randomize_center, randomize_rotation)
+		self.meshes = Ellipsoids.generate(num_samples, self.out_dir, randomize_center, randomize_rotation, self.processes, self.next_seed(), self.progress)
 		return self.meshes
 
 class SupershapesCohortGenerator(CohortGenerator):
-	def __init__(self, out_dir):
-		super().__init__(out_dir)
-	def generate(self, num_samples=3, randomize_center=True, randomize_rotation=True, m=3, start_id=0, size=20):
-		self.meshes = Supershapes.generate(num_samples, self.out_dir, randomize_center, randomize_rotation, m, start_id, size)
+	def __init__(self, out_dir, processes=1, seed=None, progress=None):
+		super().__init__(out_dir, processes, seed, progress)
+	# resolution is the number of grid points per angle the super formula is evaluated on
+	def generate(self, num_samples=3, randomize_center=True, randomize_rotation=True, m=3, start_id=0, size=20, resolution=316):
+		self.meshes = Supershapes.generate(num_samples, self.out_dir, randomize_center, randomize_rotation, m, start_id, size, self.processes, self.next_seed(), self.progress, resolution)
 		return self.meshes
\ No newline at end of file
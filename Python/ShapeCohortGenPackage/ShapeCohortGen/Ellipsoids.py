@@ -35,20 +35,22 @@ def addEllipsoid(center, radii, rotation, resolution=24):
 
 	return translateFilter
 
-def generate_ellipsoids(filename, meshDir, randomize_center, randomize_rotation):
+def generate_ellipsoids(filename, meshDir, randomize_center, randomize_rotation, rng=None):
+	if rng is None:
+		rng = np.random.default_rng()
 	vtkFileName = meshDir+"ellipsoid_"+filename+".vtk"
 	plyFileName = meshDir+"ellipsoid_"+filename+".ply"
 	if randomize_center:
-		center_loc = list(np.random.randint(low = 0,high=50,size=3))
+		center_loc = list(rng.integers(low = 0,high=50,size=3))
 	else:
 		center_loc = [0,0,0]
-	x_radius = np.random.randint(low =15,high=25,size =1)
-	y_radius = np.random.randint(low =5,high=15,size =1)
-	z_radius = np.random.randint(low =5,high=15,size =1)
+	x_radius = rng.integers(low =15,high=25,size =1)
+	y_radius = rng.integers(low =5,high=15,size =1)
+	z_radius = rng.integers(low =5,high=15,size =1)
 
 	radii = [x_radius[0],y_radius[0],z_radius[0]]
 	if randomize_rotation:
-		rotation = np.random.randint(low=0,high=180,size=1)[0]
+		rotation = rng.integers(low=0,high=180,size=1)[0]
 	else:
 		rotation = 0
 	ellipsoid = addEllipsoid(center_loc,radii,rotation)
@@ -63,11 +65,15 @@ def generate_ellipsoids(filename, meshDir, randomize_center, randomize_rotation)
 	vtk_writer.SetFileName(vtkFileName)
 	vtk_writer.Update()
 	
+# generate helper, task is (filename, meshDir, randomize_center, randomize_rotation, seed)
+def generate_ellipsoids_task(task):
+	filename, meshDir, randomize_center, randomize_rotation, seed = task
+	generate_ellipsoids(filename, meshDir, randomize_center, randomize_rotation, np.random.default_rng(seed))
 
-def generate(num_samples,out_dir,randomize_center, randomize_rotation):
+def generate(num_samples,out_dir,randomize_center, randomize_rotation, processes=1, seed=None, progress=None):
 	meshDir = out_dir + "meshes/"
 	make_dir(meshDir)
-	for i in range(num_samples):
-		filename = str(i).zfill(2)
-		generate_ellipsoids(filename, meshDir, randomize_center, randomize_rotation)
+	seeds = spawn_seeds(seed, num_samples)
+	tasks = [(str(i).zfill(2), meshDir, randomize_center, randomize_rotation, seeds[i]) for i in range(num_samples)]
+	run_tasks(generate_ellipsoids_task, tasks, processes, progress, "ellipsoid")
 	return get_files(meshDir)
@@ -2,51 +2,61 @@ import os
 import math
 import trimesh
 import numpy as np
-import matplotlib.tri as mtri
-import subprocess
+import functools
 from ShapeCohortGen.CohortGenUtils import *
 
 '''
-Generates super shapes and saves PLY mesh form
+Generates super shapes and saves PLY and VTK mesh form
 '''
-def generate(num_samples, out_dir, randomize_center, randomize_rotation, m, start_id, size):
+def generate(num_samples, out_dir, randomize_center, randomize_rotation, m, start_id, size, processes=1, seed=None, progress=None, resolution=316):
     meshDir= out_dir + "meshes/"
     make_dir(meshDir)
-    for i in range(num_samples):
-        print("Generating shape " + str(i+1) + " out of " + str(num_samples))
-        name = "id" + get_id_str(i+start_id) + "_ss" + str(m)
-        # Define shape params
-        n1 = np.random.uniform(0.5,1.5)
-        n2 = np.random.uniform(0.5,1.5)
-        n3 = n2
-        a = 1
-        b = 1
-        X, Y, Z, triIndices = super_formula_3D(m, n1, n2, n3, a, b)
-       	verts = np.column_stack((X,Y,Z))
-        # Generate shape
-        shapeMesh = trimesh.Trimesh(vertices=verts, faces=triIndices)
-        # Apply transform
-        if randomize_center:
-            center_loc = list(np.random.randint(low = 0,high=30,size=3))
-        else:
-            center_loc = [0,0,0]
-        if randomize_rotation:
-            rotation = np.random.rand(3)
-        else:
-            rotation = np.zeros(3)
-        S = trimesh.transformations.scale_matrix(size, [0,0,0])
-        T = trimesh.transformations.translation_matrix(center_loc)
-        R = trimesh.transformations.random_rotation_matrix(rotation)
-        transform_matrix = trimesh.transformations.concatenate_matrices(T, R, S)
-        shapeMesh = shapeMesh.apply_transform(transform_matrix)
-        # Save mesh as ply
-        shapeMesh.export(meshDir + name + ".stl")
-        execCommand = ["stl2ply", meshDir + name + ".stl", meshDir + name + ".ply"]
-        subprocess.check_call(execCommand)
-        subprocess.check_call(["stl2vtk", meshDir + name + ".stl", meshDir + name + ".vtk"])
-        os.remove(meshDir + name + ".stl")
+    seeds = spawn_seeds(seed, num_samples)
+    tasks = [(meshDir, "id" + get_id_str(i+start_id) + "_ss" + str(m), randomize_center, randomize_rotation, m, size, resolution, seeds[i]) for i in range(num_samples)]
+    run_tasks(generate_supershape, tasks, processes, progress, "shape")
     return get_files(meshDir)
 
+'''
+generate helper, makes one super shape
+task is (meshDir, name, randomize_center, randomize_rotation, m, size, resolution, seed)
+'''
+def generate_supershape(task):
+    meshDir, name, randomize_center, randomize_rotation, m, size, resolution, seed = task
+    shapeMesh = make_supershape(np.random.default_rng(seed), randomize_center, randomize_rotation, m, size, resolution)
+    # Save mesh as ply and vtk
+    shapeMesh.export(meshDir + name + ".ply")
+    Mesh(meshDir + name + ".ply").write(meshDir + name + ".vtk")
+
+'''
+Returns a random super shape trimesh with m lobes drawn from the numpy Generator rng
+the shape is evaluated on a resolution x resolution grid
+'''
+def make_supershape(rng, randomize_center=True, randomize_rotation=True, m=3, size=20, resolution=316):
+    # Define shape params
+    n1 = rng.uniform(0.5,1.5)
+    n2 = rng.uniform(0.5,1.5)
+    n3 = n2
+    a = 1
+    b = 1
+    X, Y, Z, triIndices = super_formula_3D(m, n1, n2, n3, a, b, resolution)
+    verts = np.column_stack((X,Y,Z))
+    # Generate shape
+    shapeMesh = trimesh.Trimesh(vertices=verts, faces=triIndices)
+    # Apply transform
+    if randomize_center:
+        center_loc = list(rng.integers(low = 0,high=30,size=3))
+    else:
+        center_loc = [0,0,0]
+    if randomize_rotation:
+        rotation = rng.random(3)
+    else:
+        rotation = np.zeros(3)
+    S = trimesh.transformations.scale_matrix(size, [0,0,0])
+    T = trimesh.transformations.translation_matrix(center_loc)
+    R = trimesh.transformations.random_rotation_matrix(rotation)
+    transform_matrix = trimesh.transformations.concatenate_matrices(T, R, S)
+    return shapeMesh.apply_transform(transform_matrix)
+
 # Name helper
 def get_id_str(num):
 	string = str(num)
@@ -55,19 +65,31 @@ def get_id_str(num):
 	return(string)
 
 # Shape generation helper
-def super_formula_3D(m, n1, n2, n3, a, b, numPoints=100000):
-	numPointsRoot = round(math.sqrt(numPoints))
-	theta = np.linspace(-math.pi, math.pi, endpoint=True, num=numPointsRoot)
-	phi = np.linspace(-math.pi / 2.0, math.pi/2.0, endpoint=True, num=numPointsRoot)
-	theta, phi = np.meshgrid(theta, phi)
-	theta, phi = theta.flatten(), phi.flatten()
-	r1 = super_formula_2D(m, n1, n2, n3, a, b, theta)
-	r2 = super_formula_2D(m, n1, n2, n3, a, b, phi)
-	x = r1 * r2 * np.cos(theta) * np.cos(phi)
-	y = r1 * r2 * np.sin(theta) * np.cos(phi)
-	z = r2 * np.sin(phi)
-	tri = mtri.Triangulation(theta, phi)
-	return x, y, z, tri.triangles
+# evaluates the super formula on a resolution x resolution grid of (theta, phi), the faces are the shared grid topology
+def super_formula_3D(m, n1, n2, n3, a, b, resolution=316):
+    theta = np.linspace(-math.pi, math.pi, endpoint=True, num=resolution)
+    phi = np.linspace(-math.pi / 2.0, math.pi/2.0, endpoint=True, num=resolution)
+    # r1 only depends on theta and r2 on phi, so they are evaluated once per grid line
+    r1 = super_formula_2D(m, n1, n2, n3, a, b, theta)
+    r2 = super_formula_2D(m, n1, n2, n3, a, b, phi)
+    x = np.outer(r2 * np.cos(phi), r1 * np.cos(theta)).flatten()
+    y = np.outer(r2 * np.cos(phi), r1 * np.sin(theta)).flatten()
+    z = np.repeat(r2 * np.sin(phi), resolution)
+    return x, y, z, grid_triangles(resolution)
+
+# Shape generation helper
+# triangles of a resolution x resolution grid of points indexed row (phi) major, two counter clockwise triangles per cell
+# cached so all shapes of the same resolution share one index array
+@functools.lru_cache(maxsize=8)
+def grid_triangles(resolution):
+    index = np.arange(resolution * resolution).reshape(resolution, resolution)
+    a = index[:-1, :-1].flatten()
+    b = index[:-1, 1:].flatten()
+    c = index[1:, :-1].flatten()
+    d = index[1:, 1:].flatten()
+    triangles = np.concatenate((np.column_stack((a, b, d)), np.column_stack((a, d, c))))
+    triangles.flags.writeable = False
+    return triangles
 
 # Shape generation helper
 def super_formula_2D(m, n1, n2, n3, a, b, theta):
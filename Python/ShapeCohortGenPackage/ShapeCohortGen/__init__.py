@@ -4,8 +4,8 @@ from ShapeCohortGen import Ellipsoids
 from ShapeCohortGen import CohortGenUtils
 import os
 
-def EllipsoidCohortGenerator(out_dir=os.getcwd()+'/generated_ellipsoid_cohort/'):
-	return CohortGenerator.EllipsoidCohortGenerator(out_dir)
+def EllipsoidCohortGenerator(out_dir=os.getcwd()+'/generated_ellipsoid_cohort/', processes=1, seed=None, progress=None):
+	return CohortGenerator.EllipsoidCohortGenerator(out_dir, processes, seed, progress)
 
-def SupershapesCohortGenerator(out_dir=os.getcwd()+'/generated_supershapes_cohort/'):
-	return CohortGenerator.SupershapesCohortGenerator(out_dir)
\ No newline at end of file
+def SupershapesCohortGenerator(out_dir=os.getcwd()+'/generated_supershapes_cohort/', processes=1, seed=None, progress=None):
+	return CohortGenerator.SupershapesCohortGenerator(out_dir, processes, seed, progress)
\ No newline at end of file
@@ -371,7 +371,7 @@ PYBIND11_MODULE(shapeworks, m)
     return stream.str();
   })
   .def("copy",                  [](Image& image) { return Image(image); })
-  .def("write",                 &Image::write, "writes the current image (determines type by its extension)", "filename"_a, "compressed"_a=true)
+  .def("write",                 &Image::write, "writes the current image (determines type by its extension)", "filename"_a, "compressed"_a=true, py::call_guard<py::gil_scoped_release>())
   .def("antialias",             &Image::antialias, "antialiases binary volumes (layers is set to 3 when not specified)", "iterations"_a=50, "maxRMSErr"_a=0.01f, "layers"_a=3)
   .def("resample",              py::overload_cast<TransformPtr, Point3, Dims, Vector3, Image::ImageType::DirectionType, Image::InterpolationType>(&Image::resample), "resamples by applying transform then sampling from given origin along direction axes at spacing physical units per pixel for dims pixels using specified interpolator", "transform"_a, "origin"_a, "dims"_a, "spacing"_a, "direction"_a, "interp"_a=Image::InterpolationType::NearestNeighbor)
   .def("resample",              py::overload_cast<const Vector&, Image::InterpolationType>(&Image::resample), "resamples image using new physical spacing, updating logical dims to keep all image data for this spacing", "physicalSpacing"_a, "interp"_a=Image::InterpolationType::Linear)
@@ -521,6 +521,10 @@ PYBIND11_MODULE(shapeworks, m)
     auto xform_ptr = shapeworks::ImageUtils::createWarpTransform(source_landmarks, target_landmarks, stride);
     return xform_ptr;
   }, "computes a warp transform from the source to the target landmarks", "source_landmarks"_a, "target_landmarks"_a, "stride"_a=1)
+  .def_static("createWarpTransform", [](const Eigen::MatrixXd &source_landmarks, const Eigen::MatrixXd &target_landmarks, const int stride) {
+    auto xform_ptr = shapeworks::ImageUtils::createWarpTransform(source_landmarks, target_landmarks, stride);
+    return xform_ptr;
+  }, "computes a warp transform from the source to the target landmarks given as N x 3 arrays", "source_landmarks"_a, "target_landmarks"_a, "stride"_a=1)
   ;
 
   // Mesh
@@ -581,7 +585,8 @@ PYBIND11_MODULE(shapeworks, m)
          return mesh.toImage(makeVector({v[0], v[1], v[2]}), Dims({d[0], d[1], d[2]}), Point({p[0], p[1], p[2]}));
        },
        "rasterizes mesh to create binary images, automatically computing size and origin if necessary",
-       "spacing"_a=std::vector<double>({1.0, 1.0, 1.0}), "size"_a=std::vector<unsigned>({0, 0, 0}), "origin"_a=std::vector<double>({-1.0, -1.0, -1.0}))  
+       "spacing"_a=std::vector<double>({1.0, 1.0, 1.0}), "size"_a=std::vector<unsigned>({0, 0, 0}), "origin"_a=std::vector<double>({-1.0, -1.0, -1.0}),
+       py::call_guard<py::gil_scoped_release>())
   .def("distance",              &Mesh::distance, "computes surface to surface distance", "target"_a, "method"_a=Mesh::DistanceMethod::POINT_TO_POINT)
   .def("toDistanceTransform",
        [](Mesh& mesh, std::vector<double>& v, std::vector<unsigned>& d, std::vector<double>& p) -> decltype(auto) {
@@ -642,6 +647,19 @@ PYBIND11_MODULE(shapeworks, m)
   .def_static("boundingBox", [](std::vector<Mesh> meshes, bool center) {
     return shapeworks::MeshUtils::boundingBox(meshes, center);
   }, "calculate bounding box incrementally for shapework meshes", "meshes"_a, "center"_a=false)
+  .def_static("readMeshes", [](const std::vector<std::string> &filenames) {
+    Region bbox;
+    std::vector<Mesh> meshes;
+    {
+      py::gil_scoped_release release;
+      meshes = shapeworks::MeshUtils::readMeshes(filenames, bbox);
+    }
+    return py::make_tuple(std::move(meshes), bbox);
+  }, "reads the meshes in parallel, each file once, returns the meshes and their union bounding box", "filenames"_a)
+  .def_static("meshesToImages", [](const std::vector<std::string> &meshFilenames, const std::vector<std::string> &imageFilenames, std::vector<double> &v, bool compressed) {
+    return shapeworks::MeshUtils::meshesToImages(meshFilenames, imageFilenames, makeVector({v[0], v[1], v[2]}), compressed);
+  }, "rasterizes each mesh to a binary image in parallel, writing each image as soon as it is ready, returns the union bounding box of the meshes",
+  "meshFilenames"_a, "imageFilenames"_a, "spacing"_a=std::vector<double>({1.0, 1.0, 1.0}), "compressed"_a=true, py::call_guard<py::gil_scoped_release>())
   ;
 
   // ParticleSystem
@@ -357,3 +357,13 @@ TEST(pythonTests, optimizeTest)
 {
   ASSERT_FALSE(system("python optimize.py"));
 }
+
+TEST(pythonTests, deepssmResumeTest)
+{
+  ASSERT_FALSE(system("python deepssmResume.py"));
+}
+
+TEST(pythonTests, zipStreamTest)
+{
+  ASSERT_FALSE(system("python zipStream.py"));
+}
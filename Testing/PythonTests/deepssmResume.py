@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+# copy.py in this directory would shadow the standard library module torch imports
+sys.path = [path for path in sys.path if os.path.abspath(path or '.') != os.path.dirname(os.path.abspath(__file__))]
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from DeepSSMUtils import DeepSSM, TorchLoaders
+
+# smallest image the network accepts
+image_shape = (1, 76, 92, 100)
+
+def makeLoaders(loader_dir):
+  rng = np.random.default_rng(0)
+  for name, count in [("train", 4), ("validation", 2)]:
+    dataset = TorchLoaders.DeepSSMdataset(rng.random((count,) + image_shape, dtype=np.float32), rng.random((count, 3)), rng.random((count, 6)))
+    torch.save(DataLoader(dataset, batch_size=2, shuffle=True), loader_dir + name)
+
+class Interrupt(Exception):
+  pass
+
+def resumeTest():
+  loader_dir = tempfile.mkdtemp() + "/"
+  makeLoaders(loader_dir)
+  parameters = {"epochs": 3, "learning_rate": 0.001, "val_freq": 1, "device": "cpu"}
+
+  torch.manual_seed(0)
+  full_dir = tempfile.mkdtemp() + "/"
+  DeepSSM.train(loader_dir, parameters, full_dir)
+
+  # stop the same run during epoch 2, after the checkpoint of epoch 1 was written
+  log_print = DeepSSM.log_print
+  def interrupt(logger, values, echo=True):
+    if values[0] == 2:
+      raise Interrupt()
+    log_print(logger, values, echo)
+  DeepSSM.log_print = interrupt
+  torch.manual_seed(0)
+  resumed_dir = tempfile.mkdtemp() + "/"
+  try:
+    DeepSSM.train(loader_dir, parameters, resumed_dir)
+    return False
+  except Interrupt:
+    pass
+  finally:
+    DeepSSM.log_print = log_print
+  if not os.path.exists(resumed_dir + "checkpoint.torch"):
+    return False
+
+  # resuming continues with the same weights, optimizer and random streams as the uninterrupted run
+  DeepSSM.train(loader_dir, parameters, resumed_dir)
+  full_model = torch.load(full_dir + "final_model.torch")
+  resumed_model = torch.load(resumed_dir + "final_model.torch")
+  same_weights = all(torch.equal(full_model[key], resumed_model[key]) for key in full_model)
+  full_log = [line.split(",")[:-1] for line in open(full_dir + "train_log.csv")]
+  resumed_log = [line.split(",")[:-1] for line in open(resumed_dir + "train_log.csv")]
+  return same_weights and full_log == resumed_log
+
+val = resumeTest()
+
+if val is False:
+  sys.exit(1)
@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 from shapeworks import *
 
 def toImageTest():
@@ -14,3 +15,28 @@ val = toImageTest()
 
 if val is False:
   sys.exit(1)
+
+def meshesToImagesTest():
+  meshFiles = [os.environ["DATA"] + "/femur.ply", os.environ["DATA"] + "/femur.ply"]
+  imageFiles = [tempfile.mkdtemp() + "/femur" + str(i) + ".nrrd" for i in range(len(meshFiles))]
+  region = MeshUtils.meshesToImages(meshFiles, imageFiles, [1.0, 1.0, 1.0])
+
+  compareImg = Image(os.environ["DATA"] + "/femurImage.nrrd")
+
+  return region == MeshUtils.boundingBox(meshFiles) and Image(imageFiles[0]) == compareImg and Image(imageFiles[1]) == compareImg
+
+val = meshesToImagesTest()
+
+if val is False:
+  sys.exit(1)
+
+def readMeshesTest():
+  meshFiles = [os.environ["DATA"] + "/femur.ply", os.environ["DATA"] + "/ellipsoid_0.ply"]
+  meshes, region = MeshUtils.readMeshes(meshFiles)
+
+  return len(meshes) == 2 and meshes[0] == Mesh(meshFiles[0]) and meshes[1] == Mesh(meshFiles[1]) and region == MeshUtils.boundingBox(meshFiles)
+
+val = readMeshesTest()
+
+if val is False:
+  sys.exit(1)
@@ -1,5 +1,6 @@
 import os
 import sys
+import numpy as np
 from shapeworks import *
 
 def warpTest():
@@ -15,3 +16,19 @@ val = warpTest()
 
 if val is False:
   sys.exit(1)
+
+def warpArraysTest():
+  img = Image(os.environ["DATA"] + "/input.nrrd")
+  source = np.loadtxt(os.environ["DATA"] + "/source.particles")
+  target = np.loadtxt(os.environ["DATA"] + "/target.particles")
+  transform = ImageUtils.createWarpTransform(source, target, 3)
+  img.applyTransform(transform)
+
+  compareImg = Image(os.environ["DATA"] + "/warp2.nrrd")
+
+  return img.compare(compareImg)
+
+val = warpArraysTest()
+
+if val is False:
+  sys.exit(1)
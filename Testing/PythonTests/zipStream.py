@@ -0,0 +1,151 @@
+import os
+import sys
+# copy.py in this directory would shadow the standard library module http.server and requests import
+sys.path = [path for path in sys.path if os.path.abspath(path or '.') != os.path.dirname(os.path.abspath(__file__))]
+import io
+import shutil
+import tempfile
+import threading
+import functools
+import http.server
+import zipfile
+from DatasetUtils import ZipStream
+
+files = {
+  'ds/a.txt': b'hello' * 1000,
+  'ds/empty.txt': b'',
+  'ds/sub/b.bin': bytes(range(256)) * 1200,
+  # data descriptor signatures inside the data of a stored member
+  'ds/sub/c.bin': b'x' + b'PK\x07\x08' * 5000 + b'PK\x07\x08',
+  'ds/deep/d/e.raw': bytes(range(7, 250)) * 900
+}
+
+# a file zipfile can only write to in order, so members are written with data descriptors
+class Unseekable(io.RawIOBase):
+  def __init__(self):
+    self.data = io.BytesIO()
+  def writable(self):
+    return True
+  def write(self, data):
+    return self.data.write(data)
+
+def makeZip(compression, streamed=False, zip64=False):
+  out = Unseekable() if streamed else io.BytesIO()
+  with zipfile.ZipFile(out, 'w', compression) as zip:
+    zip.writestr('ds/', b'')
+    for name, data in files.items():
+      if streamed or zip64:
+        with zip.open(name, 'w', force_zip64=zip64) as member:
+          member.write(data)
+      else:
+        zip.writestr(name, data)
+  return (out.data if streamed else out).getvalue()
+
+def chunks(data, size):
+  for start in range(0, len(data), size):
+    yield data[start:start + size]
+
+def extracted(destination, names):
+  for name, data in files.items():
+    path = os.path.join(destination, name)
+    if name not in names:
+      if os.path.exists(path):
+        return False
+    elif not os.path.exists(path) or open(path, 'rb').read() != data:
+      return False
+  for dirPath, dirNames, fileNames in os.walk(destination):
+    if any(fileName.endswith('.part') for fileName in fileNames):
+      return False
+  return True
+
+def extract(data, size, members=None):
+  destination = tempfile.mkdtemp()
+  ZipStream.extractZipStream(chunks(data, size), destination, members)
+  return destination
+
+def zipStreamTest():
+  zips = {}
+  for compression in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+    for streamed in [False, True]:
+      for zip64 in [False, True]:
+        zips[(compression, streamed, zip64)] = makeZip(compression, streamed, zip64)
+
+  for (compression, streamed, zip64), data in zips.items():
+    # whole zip, read in chunks that split the records anywhere
+    for size in [7, 1000, 1 << 20]:
+      if not extracted(extract(data, size), files):
+        print('extraction failed', compression, streamed, zip64, size)
+        return False
+    # subsets by name and by function
+    if not extracted(extract(data, 999, ['ds/a.txt']), ['ds/a.txt']):
+      return False
+    if not extracted(extract(data, 999, lambda name: name.startswith('ds/sub/')), ['ds/sub/b.bin', 'ds/sub/c.bin']):
+      return False
+
+  # a changed byte in a member fails its crc check and leaves no file behind
+  data = bytearray(zips[(zipfile.ZIP_STORED, False, False)])
+  data[data.find(files['ds/sub/b.bin'][:64]) + 1000] ^= 1
+  destination = tempfile.mkdtemp()
+  try:
+    ZipStream.extractZipStream(chunks(bytes(data), 5000), destination)
+    return False
+  except ValueError:
+    pass
+  if os.path.exists(os.path.join(destination, 'ds/sub/b.bin')) or os.path.exists(os.path.join(destination, 'ds/sub/b.bin.part')):
+    return False
+
+  # members outside of the destination are refused
+  for name in ['../evil.txt', 'ds/../../evil.txt', '/evil.txt']:
+    escaping = io.BytesIO()
+    with zipfile.ZipFile(escaping, 'w') as zip:
+      zip.writestr(name, b'x')
+    destination = tempfile.mkdtemp() + '/out'
+    try:
+      ZipStream.extractZipStream([escaping.getvalue()], destination)
+      return False
+    except ValueError:
+      pass
+    if os.path.exists(os.path.join(os.path.dirname(destination), 'evil.txt')):
+      return False
+    # an unsafe name that is not extracted does not stop a subset from being extracted
+    mixed = io.BytesIO()
+    with zipfile.ZipFile(mixed, 'w') as zip:
+      zip.writestr(name, b'x')
+      zip.writestr('ds/a.txt', files['ds/a.txt'])
+    if not extracted(extract(mixed.getvalue(), 999, ['ds/a.txt']), ['ds/a.txt']):
+      return False
+
+  # requested members that are not in the zip are reported
+  try:
+    extract(zips[(zipfile.ZIP_DEFLATED, False, False)], 999, ['ds/a.txt', 'ds/missing.txt'])
+    return False
+  except ValueError as error:
+    if 'ds/missing.txt' not in str(error):
+      return False
+
+  # download from a local http server
+  serverDir = tempfile.mkdtemp()
+  with open(os.path.join(serverDir, 'fixture.zip'), 'wb') as fixture:
+    fixture.write(zips[(zipfile.ZIP_DEFLATED, True, False)])
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(http.server.SimpleHTTPRequestHandler, directory=serverDir))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = 'http://127.0.0.1:%d/' % server.server_address[1]
+  try:
+    destination = tempfile.mkdtemp()
+    if len(ZipStream.extractZipFromUrl(url + 'fixture.zip', destination)) != len(files) or not extracted(destination, files):
+      return False
+    try:
+      ZipStream.extractZipFromUrl(url + 'missing.zip', tempfile.mkdtemp())
+      return False
+    except ValueError:
+      pass
+  finally:
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(serverDir)
+  return True
+
+val = zipStreamTest()
+
+if val is False:
+  sys.exit(1)